@@ -0,0 +1,192 @@
+import logging
+import select
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+
+logging.basicConfig(level=logging.INFO)
+
+# Progress of a running statement. {} is the backend pid.
+redshift_inflight_progress = ("""
+    SELECT query, DATEDIFF(second, starttime, GETDATE()), TRIM(text)
+    FROM stv_inflight
+    WHERE pid = {}
+    ORDER BY starttime DESC
+    LIMIT 1
+""")
+redshift_load_progress = ("""
+    SELECT SUM(bytes_loaded), SUM(bytes_to_load), MIN(pct_complete)
+    FROM stv_load_state
+    WHERE pid = {}
+""")
+postgres_progress = ("""
+    SELECT state, EXTRACT(epoch FROM NOW() - query_start), wait_event, LEFT(query, 60)
+    FROM pg_stat_activity
+    WHERE pid = {}
+""")
+cancel_backend = "SELECT pg_cancel_backend({})"
+
+class StatementController():
+    """
+    Runs the statements of every psycopg2 connection through psycopg2's
+    asynchronous protocol, using a wait callback instead of a blocking
+    libpq call. The thread waiting for a statement wakes up every
+    `poll_interval` seconds to:
+    - log the statement's progress, read from stv_inflight/stv_load_state on
+      Redshift and from pg_stat_activity on PostgreSQL
+    - cancel it with pg_cancel_backend once the deadline set for the
+      current thread with deadline() has passed. The waiting execute()
+      then raises psycopg2.extensions.QueryCanceledError.
+
+    Status queries and cancels go through a separate control connection,
+    so they work while every pooled connection is busy.
+
+    ...
+
+    Attributes
+    ----------
+    connect : callable
+        opens the control connection
+    poll_interval : float
+        seconds between progress reports and deadline checks
+    """
+    def __init__(self, connect, poll_interval=5.0):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.redshift = None
+        self._control = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def install(self):
+        """Routes every psycopg2 statement of this process through wait()."""
+        psycopg2.extensions.set_wait_callback(self.wait)
+
+    @staticmethod
+    def uninstall():
+        psycopg2.extensions.set_wait_callback(None)
+
+    @contextmanager
+    def deadline(self, seconds):
+        """
+        Cancels statements started by the current thread inside the with
+        block once `seconds` have passed since it was entered.
+        """
+        with self.deadline_at(time.monotonic() + seconds if seconds else None):
+            yield
+
+    @contextmanager
+    def deadline_at(self, deadline):
+        """
+        Cancels statements started by the current thread inside the with
+        block once time.monotonic() reaches `deadline` (None for never).
+        """
+        previous = getattr(self._local, 'deadline', None)
+        self._local.deadline = deadline
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def current_deadline(self):
+        """Deadline of the current thread as a time.monotonic() value, or None."""
+        return getattr(self._local, 'deadline', None)
+
+    def wait(self, conn):
+        """Wait callback: polls `conn` until its statement has finished."""
+        started = time.monotonic()
+        next_tick = started + self.poll_interval
+        cancelled = False
+        while True:
+            state = conn.poll()
+            if state == psycopg2.extensions.POLL_OK:
+                return
+            wake_up = next_tick if cancelled else min(next_tick, self._deadline_or(next_tick))
+            timeout = max(0.0, wake_up - time.monotonic())
+            if state == psycopg2.extensions.POLL_READ:
+                ready = select.select([conn.fileno()], [], [], timeout)[0]
+            elif state == psycopg2.extensions.POLL_WRITE:
+                ready = select.select([], [conn.fileno()], [], timeout)[1]
+            else:
+                raise psycopg2.OperationalError(f"Unexpected poll state: {state}")
+            if ready or conn is self._control or getattr(self._local, 'in_tick', False):
+                continue
+            now = time.monotonic()
+            deadline = getattr(self._local, 'deadline', None)
+            if deadline is not None and now >= deadline and not cancelled:
+                logging.warning(f"Deadline passed after {now - started:.0f}s, "
+                                f"cancelling backend {conn.get_backend_pid()}.")
+                self.cancel(conn.get_backend_pid())
+                cancelled = True
+            elif now >= next_tick:
+                self._report(conn, now - started)
+                next_tick = now + self.poll_interval
+
+    def cancel(self, pid):
+        """Cancels the statement running on backend `pid`."""
+        try:
+            self._control_query(cancel_backend.format(pid))
+        except psycopg2.Error as e:
+            logging.warning(f"Could not cancel backend {pid}: {e}")
+
+    def _deadline_or(self, default):
+        deadline = getattr(self._local, 'deadline', None)
+        return default if deadline is None else deadline
+
+    def _report(self, conn, seconds):
+        progress = self.progress(conn.get_backend_pid())
+        logging.info(f"Statement on backend {conn.get_backend_pid()} running for "
+                     f"{seconds:.0f}s: {progress}")
+
+    def progress(self, pid):
+        """
+        Returns what the database reports about the statement running on
+        backend `pid`, or {} if it cannot be read.
+        """
+        try:
+            if self._is_redshift():
+                inflight = self._control_query(redshift_inflight_progress.format(pid))
+                load = self._control_query(redshift_load_progress.format(pid))
+                progress = {}
+                if inflight:
+                    query_id, seconds, text = inflight[0]
+                    progress.update(query_id=query_id, seconds=seconds, text=text)
+                if load and load[0][1]:
+                    loaded, to_load, pct_complete = load[0]
+                    progress.update(bytes_loaded=loaded, bytes_to_load=to_load,
+                                    pct_complete=pct_complete)
+                return progress
+            rows = self._control_query(postgres_progress.format(pid))
+            if not rows:
+                return {}
+            state, seconds, wait_event, text = rows[0]
+            return {'state': state, 'seconds': float(seconds or 0),
+                    'wait_event': wait_event, 'text': text}
+        except psycopg2.Error as e:
+            logging.warning(f"Could not read progress of backend {pid}: {e}")
+            return {}
+
+    def _is_redshift(self):
+        if self.redshift is None:
+            self.redshift = 'redshift' in self._control_query("SELECT version()")[0][0].lower()
+        return self.redshift
+
+    def _control_query(self, query):
+        self._local.in_tick = True
+        try:
+            with self._lock:
+                if self._control is None or self._control.closed:
+                    self._control = self.connect()
+                    self._control.autocommit = True
+                with self._control.cursor() as cur:
+                    cur.execute(query)
+                    return cur.fetchall()
+        finally:
+            self._local.in_tick = False
+
+    def close(self):
+        with self._lock:
+            if self._control is not None and not self._control.closed:
+                self._control.close()
@@ -0,0 +1,50 @@
+import threading
+from settings import settings
+
+# boto3 is imported on first use: it takes longer to import than the rest
+# of the pipeline together, and runs on the local backend never need it.
+_lock = threading.RLock()
+_session = None
+_clients = {}
+
+def session():
+    """Shared boto3 session for the credentials and region in dwh.cfg."""
+    global _session
+    with _lock:
+        if _session is None:
+            import boto3
+            _session = boto3.session.Session(
+                aws_access_key_id=settings.KEY,
+                aws_secret_access_key=settings.SECRET,
+                region_name=settings.REGION)
+        return _session
+
+def client(service, max_pool_connections=None):
+    """
+    Returns the shared client of `service`. Clients are thread-safe once
+    created, but creating them from a session is not, hence the lock.
+    `max_pool_connections` should be at least the number of threads using
+    the client, or they queue for sockets.
+    """
+    key = (service, max_pool_connections)
+    with _lock:
+        if key not in _clients:
+            if max_pool_connections:
+                from botocore.config import Config
+                _clients[key] = session().client(
+                    service, config=Config(max_pool_connections=max_pool_connections))
+            else:
+                _clients[key] = session().client(service)
+        return _clients[key]
+
+def resource(service):
+    """Returns a new boto3 resource of `service`. Resources are not thread-safe."""
+    with _lock:
+        return session().resource(service)
+
+def reset():
+    """Drops the shared session and clients, e.g. after the credentials changed."""
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
@@ -0,0 +1,257 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+import psycopg2
+from compaction import iter_json_records, _read_local
+from data_generator import SparkifyDataGenerator
+from dialect import to_postgres, postgres_functions, parse_copy, jsonpath_fields
+from instrumentation import statement_name
+from local_backend import local_files
+from sql_queries import staging_events_copy, staging_songs_copy, \
+    create_staging_table_queries, drop_staging_table_queries, \
+    create_analytical_table_queries, drop_analytical_table_queries, \
+        insert_analytical_table_queries, song_lookup_insert, \
+        songplays_upsert, songplays_upsert_call, songplays_window, songplays_append, \
+        staging_events_keyed_drop, staging_events_keyed_create, \
+            read_total_users, read_total_songs, read_popular_songs, read_top_active_users, \
+                read_popular_songs_rollup, read_top_active_users_rollup, refresh_rollup_queries
+
+logging.basicConfig(level=logging.INFO)
+
+# The synthetic files stand in for this bucket in the staging COPYs.
+BENCH_BUCKET = 's3://sparkify-bench'
+BENCH_ROLE_ARN = 'arn:aws:iam::000000000000:role/sparkify-bench'
+
+# Size of the udacity-dend sample at scale 1x.
+BASE_EVENTS = 8056
+BASE_SONGS = 14896
+BASE_USERS = 100
+BASE_DAYS = 30
+BASE_SESSION_LENGTH = 10
+
+READ_QUERIES = [read_total_users, read_total_songs, read_popular_songs, read_top_active_users,
+                read_popular_songs_rollup, read_top_active_users_rollup]
+
+def write_synthetic_data(scale, output_dir, seed=42):
+    """
+    Writes log_data, song_data and log_json_path.json in the layout of
+    udacity-dend to output_dir, with roughly the row counts of the sample
+    times `scale`.
+    """
+    generator = SparkifyDataGenerator(
+        n_users=max(1, int(BASE_USERS * scale)), n_songs=max(1, int(BASE_SONGS * scale)),
+        n_days=BASE_DAYS, mean_session_length=BASE_SESSION_LENGTH,
+        sessions_per_user_day=BASE_EVENTS / (BASE_USERS * BASE_DAYS * BASE_SESSION_LENGTH),
+        seed=seed)
+    return generator.write(output_dir)
+
+def staging_copies():
+    """Name -> staging COPY statement of the pipeline, reading BENCH_BUCKET."""
+    return {
+        statement_name(staging_events_copy): staging_events_copy.format(
+            f"'{BENCH_BUCKET}/log_data'", BENCH_ROLE_ARN,
+            f"'{BENCH_BUCKET}/log_json_path.json'", ''),
+        statement_name(staging_songs_copy): staging_songs_copy.format(
+            f"'{BENCH_BUCKET}/song_data'", BENCH_ROLE_ARN, ''),
+    }
+
+def run_json_copy(cur, query, data_dir):
+    """
+    Runs a staging COPY ... JSON from sql_queries on PostgreSQL. The files
+    standing in for its S3 source are read from data_dir, each record is
+    mapped to the table columns through the JSONPaths file (or by column
+    name for JSON 'auto') like Redshift does, and the rows are streamed
+    through COPY FROM STDIN. Other COPY options are ignored.
+    Returns the number of rows loaded.
+    """
+    table, source, jsonpaths = parse_copy(query)
+    cur.execute("SELECT column_name FROM information_schema.columns "
+                "WHERE table_name = %s ORDER BY ordinal_position", (table,))
+    columns = [row[0] for row in cur.fetchall()]
+    if jsonpaths:
+        fields = jsonpath_fields(next(iter_json_records(
+            _read_local(local_files(data_dir, jsonpaths)[0]))))
+    else:
+        fields = columns
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    rows = 0
+    for path in local_files(data_dir, source):
+        for record in iter_json_records(_read_local(path)):
+            writer.writerow(['\\N' if record.get(field) is None else record[field]
+                             for field in fields])
+            rows += 1
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns[:len(fields)])}) "
+                    f"FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    return rows
+
+
+class BenchmarkRunner():
+    """
+    Creates the sql_queries schema in a local PostgreSQL database and times
+    every pipeline statement at several data scales.
+
+    ...
+
+    Attributes
+    ----------
+    dsn : str
+        libpq connection string of the local PostgreSQL database
+    repeat : int
+        number of times each read query is run (median and min are kept)
+    """
+    def __init__(self, dsn, repeat=3, seed=42):
+        self.dsn = dsn
+        self.repeat = repeat
+        self.seed = seed
+
+    def run(self, scales):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SHOW server_version")
+                server_version = cur.fetchone()[0]
+            report = {
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'server_version': server_version,
+                'python_version': platform.python_version(),
+                'seed': self.seed,
+                'scales': {},
+            }
+            for scale in scales:
+                logging.info(f"Running benchmark at scale {scale}x...")
+                report['scales'][str(scale)] = self.run_scale(conn, scale)
+            return report
+        finally:
+            conn.close()
+
+    def run_scale(self, conn, scale):
+        """
+        Rebuilds the schema, loads synthetic data through the staging COPYs
+        and times every statement. The COPY timings include reading and
+        mapping the JSON files, as Redshift's do.
+        """
+        data_dir = tempfile.mkdtemp(prefix='sparkify-bench-')
+        try:
+            write_synthetic_data(scale, data_dir, self.seed)
+            return self._run_scale(conn, scale, data_dir)
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    def _run_scale(self, conn, scale, data_dir):
+        results = {}
+        with conn.cursor() as cur:
+            for query in postgres_functions:
+                cur.execute(query)
+            cur.execute(staging_events_keyed_drop)
+            for query in drop_analytical_table_queries + drop_staging_table_queries:
+                cur.execute(query)
+            for query in create_staging_table_queries + create_analytical_table_queries:
+                cur.execute(to_postgres(query))
+            conn.commit()
+
+            for name, query in staging_copies().items():
+                copied = {}
+                results[name] = self._timed(conn, cur, lambda: copied.update(
+                    rows=run_json_copy(cur, query, data_dir)))
+                results[name]['rows'] = copied['rows']
+            cur.execute("ANALYZE staging_events")
+            cur.execute("ANALYZE staging_songs")
+            conn.commit()
+
+            for query in insert_analytical_table_queries:
+                results[statement_name(query)] = self._timed(
+                    conn, cur, lambda: cur.execute(to_postgres(query)))
+            results['song_lookup_insert'] = self._timed(
+                conn, cur, lambda: cur.execute(song_lookup_insert))
+            cur.execute(songplays_window)
+            window = cur.fetchone()
+            results['staging_events_keyed_create'] = self._timed(
+                conn, cur, lambda: cur.execute(to_postgres(staging_events_keyed_create)))
+            # songplays is empty, so the first load takes the append path and
+            # loading the same batch again takes the upsert path.
+            results['songplays_append'] = self._timed(
+                conn, cur, lambda: cur.execute(songplays_append.format(*window)))
+            cur.execute(to_postgres(songplays_upsert))
+            conn.commit()
+            results['songplays_upsert'] = self._timed(
+                conn, cur, lambda: cur.execute(songplays_upsert_call.format(*window)))
+            day = 86400000
+            days = (window[0] - window[0] % day, window[1] - window[1] % day + day)
+            results['refresh_rollups'] = self._timed(conn, cur, lambda: [
+                cur.execute(query.format(*days)) for query in refresh_rollup_queries])
+            cur.execute("ANALYZE")
+            conn.commit()
+
+            for query in READ_QUERIES:
+                results[statement_name(query)] = self._timed_read(conn, cur, to_postgres(query))
+        for name, result in results.items():
+            logging.info(f"{scale}x {name}: {result['seconds']:.4f}s")
+        return results
+
+    def _timed(self, conn, cur, func, rows=None):
+        start_time = time.perf_counter()
+        func()
+        conn.commit()
+        seconds = time.perf_counter() - start_time
+        return {'seconds': seconds, 'rows': rows if rows is not None else cur.rowcount}
+
+    def _timed_read(self, conn, cur, query):
+        timings = []
+        for _ in range(max(1, self.repeat)):
+            start_time = time.perf_counter()
+            cur.execute(query)
+            rows = cur.fetchall()
+            timings.append(time.perf_counter() - start_time)
+        conn.commit()
+        return {'seconds': statistics.median(timings), 'min_seconds': min(timings),
+                'rows': len(rows)}
+
+
+def compare_reports(baseline, current):
+    """
+    Returns (scale, statement, baseline seconds, current seconds, ratio)
+    for every statement present in both reports.
+    """
+    rows = []
+    for scale, results in current['scales'].items():
+        before = baseline.get('scales', {}).get(scale, {})
+        for name, result in results.items():
+            if name in before:
+                ratio = result['seconds'] / before[name]['seconds'] if before[name]['seconds'] else None
+                rows.append((scale, name, before[name]['seconds'], result['seconds'], ratio))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Sparkify SQL against a local PostgreSQL.")
+    parser.add_argument('--dsn', default='dbname=sparkify_bench',
+                        help="libpq connection string of the benchmark database")
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_report.json')
+    parser.add_argument('--compare', help="previous report to compare against")
+    args = parser.parse_args()
+
+    report = BenchmarkRunner(args.dsn, args.repeat).run(
+        [int(s) if s.is_integer() else s for s in args.scales])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for scale, name, before, after, ratio in compare_reports(baseline, report):
+            change = f"{ratio:.2f}x" if ratio is not None else "n/a"
+            logging.info(f"{scale}x {name}: {before:.4f}s -> {after:.4f}s ({change})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import json
+import math
+import os
+import statistics
+from compaction import slice_count
+
+# On-demand price per node-hour in USD (us-east-1), used to rank sizes.
+NODE_HOURLY_COST = {
+    'dc2.large': 0.25,
+    'ra3.xlplus': 1.086,
+    'ra3.4xlarge': 3.26,
+    'dc2.8xlarge': 4.80,
+    'ra3.16xlarge': 13.04,
+}
+
+# Largest multi-node cluster of each node type.
+MAX_NODES = {
+    'dc2.large': 32,
+    'ra3.xlplus': 32,
+    'ra3.4xlarge': 64,
+    'dc2.8xlarge': 128,
+    'ra3.16xlarge': 128,
+}
+
+MIN_NODES = 2
+
+# COPY throughput of one slice loading JSON from S3 when there is no
+# load history yet.
+DEFAULT_SLICE_BYTES_PER_SECOND = 5 * 1024 * 1024
+
+# Load history entries the throughput estimate is based on.
+HISTORY_WINDOW = 10
+
+def estimate_load_seconds(total_bytes, object_count, node_type, num_nodes,
+                          slice_bytes_per_second):
+    """
+    Returns the expected COPY time of `total_bytes` spread over
+    `object_count` files. Every file is loaded by one slice, so fewer
+    files than slices leave slices idle.
+    """
+    slices = slice_count(num_nodes, node_type)
+    busy_slices = max(1, min(slices, object_count))
+    return total_bytes / (busy_slices * slice_bytes_per_second)
+
+def choose_cluster_size(total_bytes, object_count, target_seconds,
+                        slice_bytes_per_second=DEFAULT_SLICE_BYTES_PER_SECOND,
+                        node_types=None, max_nodes=None):
+    """
+    Picks the cheapest node type and count whose estimated load time is at
+    most `target_seconds`. If no size meets the target the fastest one is
+    returned. Ties go to the faster size.
+
+    Returns a dict with node_type, num_nodes, slices, estimated_seconds,
+    hourly_cost and meets_target.
+    """
+    node_types = node_types or list(NODE_HOURLY_COST)
+    sizes = []
+    for node_type in node_types:
+        largest = MAX_NODES.get(node_type, MIN_NODES)
+        if max_nodes:
+            largest = min(largest, max_nodes)
+        for num_nodes in range(MIN_NODES, largest + 1):
+            seconds = estimate_load_seconds(total_bytes, object_count, node_type,
+                                            num_nodes, slice_bytes_per_second)
+            sizes.append({
+                'node_type': node_type,
+                'num_nodes': num_nodes,
+                'slices': slice_count(num_nodes, node_type),
+                'estimated_seconds': seconds,
+                'hourly_cost': NODE_HOURLY_COST.get(node_type, math.inf) * num_nodes,
+                'meets_target': seconds <= target_seconds,
+            })
+    if not sizes:
+        raise ValueError(f"No known node type in {node_types}")
+    fitting = [size for size in sizes if size['meets_target']]
+    if fitting:
+        return min(fitting, key=lambda size: (size['hourly_cost'], size['estimated_seconds']))
+    return min(sizes, key=lambda size: (size['estimated_seconds'], size['hourly_cost']))
+
+def elastic_node_count(base_nodes, wanted_nodes):
+    """
+    Clamps `wanted_nodes` to what an elastic resize of a `base_nodes`
+    cluster can reach: between half and double its node count.
+    """
+    lowest = max(MIN_NODES, math.ceil(base_nodes / 2))
+    return max(lowest, min(wanted_nodes, base_nodes * 2))
+
+def slice_throughput(history, default=DEFAULT_SLICE_BYTES_PER_SECOND):
+    """
+    Returns the median bytes per second and busy slice of the last
+    HISTORY_WINDOW loads in `history` (dicts with bytes, objects, slices
+    and seconds), or `default` if there are none. Like in
+    estimate_load_seconds, a load of fewer files than slices only keeps
+    as many slices busy as it has files.
+    """
+    rates = [entry['bytes'] / (max(1, min(entry['slices'], entry.get('objects') or entry['slices']))
+                               * entry['seconds'])
+             for entry in history
+             if entry.get('bytes') and entry.get('slices') and entry.get('seconds')]
+    rates = rates[-HISTORY_WINDOW:]
+    return statistics.median(rates) if rates else default
+
+def read_history(path):
+    """Reads the load history JSON lines file, or [] if there is none."""
+    if not path or not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def record_load(path, total_bytes, object_count, node_type, num_nodes, seconds):
+    """Appends a finished load to the load history file."""
+    entry = {
+        'bytes': total_bytes,
+        'objects': object_count,
+        'node_type': node_type,
+        'num_nodes': num_nodes,
+        'slices': slice_count(num_nodes, node_type),
+        'seconds': round(seconds, 3),
+    }
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
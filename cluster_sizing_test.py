@@ -0,0 +1,64 @@
+import unittest
+from cluster_sizing import choose_cluster_size, estimate_load_seconds, elastic_node_count, \
+    slice_throughput, DEFAULT_SLICE_BYTES_PER_SECOND
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+class ChooseClusterSizeTest(unittest.TestCase):
+
+    def test_picks_cheapest_size_meeting_target(self):
+        # 100 GB at 5 MB/s per slice within 10 minutes needs 35 busy slices.
+        size = choose_cluster_size(100 * GB, 10000, 600, 5 * MB,
+                                   node_types=['dc2.large', 'ra3.4xlarge'])
+        self.assertEqual((size['node_type'], size['num_nodes']), ('dc2.large', 18))
+        self.assertTrue(size['meets_target'])
+        self.assertLessEqual(size['estimated_seconds'], 600)
+        self.assertGreater(estimate_load_seconds(100 * GB, 10000, 'dc2.large', 17, 5 * MB), 600)
+
+    def test_falls_back_to_fastest_size(self):
+        size = choose_cluster_size(100 * GB, 10000, 1, 5 * MB, max_nodes=4)
+        self.assertFalse(size['meets_target'])
+        self.assertEqual(size['slices'], 64)
+        # dc2.8xlarge and ra3.16xlarge are equally fast; the cheaper one wins.
+        self.assertEqual((size['node_type'], size['num_nodes']), ('dc2.8xlarge', 4))
+
+
+class EstimateLoadSecondsTest(unittest.TestCase):
+
+    def test_every_slice_busy(self):
+        self.assertAlmostEqual(estimate_load_seconds(64 * MB, 100, 'dc2.large', 2, MB), 16)
+
+    def test_capped_by_file_count(self):
+        # A file is loaded by one slice, so 3 files keep 3 of 32 slices busy.
+        self.assertAlmostEqual(estimate_load_seconds(30 * MB, 3, 'dc2.8xlarge', 2, MB), 10)
+        self.assertAlmostEqual(estimate_load_seconds(30 * MB, 0, 'dc2.8xlarge', 2, MB), 30)
+
+
+class ElasticNodeCountTest(unittest.TestCase):
+
+    def test_within_range(self):
+        self.assertEqual(elastic_node_count(4, 6), 6)
+
+    def test_at_most_double(self):
+        self.assertEqual(elastic_node_count(4, 20), 8)
+
+    def test_at_least_half(self):
+        self.assertEqual(elastic_node_count(8, 3), 4)
+        self.assertEqual(elastic_node_count(2, 1), 2)
+
+
+class SliceThroughputTest(unittest.TestCase):
+
+    def test_default_without_history(self):
+        self.assertEqual(slice_throughput([]), DEFAULT_SLICE_BYTES_PER_SECOND)
+
+    def test_divides_by_busy_slices(self):
+        history = [{'bytes': 100 * MB, 'objects': 2, 'slices': 16, 'seconds': 10}]
+        self.assertAlmostEqual(slice_throughput(history), 5 * MB)
+        # Consistent with the estimate for the same load.
+        self.assertAlmostEqual(
+            estimate_load_seconds(100 * MB, 2, 'dc2.8xlarge', 1, slice_throughput(history)), 10)
+
+if __name__ == "__main__":
+    unittest.main()
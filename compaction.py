@@ -0,0 +1,200 @@
+import gzip
+import heapq
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from get_sparkify_data import S3Loader
+from load_state import parse_s3_url
+from settings import get_settings
+
+logging.basicConfig(level=logging.INFO)
+
+# Slices per node for each Redshift node type.
+SLICES_PER_NODE = {
+    'dc2.large': 2,
+    'dc2.8xlarge': 16,
+    'ds2.xlarge': 2,
+    'ds2.8xlarge': 16,
+    'ra3.xlplus': 2,
+    'ra3.4xlarge': 4,
+    'ra3.16xlarge': 16,
+}
+
+# Newline-delimited song JSON typically gzips to about a fifth of its size.
+GZIP_RATIO = 0.2
+
+def slice_count(num_nodes, node_type):
+    """Returns the number of slices of a cluster."""
+    return int(num_nodes) * SLICES_PER_NODE.get(node_type, 2)
+
+def part_count(total_bytes, slices, target_part_bytes):
+    """
+    Returns the number of compressed parts to split `total_bytes` of raw
+    JSON into: a multiple of the slice count, so every slice loads the same
+    number of files, with parts of at most about target_part_bytes.
+    """
+    compressed = total_bytes * GZIP_RATIO
+    return slices * max(1, math.ceil(compressed / (slices * target_part_bytes)))
+
+def iter_json_records(data):
+    """Yields every JSON value in a file that holds one or more of them."""
+    decoder = json.JSONDecoder()
+    text = data.decode('utf-8') if isinstance(data, bytes) else data
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            return
+        record, position = decoder.raw_decode(text, position)
+        yield record
+
+def _decompress(name, data):
+    return gzip.decompress(data) if name.endswith('.gz') else data
+
+def _read_local(path):
+    with open(path, 'rb') as f:
+        return _decompress(path, f.read())
+
+
+class SongCompactor():
+    """
+    Merges many small JSON objects (local files or S3 objects) into evenly
+    sized, gzipped, newline-delimited JSON parts that COPY loads in parallel
+    across all slices.
+
+    ...
+
+    Attributes
+    ----------
+    slices : int
+        number of slices of the target cluster
+    target_part_bytes : int
+        upper bound for the compressed size of a part
+    max_workers : int
+        number of threads fetching source objects and uploading parts
+    """
+    def __init__(self, slices, target_part_bytes=64 * 1024 * 1024, max_workers=16,
+                 s3_client=None):
+        self.slices = slices
+        self.target_part_bytes = target_part_bytes
+        self.max_workers = max_workers
+        self._s3_client = s3_client
+        self._s3_loader = None
+
+    @classmethod
+    def from_config(cls, config_path='dwh.cfg', slices=None, **kwargs):
+        """
+        Builds a compactor for `slices` slices, by default those of the
+        cluster described in dwh.cfg.
+        """
+        settings = get_settings(config_path)
+        slices = slices or slice_count(settings.DWH_NUM_NODES, settings.DWH_NODE_TYPE)
+        target_mb = settings.COMPACT_PART_MB
+        return cls(slices, int(target_mb * 1024 * 1024), **kwargs)
+
+    @property
+    def s3_loader(self):
+        if self._s3_loader is None:
+            self._s3_loader = S3Loader(s3_client=self._s3_client, max_workers=self.max_workers)
+        return self._s3_loader
+
+    def compact(self, source, destination, objects=None):
+        """
+        Compacts every JSON object under `source` into parts written to
+        `destination`. Both can be local folders or s3:// urls.
+
+        params:
+        - source: folder or s3 url holding the small JSON files
+        - destination: folder or s3 url for the parts (should be empty)
+        - objects: optional S3 listing entries to compact instead of
+          everything under an S3 source (e.g. only the new objects)
+
+        Returns a dict with the number of records, parts and bytes.
+        """
+        start_time = time.time()
+        if source.strip("'\"").startswith('s3://'):
+            bucket, prefix = parse_s3_url(source)
+            if objects is None:
+                objects = [o for o in self.s3_loader.iter_s3_objects(bucket, prefix)
+                           if not o['Key'].endswith('/')]
+            sizes = [o.get('Size', 0) for o in objects]
+            read = lambda obj: _decompress(obj['Key'], self.s3_loader.s3_client.get_object(
+                Bucket=bucket, Key=obj['Key'])['Body'].read())
+        else:
+            objects = sorted(os.path.join(root, name)
+                             for root, _, names in os.walk(source)
+                             for name in names if name.endswith(('.json', '.json.gz')))
+            sizes = [os.path.getsize(path) for path in objects]
+            read = _read_local
+
+        parts = part_count(sum(sizes), self.slices, self.target_part_bytes)
+        work_dir = tempfile.mkdtemp(prefix='compaction-')
+        try:
+            paths = [os.path.join(work_dir, f"part-{i:05d}.json.gz") for i in range(parts)]
+            writers = [gzip.open(path, 'wb') for path in paths]
+            # Always append to the part with the fewest bytes so parts stay even.
+            heap = [(0, i) for i in range(parts)]
+            records = 0
+            try:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    window = self.max_workers * 8
+                    for i in range(0, len(objects), window):
+                        for data in executor.map(read, objects[i:i + window]):
+                            for record in iter_json_records(data):
+                                line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+                                written, part = heapq.heappop(heap)
+                                writers[part].write(line)
+                                heapq.heappush(heap, (written + len(line), part))
+                                records += 1
+            finally:
+                for writer in writers:
+                    writer.close()
+            compressed = sum(os.path.getsize(path) for path in paths)
+            self._publish(paths, destination)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        stats = {'objects': len(objects), 'records': records, 'parts': parts,
+                 'raw_bytes': sum(sizes), 'compressed_bytes': compressed,
+                 'seconds': time.time() - start_time}
+        logging.info(f"Compacted {stats['objects']} objects ({stats['records']} records) into "
+                     f"{parts} parts of ~{compressed / parts / 1024 / 1024:.2f} MB "
+                     f"for {self.slices} slices in {stats['seconds']:.1f}s")
+        return stats
+
+    def prune(self, root, keep):
+        """
+        Deletes every object under the s3:// url `root` except those under
+        `keep`, e.g. the compacted batches before the one just loaded.
+        """
+        bucket, prefix = parse_s3_url(root)
+        _, keep_prefix = parse_s3_url(keep)
+        keep_prefix = keep_prefix.rstrip('/') + '/'
+        keys = [obj['Key'] for obj in self.s3_loader.iter_s3_objects(bucket, prefix)
+                if not obj['Key'].startswith(keep_prefix)]
+        client = self.s3_loader.s3_client
+        for i in range(0, len(keys), 1000):
+            client.delete_objects(Bucket=bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+        if keys:
+            logging.info(f"Pruned {len(keys)} objects of earlier batches under {bucket}/{prefix}.")
+        return len(keys)
+
+    def _publish(self, paths, destination):
+        if destination.strip("'\"").startswith('s3://'):
+            bucket, prefix = parse_s3_url(destination)
+            prefix = prefix.rstrip('/') + '/' if prefix else ''
+            client = self.s3_loader.s3_client
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(lambda path: client.upload_file(
+                    path, bucket, prefix + os.path.basename(path)), paths))
+        else:
+            os.makedirs(destination, exist_ok=True)
+            for path in paths:
+                shutil.move(path, os.path.join(destination, os.path.basename(path)))
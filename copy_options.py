@@ -0,0 +1,121 @@
+from settings import get_settings
+
+# Built-in load profiles. A first load into empty tables benefits from
+# automatic compression analysis and fresh statistics; staging tables are
+# emptied before every COPY and re-read every run, so both are wasted work.
+# Only speed settings differ between them: what gets loaded is the same.
+# 'lenient_staging' also cuts values that overflow their varchar column
+# instead of failing the COPY, which changes the loaded data, so it has
+# to be chosen explicitly.
+COPY_PROFILES = {
+    'first_load': {
+        'compression': '',
+        'compupdate': 'ON',
+        'statupdate': 'ON',
+        'maxerror': 0,
+        'truncatecolumns': False,
+        'region': '',
+    },
+    'fast_staging': {
+        'compression': '',
+        'compupdate': 'OFF',
+        'statupdate': 'OFF',
+        'maxerror': 0,
+        'truncatecolumns': False,
+        'region': '',
+    },
+    'lenient_staging': {
+        'compression': '',
+        'compupdate': 'OFF',
+        'statupdate': 'OFF',
+        'maxerror': 0,
+        'truncatecolumns': True,
+        'region': '',
+    },
+}
+
+COMPRESSION_FORMATS = ('', 'GZIP', 'ZSTD', 'BZIP2', 'LZOP')
+COMPUPDATE_VALUES = ('ON', 'OFF', 'PRESET')
+STATUPDATE_VALUES = ('ON', 'OFF')
+
+
+class CopyOptionsBuilder():
+    """
+    Assembles the option clause appended to the staging COPY statements
+    from a load profile.
+
+    ...
+
+    Attributes
+    ----------
+    profile : str
+        name of the load profile, e.g. 'fast_staging' or 'first_load'
+    options : dict
+        compression, compupdate, statupdate, maxerror, truncatecolumns and
+        region settings of the profile
+    """
+    def __init__(self, profile='fast_staging', **overrides):
+        if profile not in COPY_PROFILES and not overrides:
+            raise ValueError(f"Unknown COPY profile: {profile}")
+        self.profile = profile
+        self.options = dict(COPY_PROFILES.get(profile, COPY_PROFILES['fast_staging']))
+        self.options.update(overrides)
+        self._validate()
+
+    @classmethod
+    def from_config(cls, config_path='dwh.cfg', profile=None):
+        """
+        Builds the profile named by [ETL] copy_profile. Settings in a
+        [COPY <profile>] section override the built-in defaults.
+        """
+        settings = get_settings(config_path)
+        config = settings.config
+        profile = profile or settings.COPY_PROFILE
+        overrides = {}
+        section = f'COPY {profile}'
+        if config.has_section(section):
+            for key in ('compression', 'compupdate', 'statupdate', 'region'):
+                if config.has_option(section, key):
+                    overrides[key] = config.get(section, key)
+            if config.has_option(section, 'maxerror'):
+                overrides['maxerror'] = config.getint(section, 'maxerror')
+            if config.has_option(section, 'truncatecolumns'):
+                overrides['truncatecolumns'] = config.getboolean(section, 'truncatecolumns')
+        return cls(profile, **overrides)
+
+    def _validate(self):
+        self.options['compression'] = self.options['compression'].upper()
+        self.options['compupdate'] = self.options['compupdate'].upper()
+        self.options['statupdate'] = self.options['statupdate'].upper()
+        if self.options['compression'] not in COMPRESSION_FORMATS:
+            raise ValueError(f"Unsupported COPY compression: {self.options['compression']}")
+        if self.options['compupdate'] not in COMPUPDATE_VALUES:
+            raise ValueError(f"Invalid COMPUPDATE: {self.options['compupdate']}")
+        if self.options['statupdate'] not in STATUPDATE_VALUES:
+            raise ValueError(f"Invalid STATUPDATE: {self.options['statupdate']}")
+        if int(self.options['maxerror']) < 0:
+            raise ValueError("MAXERROR must not be negative")
+
+    def build(self, compression=None):
+        """
+        Returns the option clause, e.g.
+        "GZIP COMPUPDATE OFF STATUPDATE OFF TRUNCATECOLUMNS".
+
+        params:
+        - compression: overrides the profile's input compression for
+          sources with a known format, such as compacted GZIP parts
+        """
+        options = self.options
+        clause = []
+        compression = options['compression'] if compression is None else compression.upper()
+        if compression:
+            clause.append(compression)
+        clause.append(f"COMPUPDATE {options['compupdate']}")
+        clause.append(f"STATUPDATE {options['statupdate']}")
+        if int(options['maxerror']):
+            clause.append(f"MAXERROR {int(options['maxerror'])}")
+        if options['truncatecolumns']:
+            clause.append("TRUNCATECOLUMNS")
+        if options['region']:
+            clause.append(f"REGION '{options['region']}'")
+        return ' '.join(clause)
@@ -0,0 +1,313 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO)
+
+# Field order of log_json_path.json, i.e. of the staging_events columns.
+EVENT_FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName',
+    'length', 'level', 'location', 'method', 'page', 'registration', 'sessionId',
+    'song', 'status', 'ts', 'userAgent', 'userId']
+SONG_FIELDS = ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude',
+    'artist_location', 'artist_name', 'song_id', 'title', 'duration', 'year']
+
+FIRST_NAMES = np.array(['Jacob', 'Lily', 'Kevin', 'Chloe', 'Ryan', 'Ava', 'Noah',
+    'Emily', 'Jayden', 'Sophie', 'Aiden', 'Mia', 'Wyatt', 'Layla', 'Tegan', 'Adler'])
+LAST_NAMES = np.array(['Smith', 'Koch', 'Arellano', 'Cuevas', 'Levine', 'Robinson',
+    'Garrison', 'Kirby', 'Graves', 'Jones', 'Barrett', 'Moore', 'Hogan', 'Lynch'])
+LOCATIONS = np.array(['San Francisco-Oakland-Hayward, CA', 'Portland-South Portland, ME',
+    'Chicago-Naperville-Elgin, IL-IN-WI', 'Atlanta-Sandy Springs-Roswell, GA',
+    'New York-Newark-Jersey City, NY-NJ-PA', 'Lansing-East Lansing, MI',
+    'Tampa-St. Petersburg-Clearwater, FL', 'Houston-The Woodlands-Sugar Land, TX'])
+USER_AGENTS = np.array([
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.125 Safari/537.36"',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+    '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"'])
+OTHER_PAGES = np.array(['Home', 'Logout', 'Settings', 'About', 'Help', 'Upgrade', 'Downgrade'])
+LETTERS = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+LOG_JSONPATH = {'jsonpaths': [f"$['{field}']" for field in EVENT_FIELDS]}
+# Events are serialized this many rows at a time, so a large day never
+# has to be held as a single JSON string.
+WRITE_CHUNK_ROWS = 250000
+
+
+class SparkifyDataGenerator():
+    """
+    Generates synthetic Sparkify song and event data in the shape of the
+    udacity-dend bucket. Everything is built with vectorized numpy/pandas
+    operations one day at a time, so memory stays bounded by a single day.
+
+    ...
+
+    Attributes
+    ----------
+    n_users : int
+        number of distinct users
+    n_songs : int
+        number of songs in song_data
+    n_days : int
+        number of days of log_data, starting at start_date
+    sessions_per_user_day : float
+        average number of sessions a user starts per day
+    mean_session_length : float
+        average number of events per session (geometric distribution)
+    zipf_a : float
+        exponent of the Zipf distribution of song popularity, bounded to
+        the n_songs ranks (must be > 0; higher is more skewed)
+    unmatched_fraction : float
+        share of NextSong events whose song is not in song_data
+    nextsong_fraction : float
+        share of events that are song plays, the rest are other pages
+    """
+    def __init__(self, n_users=100, n_songs=15000, n_days=30, sessions_per_user_day=0.5,
+                 mean_session_length=10, zipf_a=1.2, unmatched_fraction=0.1,
+                 nextsong_fraction=0.8, start_date='2018-11-01', seed=42):
+        if zipf_a <= 0:
+            raise ValueError("zipf_a must be greater than 0")
+        self.n_users = int(n_users)
+        self.n_songs = int(n_songs)
+        self.n_artists = max(1, self.n_songs // 2)
+        self.n_days = int(n_days)
+        self.sessions_per_user_day = sessions_per_user_day
+        self.mean_session_length = mean_session_length
+        self.zipf_a = zipf_a
+        self.unmatched_fraction = unmatched_fraction
+        self.nextsong_fraction = nextsong_fraction
+        self.start_date = pd.Timestamp(start_date)
+        self.seed = seed
+        self._songs = None
+        self._users = None
+        self._session_offset = 0
+
+    def songs(self):
+        """Returns the song catalog as a DataFrame with SONG_FIELDS columns."""
+        if self._songs is None:
+            rng = np.random.default_rng([self.seed, 1])
+            n = self.n_songs
+            ids = np.char.mod('%016X', np.arange(n))
+            artists = rng.integers(self.n_artists, size=n)
+            artist_ids = np.char.mod('AR%016X', artists)
+            has_location = rng.random(n) < 0.4
+            letters = LETTERS[rng.integers(26, size=(n, 3))]
+            track_prefix = np.char.add(np.char.add(letters[:, 0], letters[:, 1]), letters[:, 2])
+            self._songs = pd.DataFrame({
+                'num_songs': np.ones(n, dtype=np.int64),
+                'artist_id': artist_ids,
+                'artist_latitude': np.where(has_location, rng.uniform(-60, 70, n), np.nan),
+                'artist_longitude': np.where(has_location, rng.uniform(-150, 150, n), np.nan),
+                'artist_location': np.where(has_location, LOCATIONS[artists % len(LOCATIONS)], ''),
+                'artist_name': np.char.mod('Artist %d', artists),
+                'song_id': np.char.add('SO', ids),
+                'title': np.char.add('Song ', ids),
+                'duration': np.round(rng.lognormal(5.4, 0.35, n), 5),
+                'year': np.where(rng.random(n) < 0.5, 0, rng.integers(1950, 2019, n)),
+            })
+            self._songs['track_id'] = np.char.add(np.char.add('TR', track_prefix), ids)
+            # Rank -> song, so popularity is not correlated with song ids.
+            self._popularity = rng.permutation(n)
+            # CDF of the Zipf distribution over exactly n ranks: rank k is
+            # played with probability proportional to 1 / k^zipf_a.
+            weights = 1.0 / np.arange(1, n + 1, dtype=np.float64) ** self.zipf_a
+            self._rank_cdf = np.cumsum(weights / weights.sum())
+        return self._songs
+
+    def users(self):
+        """Returns the user profiles used for the events."""
+        if self._users is None:
+            rng = np.random.default_rng([self.seed, 2])
+            n = self.n_users
+            self._users = pd.DataFrame({
+                'userId': np.arange(1, n + 1),
+                'firstName': FIRST_NAMES[rng.integers(len(FIRST_NAMES), size=n)],
+                'lastName': LAST_NAMES[rng.integers(len(LAST_NAMES), size=n)],
+                'gender': np.where(rng.random(n) < 0.5, 'F', 'M'),
+                'level': np.where(rng.random(n) < 0.3, 'paid', 'free'),
+                'location': LOCATIONS[rng.integers(len(LOCATIONS), size=n)],
+                'userAgent': USER_AGENTS[rng.integers(len(USER_AGENTS), size=n)],
+                'registration': rng.uniform(1.5e12, 1.54e12, n).round(),
+            })
+        return self._users
+
+    def events_for_day(self, day):
+        """
+        Returns the events of day number `day` (0 based) as a DataFrame with
+        EVENT_FIELDS columns, sorted by ts.
+        """
+        songs = self.songs()
+        users = self.users()
+        rng = np.random.default_rng([self.seed, 3, day])
+
+        n_sessions = rng.poisson(self.n_users * self.sessions_per_user_day)
+        lengths = rng.geometric(1.0 / self.mean_session_length, size=n_sessions)
+        session_users = rng.integers(self.n_users, size=n_sessions)
+        session_ids = self._session_offset + np.arange(n_sessions)
+        self._session_offset += n_sessions
+        day_start_ms = int((self.start_date + pd.Timedelta(days=day)).value // 10**6)
+        session_starts = day_start_ms + rng.integers(0, 86400 * 1000, size=n_sessions)
+
+        total = int(lengths.sum())
+        session_index = np.repeat(np.arange(n_sessions), lengths)
+        session_first = np.cumsum(lengths) - lengths
+        item_in_session = np.arange(total) - np.repeat(session_first, lengths)
+        # Each event starts one song length after the previous one.
+        gaps = rng.integers(120, 360, size=total) * 1000
+        before = np.cumsum(gaps) - gaps
+        elapsed = before - np.repeat(before[session_first], lengths)
+        ts = session_starts[session_index] + elapsed
+
+        user_rows = users.iloc[session_users[session_index]].reset_index(drop=True)
+        is_song = rng.random(total) < self.nextsong_fraction
+        matched = is_song & (rng.random(total) >= self.unmatched_fraction)
+        ranks = np.minimum(np.searchsorted(self._rank_cdf, rng.random(total), side='right'),
+                           self.n_songs - 1)
+        song_rows = self._popularity[ranks]
+
+        artist = songs['artist_name'].to_numpy()[song_rows].astype(object)
+        title = songs['title'].to_numpy()[song_rows].astype(object)
+        length = songs['duration'].to_numpy()[song_rows]
+        unmatched = is_song & ~matched
+        unmatched_ids = np.char.mod('%08X', rng.integers(0, 2**31, size=int(unmatched.sum())))
+        artist[unmatched] = np.char.add('Unknown Artist ', unmatched_ids)
+        title[unmatched] = np.char.add('Unknown Song ', unmatched_ids)
+        length[unmatched] = np.round(rng.lognormal(5.4, 0.35, int(unmatched.sum())), 5)
+        artist[~is_song] = None
+        title[~is_song] = None
+        length = np.where(is_song, length, np.nan)
+
+        events = pd.DataFrame({
+            'artist': artist,
+            'auth': 'Logged In',
+            'firstName': user_rows['firstName'],
+            'gender': user_rows['gender'],
+            'itemInSession': item_in_session,
+            'lastName': user_rows['lastName'],
+            'length': length,
+            'level': user_rows['level'],
+            'location': user_rows['location'],
+            'method': np.where(is_song, 'PUT', 'GET'),
+            'page': np.where(is_song, 'NextSong', OTHER_PAGES[rng.integers(len(OTHER_PAGES), size=total)]),
+            'registration': user_rows['registration'],
+            'sessionId': session_ids[session_index],
+            'song': title,
+            'status': 200,
+            'ts': ts,
+            'userAgent': user_rows['userAgent'],
+            'userId': user_rows['userId'],
+        })
+        return events.sort_values('ts', kind='stable').reset_index(drop=True)
+
+    def iter_event_days(self):
+        """Yields (date, events DataFrame) for every generated day."""
+        self._session_offset = 0
+        for day in range(self.n_days):
+            yield self.start_date + pd.Timedelta(days=day), self.events_for_day(day)
+
+    def write(self, output_dir, compress=False, target_file_bytes=None, songs_per_file=1):
+        """
+        Writes log_data/YYYY/MM/*.json, song_data/A/B/C/*.json and
+        log_json_path.json under output_dir.
+
+        params:
+        - output_dir: local folder to write to
+        - compress: gzip every file (adds .gz, load with COPY ... GZIP)
+        - target_file_bytes: split event files and pack song files to
+          about this (uncompressed) size; by default one file per day and
+          songs_per_file songs per file, like udacity-dend
+        - songs_per_file: songs per file when target_file_bytes is not set
+
+        Returns a dict with the number of files, rows and bytes written.
+        """
+        start_time = time.time()
+        stats = {'event_files': 0, 'events': 0, 'song_files': 0, 'songs': 0, 'bytes': 0}
+        suffix = '.json.gz' if compress else '.json'
+
+        for date, events in self.iter_event_days():
+            folder = os.path.join(output_dir, 'log_data', f"{date:%Y}", f"{date:%m}")
+            os.makedirs(folder, exist_ok=True)
+            parts = self._split(events, target_file_bytes)
+            for i, part in enumerate(parts):
+                name = f"{date:%Y-%m-%d}-events" + (f"-{i:04d}" if len(parts) > 1 else '')
+                path = os.path.join(folder, name + suffix)
+                with (gzip.open(path, 'wt') if compress else open(path, 'w')) as f:
+                    for start in range(0, len(part), WRITE_CHUNK_ROWS):
+                        chunk = part.iloc[start:start + WRITE_CHUNK_ROWS][EVENT_FIELDS]
+                        f.write(chunk.to_json(orient='records', lines=True).rstrip('\n') + '\n')
+                stats['event_files'] += 1
+                stats['bytes'] += os.path.getsize(path)
+            stats['events'] += len(events)
+
+        songs = self.songs()
+        lines = np.array(songs[SONG_FIELDS].to_json(orient='records', lines=True).splitlines(),
+                         dtype=object)
+        track_ids = songs['track_id'].to_numpy()
+        folders = (songs['track_id'].str[2] + '/' + songs['track_id'].str[3] + '/' +
+                   songs['track_id'].str[4])
+        for folder, rows in folders.groupby(folders, sort=False).indices.items():
+            path_folder = os.path.join(output_dir, 'song_data', *folder.split('/'))
+            os.makedirs(path_folder, exist_ok=True)
+            if target_file_bytes:
+                sizes = np.cumsum([len(line) + 1 for line in lines[rows]])
+                part_ids = sizes // target_file_bytes
+                parts = [rows[part_ids == i] for i in np.unique(part_ids)]
+            else:
+                step = max(1, songs_per_file)
+                parts = [rows[i:i + step] for i in range(0, len(rows), step)]
+            for part in parts:
+                path = os.path.join(path_folder, track_ids[part[0]] + suffix)
+                data = ('\n'.join(lines[part]) + '\n').encode('utf-8')
+                with (gzip.open(path, 'wb') if compress else open(path, 'wb')) as f:
+                    f.write(data)
+                stats['song_files'] += 1
+                stats['bytes'] += os.path.getsize(path)
+            stats['songs'] += len(rows)
+
+        with open(os.path.join(output_dir, 'log_json_path.json'), 'w') as f:
+            json.dump(LOG_JSONPATH, f, indent=4)
+        stats['seconds'] = time.time() - start_time
+        logging.info(f"Wrote {stats['events']} events in {stats['event_files']} files and "
+                     f"{stats['songs']} songs in {stats['song_files']} files "
+                     f"({stats['bytes'] / 1024 / 1024:.1f} MB) in {stats['seconds']:.1f}s")
+        return stats
+
+    @staticmethod
+    def _split(frame, target_file_bytes, columns=EVENT_FIELDS):
+        """Splits a frame into parts of about target_file_bytes of JSON."""
+        if not target_file_bytes or frame.empty:
+            return [frame]
+        sample = frame[columns].head(1000).to_json(orient='records', lines=True)
+        bytes_per_row = max(1, len(sample) / min(len(frame), 1000))
+        rows_per_file = max(1, int(target_file_bytes / bytes_per_row))
+        return [frame.iloc[i:i + rows_per_file] for i in range(0, len(frame), rows_per_file)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Sparkify data.")
+    parser.add_argument('output_dir', nargs='?', default='sparkify_synthetic')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--songs', type=int, default=15000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--sessions-per-user-day', type=float, default=0.5)
+    parser.add_argument('--session-length', type=float, default=10)
+    parser.add_argument('--zipf', type=float, default=1.2)
+    parser.add_argument('--unmatched', type=float, default=0.1)
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--target-file-mb', type=float)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    generator = SparkifyDataGenerator(
+        n_users=args.users, n_songs=args.songs, n_days=args.days,
+        sessions_per_user_day=args.sessions_per_user_day,
+        mean_session_length=args.session_length, zipf_a=args.zipf,
+        unmatched_fraction=args.unmatched, seed=args.seed)
+    generator.write(args.output_dir, compress=args.gzip,
+                    target_file_bytes=int(args.target_file_mb * 1024 * 1024) if args.target_file_mb else None)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,46 @@
-import configparser
 from sql_queries import staging_events_copy, staging_songs_copy, \
-    insert_analytical_table_queries, songplays_upsert, \
+    staging_events_copy_manifest, staging_songs_copy_manifest, \
+    staging_events_truncate, staging_songs_truncate, \
+    analytical_table_insert_templates, analytical_load_table_drop, \
+    analytical_load_table_create, analytical_load_table_publish, \
+    song_lookup_insert, songplays_upsert, songplays_upsert_call, \
+    songplays_window, songplays_window_overlap, songplays_append, \
+    staging_events_keyed_drop, staging_events_keyed_create, \
+    refresh_rollup_queries, songplays_time_range, rollup_coverage, \
+    read_popular_songs_rollup, read_top_active_users_rollup, \
+    create_analytical_table_queries, dimension_batch_drop, dimension_batch_create, \
+    dimension_merge_drop, dimension_merge_create, dimension_merge_dedupe, \
+    dimension_merge_delete, dimension_merge_insert, row_hash_column, row_hash_expression, \
         read_popular_songs, read_top_active_users, \
             read_total_songs, read_total_users
+from load_state import LoadStateManager, parse_s3_url
+from db_connection import backend_from_config
+from compaction import SongCompactor
+from copy_options import CopyOptionsBuilder
+from table_design import parse_create_table
+from result_cache import ResultCache
+from load_report import LoadReporter
+from settings import settings
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
 import time
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+DAY_MS = 86400000
+
+# dimension -> (columns, primary key) as declared in sql_queries
+DIMENSION_KEYS = {table: (columns, primary_key) for table, columns, primary_key in
+                  filter(None, map(parse_create_table, create_analytical_table_queries))
+                  if table in analytical_table_insert_templates}
+
+def row_hash(alias, columns):
+    """SQL expression hashing all `columns` of the row `alias`."""
+    return row_hash_expression.format(" || '|' || ".join(
+        row_hash_column.format(alias, column) for column in columns))
+
 class ETLManager():
     """
     1. Copies staging data from S3 to Redshift
@@ -18,99 +51,483 @@ class ETLManager():
 
     Attributes
     ----------
-    conn : psycopg2 connection
-        an object representing the connection to the database
-    cur : psycopg2 cursor
-        an object representing the database cursor
+    db : ConnectionManager or LocalConnectionManager
+        pool from which every method borrows its own connection
+    load_reporter : LoadReporter
+        reports the throughput and errors of every staging COPY
+    slices : int
+        slices of the cluster the compacted song parts are sized for
+        (None uses DWH_NUM_NODES and DWH_NODE_TYPE of dwh.cfg)
+    copied : dict
+        staging table -> {'bytes', 'objects'} its last COPY read, for the
+        loads that know it (manifests and compacted parts)
     """
-    def __init__(self, conn, cur):
-        self.conn = conn
-        self.cur = cur
+    def __init__(self, db):
+        self.db = db
         
-        config = configparser.ConfigParser()
-        config.read_file(open('dwh.cfg'))  
+        self.LOG_DATA            = settings.LOG_DATA
+        self.LOG_JSONPATH        = settings.LOG_JSONPATH
+        self.SONG_DATA           = settings.SONG_DATA
+        self.DWH_ROLE_ARN        = settings.DWH_ROLE_ARN
+        self.MANIFEST_PREFIX     = settings.MANIFEST_PREFIX
+        self.INCREMENTAL         = settings.INCREMENTAL
+        self.LOAD_STATE_FILE     = settings.LOAD_STATE_FILE
+        self.MAX_PARALLELISM     = settings.MAX_PARALLELISM
+        self.STEP_DEADLINES      = settings.section('DEADLINES', float)
+        self.INSERT_MODE         = settings.INSERT_MODE
+        self.COMPACT_SONGS       = settings.COMPACT_SONGS
+        self.COMPACTED_SONG_DATA = settings.COMPACTED_SONG_DATA
+        self.READ_FROM_ROLLUPS   = settings.READ_FROM_ROLLUPS
+        self.copy_options        = CopyOptionsBuilder.from_config()
+        self.result_cache        = ResultCache.from_config(settings.config)
+        self.load_reporter       = LoadReporter(db, settings.LOAD_REPORT_DIR or None)
+        self.slices = None
+        self.copied = {}
+        self._load_state = None
+        self._compactor = None
+        # The staging COPYs run concurrently and must share one of each.
+        self._lock = threading.Lock()
 
-        self.LOG_DATA            = config.get('S3', 'LOG_DATA')
-        self.LOG_JSONPATH        = config.get('S3', 'LOG_JSONPATH')  
-        self.SONG_DATA           = config.get('S3', 'SONG_DATA')
-        self.DWH_ROLE_ARN        = config.get('ROLE', 'DWH_ROLE_ARN')
-        
-    def copy_staging_events(self):
+    @property
+    def load_state(self):
+        """LoadStateManager, created on first use by an incremental load."""
+        with self._lock:
+            if self._load_state is None:
+                self._load_state = LoadStateManager(self.LOAD_STATE_FILE, self.MANIFEST_PREFIX)
+            return self._load_state
+
+    @property
+    def compactor(self):
+        """SongCompactor sized for `slices`, or the cluster in dwh.cfg."""
+        with self._lock:
+            if self._compactor is None:
+                self._compactor = SongCompactor.from_config(slices=self.slices)
+            return self._compactor
+
+    def copy_staging_events(self, incremental=None):
         """
-        Copies EVENTS data from AWS S3 to a redshift staging table.
+        Replaces the contents of a redshift staging table with EVENTS data
+        from AWS S3, so a re-run of the step does not load rows twice.
+        In incremental mode only objects that were not loaded before are
+        copied.
+        Returns the summary of its load report, None if nothing was copied.
         """
-        logging.info("Copying EVENT data to staging table...")
+        logging.info(f"Copying EVENT data to staging table ({self.copy_options.profile})...")
         start_time = time.time()
-        self.cur.execute(staging_events_copy.format(
-            self.LOG_DATA, self.DWH_ROLE_ARN, self.LOG_JSONPATH))
-        self.conn.commit()
+        with self.db.recorder.labels(copy_profile=self.copy_options.profile):
+            copy_id = self._copy_events(incremental)
         execution_time = time.time() - start_time
         logging.info(f"Finished copying EVENT data to staging. Total time: {execution_time}")
+        return self.load_reporter.report('staging_events', copy_id, execution_time)
+
+    def _copy_events(self, incremental):
+        if self._is_incremental(incremental):
+            return self._copy_incremental('staging_events', self.LOG_DATA,
+                staging_events_truncate, staging_events_copy_manifest,
+                self.LOG_JSONPATH, append_only=True)
+        else:
+            with self.db.connection() as (conn, cur):
+                cur.execute(staging_events_truncate)
+                copy_id = self.load_reporter.copy(cur, 'staging_events', staging_events_copy.format(
+                    self.LOG_DATA, self.DWH_ROLE_ARN, self.LOG_JSONPATH,
+                    self.copy_options.build()))
+                conn.commit()
+            return copy_id
         
-    def copy_staging_songs(self):
+    def copy_staging_songs(self, incremental=None):
         """
-        Copies SONGS data from AWS S3 to a redshift staging table.
+        Replaces the contents of a redshift staging table with SONGS data
+        from AWS S3, so a re-run of the step does not load rows twice.
+        In incremental mode only objects that were not loaded before are
+        copied.
+        With COMPACT_SONGS the small song files are first merged into
+        gzipped parts under COMPACTED_SONG_DATA and those are loaded.
+        Returns the summary of its load report, None if nothing was copied.
         """
-        logging.info("Copying SONG data to staging table...")
+        logging.info(f"Copying SONG data to staging table ({self.copy_options.profile})...")
         start_time = time.time()
-        self.cur.execute(staging_songs_copy.format(
-            self.SONG_DATA , self.DWH_ROLE_ARN))
-        self.conn.commit()
+        with self.db.recorder.labels(copy_profile=self.copy_options.profile):
+            copy_id = self._copy_songs(incremental)
         execution_time = time.time() - start_time
         logging.info(f"Finished copying SONG data to staging. Total time: {execution_time}")
+        return self.load_reporter.report('staging_songs', copy_id, execution_time)
+
+    def _copy_songs(self, incremental):
+        if self.COMPACT_SONGS:
+            return self._copy_compacted_songs(self._is_incremental(incremental))
+        elif self._is_incremental(incremental):
+            return self._copy_incremental('staging_songs', self.SONG_DATA,
+                staging_songs_truncate, staging_songs_copy_manifest)
+        else:
+            with self.db.connection() as (conn, cur):
+                cur.execute(staging_songs_truncate)
+                copy_id = self.load_reporter.copy(cur, 'staging_songs', staging_songs_copy.format(
+                    self.SONG_DATA , self.DWH_ROLE_ARN, self.copy_options.build()))
+                conn.commit()
+            return copy_id
+
+    def _copy_compacted_songs(self, incremental):
+        """
+        Compacts the (new) song objects into a fresh batch folder under
+        COMPACTED_SONG_DATA and replaces staging_songs with its contents.
+        Returns the query id of the COPY, None if there was nothing new.
+        """
+        objects = None
+        if incremental:
+            objects = self.load_state.pending_objects(self.SONG_DATA)
+        bucket, prefix = parse_s3_url(self.COMPACTED_SONG_DATA)
+        batch_url = f"s3://{bucket}/{prefix.rstrip('/')}/batch-{time.strftime('%Y%m%d%H%M%S')}/"
+        if objects is None or objects:
+            stats = self.compactor.compact(self.SONG_DATA, batch_url, objects)
+        with self.db.connection() as (conn, cur):
+            cur.execute(staging_songs_truncate)
+            if objects is not None and not objects:
+                conn.commit()
+                self.copied['staging_songs'] = {'bytes': 0, 'objects': 0}
+                logging.info("No new data for staging_songs.")
+                return
+            copy_id = self.load_reporter.copy(cur, 'staging_songs', staging_songs_copy.format(
+                f"'{batch_url}'", self.DWH_ROLE_ARN,
+                self.copy_options.build(compression='GZIP')))
+            conn.commit()
+        self.copied['staging_songs'] = {'bytes': stats['compressed_bytes'],
+                                        'objects': stats['parts']}
+        if incremental:
+            self.load_state.mark_loaded(self.SONG_DATA, objects)
+        self.compactor.prune(self.COMPACTED_SONG_DATA, batch_url)
+        return copy_id
+
+    def _is_incremental(self, incremental):
+        return self.INCREMENTAL if incremental is None else incremental
+
+    def _copy_incremental(self, table, source_url, truncate_query, copy_query, *copy_args,
+                          append_only=False):
+        """
+        Replaces the contents of a staging table with the S3 objects that
+        have not been loaded yet, then advances the load high-water mark.
+        Returns the query id of the COPY, None if there was nothing new.
+        """
+        objects = self.load_state.pending_objects(source_url, append_only)
+        if objects:
+            manifest_url = self.load_state.write_copy_manifest(source_url, objects, table)
+        with self.db.connection() as (conn, cur):
+            cur.execute(truncate_query)
+            if not objects:
+                conn.commit()
+                self.copied[table] = {'bytes': 0, 'objects': 0}
+                logging.info(f"No new data for {table}.")
+                return
+            copy_id = self.load_reporter.copy(cur, table, copy_query.format(
+                manifest_url, self.DWH_ROLE_ARN, *copy_args, self.copy_options.build()))
+            conn.commit()
+        self.copied[table] = {'bytes': sum(obj.get('Size', 0) for obj in objects),
+                              'objects': len(objects)}
+        self.load_state.mark_loaded(source_url, objects)
+        self.load_state.prune_manifests(table)
+        return copy_id
         
-    def insert_analytical_data(self):
+    def insert_analytical_data(self, mode=None):
         """
         Transforms data from Redshift staging tables into analytical tables.
         The songplay table is excluded from this. Data is transformed 
         via a different method for it.
+
+        Either all dimensions are published or none are:
+        - 'atomic' runs the four inserts in one transaction
+        - 'parallel' loads each dimension into a shadow table on its own
+          connection at the same time, then publishes them in one transaction
+        - 'upsert' merges the staging batch into the existing rows on the
+          primary key in one transaction, so re-runs do not add duplicates
+
+        Returns a dict of table -> {'rows': ..., 'seconds': ...}.
+        """
+        mode = mode or self.INSERT_MODE
+        logging.info(f"Inserting analytical data ({mode})...")
+        if mode == 'atomic':
+            stats = self._insert_atomic()
+        elif mode == 'parallel':
+            stats = self._insert_parallel()
+        elif mode == 'upsert':
+            stats = self._insert_upsert()
+        else:
+            raise ValueError(f"Unknown insert mode: {mode}")
+        for table, table_stats in stats.items():
+            logging.info(f"{table}: {table_stats['rows']} rows in {table_stats['seconds']:.2f}s")
+        return stats
+
+    def _insert_atomic(self):
+        stats = {}
+        with self.db.connection() as (conn, cur):
+            for table, template in analytical_table_insert_templates.items():
+                start_time = time.time()
+                cur.execute(template.format(table))
+                stats[table] = {'rows': cur.rowcount, 'seconds': time.time() - start_time}
+            conn.commit()
+        self._new_load_generation()
+        return stats
+
+    def _insert_parallel(self):
+        tables = list(analytical_table_insert_templates)
+        workers = max(1, min(len(tables), self.MAX_PARALLELISM))
+        # The step deadline is per thread: the workers take over this one's.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {table: executor.submit(self.db.with_current_deadline(
+                           functools.partial(self.stage_analytical_table, table)))
+                       for table in tables}
+        try:
+            stats = {table: future.result() for table, future in futures.items()}
+        except Exception:
+            self.drop_load_tables(tables)
+            raise
+        self.publish_analytical_tables(tables)
+        return stats
+
+    def _insert_upsert(self):
+        stats = {}
+        with self.db.connection() as (conn, cur):
+            for table in analytical_table_insert_templates:
+                stats[table] = self._merge_table(cur, table)
+            conn.commit()
+        self._new_load_generation()
+        return stats
+
+    def upsert_analytical_table(self, table):
+        """
+        Merges the current staging batch into one dimension on its own
+        connection. Returns {'rows', 'inserted', 'updated', 'seconds'}.
         """
-        for query in insert_analytical_table_queries:
-            self.cur.execute(query)
-            self.conn.commit()
+        with self.db.connection() as (conn, cur):
+            stats = self._merge_table(cur, table)
+            conn.commit()
+        self._new_load_generation()
+        return stats
+
+    def _merge_table(self, cur, table):
+        """
+        Staged merge of the staging batch into `table`, keyed on its
+        declared primary key. Only the batch and the rows sharing its keys
+        are read, so the cost follows the batch size and not the table size.
+        """
+        columns, primary_key = DIMENSION_KEYS[table]
+        start_time = time.time()
+        cur.execute(dimension_batch_drop.format(table))
+        cur.execute(dimension_merge_drop.format(table))
+        cur.execute(dimension_batch_create.format(table))
+        cur.execute(dimension_merge_create.format(table))
+        cur.execute(analytical_table_insert_templates[table].format(f"{table}_batch"))
+        cur.execute(dimension_merge_dedupe.format(table, primary_key,
+            ', '.join(f"d.{column}" for column in columns), row_hash('b', columns)))
+        cur.execute(dimension_merge_delete.format(table, primary_key,
+            row_hash(table, columns), row_hash('m', columns)))
+        updated = cur.rowcount
+        cur.execute(dimension_merge_insert.format(table, primary_key))
+        inserted = cur.rowcount - updated
+        cur.execute(dimension_batch_drop.format(table))
+        cur.execute(dimension_merge_drop.format(table))
+        return {'rows': inserted + updated, 'inserted': inserted, 'updated': updated,
+                'seconds': time.time() - start_time}
+
+    def stage_analytical_table(self, table):
+        """
+        Loads one dimension (users, songs, artists or time) into its shadow
+        table <table>_load on its own connection. Nothing is visible in the
+        real table until publish_analytical_tables is called. The shadow
+        table is dropped again if loading it fails.
+        """
+        start_time = time.time()
+        try:
+            with self.db.connection() as (conn, cur):
+                cur.execute(analytical_load_table_drop.format(table))
+                cur.execute(analytical_load_table_create.format(table))
+                cur.execute(analytical_table_insert_templates[table].format(f"{table}_load"))
+                rows = cur.rowcount
+                conn.commit()
+        except Exception:
+            try:
+                self.drop_load_tables([table])
+            except Exception as e:
+                logging.warning(f"Could not drop {table}_load: {e}")
+            raise
+        return {'rows': rows, 'seconds': time.time() - start_time}
+
+    def publish_analytical_tables(self, tables=None):
+        """
+        Appends every shadow table to its analytical table and drops the
+        shadow tables, all in a single transaction.
+        """
+        tables = tables or list(analytical_table_insert_templates)
+        start_time = time.time()
+        with self.db.connection() as (conn, cur):
+            for table in tables:
+                cur.execute(analytical_load_table_publish.format(table))
+                cur.execute(analytical_load_table_drop.format(table))
+            conn.commit()
+        self._new_load_generation()
+        logging.info(f"Published {', '.join(tables)} in {time.time() - start_time:.2f}s")
+
+    def drop_load_tables(self, tables=None):
+        """Removes leftover shadow tables after a failed load."""
+        tables = tables or list(analytical_table_insert_templates)
+        with self.db.connection() as (conn, cur):
+            for table in tables:
+                cur.execute(analytical_load_table_drop.format(table))
+            conn.commit()
+
+    def update_song_lookup(self):
+        """
+        Adds the songs of the current staging_songs batch to song_lookup,
+        which songplays are resolved against. Returns the number of new keys.
+        """
+        start_time = time.time()
+        with self.db.connection() as (conn, cur):
+            cur.execute(song_lookup_insert)
+            rows = cur.rowcount
+            conn.commit()
+        logging.info(f"song_lookup: {rows} new songs in {time.time() - start_time:.2f}s")
+        return rows
 
     def upsert_songplay_data(self):
         """
         Transforms data from Redshift staging tables into analytical tables.
         This is a special method only for upserts which:
-        1. Creates a procedure for upserting data
-        2. Executes the procedure
+        1. Finds the min/max ts of the NextSong events in staging and
+           copies them into staging_events_keyed with their song key
+        2. Appends the batch directly if songplays has no rows in that window
+        3. Otherwise creates the upsert procedure and calls it with the
+           window, so only that range of songplays is read and replaced
+        4. Recomputes the daily rollups of the days in the window, in the
+           same transaction, and all of them if they do not cover songplays
+           (songplays loaded before the rollups existed, or older data on a
+           restored cluster)
+
+        Returns {'mode', 'min_ts', 'max_ts', 'rows', 'seconds'}; rows is
+        None for the procedure, which does not report a row count.
         """
-        self.cur.execute(songplays_upsert)
-        self.conn.commit()
-        self.cur.execute("CALL songplays_upsert();")
-        self.conn.commit()
+        start_time = time.time()
+        with self.db.connection() as (conn, cur):
+            cur.execute(songplays_window)
+            min_ts, max_ts = cur.fetchone()
+            if min_ts is None:
+                self._backfill_rollups(cur)
+                conn.commit()
+                logging.info("No new songplays in staging.")
+                return {'mode': 'none', 'min_ts': None, 'max_ts': None, 'rows': 0,
+                        'seconds': time.time() - start_time}
+            cur.execute(songplays_window_overlap.format(min_ts, max_ts))
+            overlap = cur.fetchone() is not None
+            cur.execute(staging_events_keyed_drop)
+            cur.execute(staging_events_keyed_create)
+            if overlap:
+                mode = 'upsert'
+                cur.execute(songplays_upsert)
+                conn.commit()
+                cur.execute(songplays_upsert_call.format(min_ts, max_ts))
+            else:
+                mode = 'append'
+                cur.execute(songplays_append.format(min_ts, max_ts))
+            rows = cur.rowcount if mode == 'append' else None
+            cur.execute(staging_events_keyed_drop)
+            self._refresh_rollups(cur, min_ts, max_ts)
+            self._backfill_rollups(cur)
+            conn.commit()
+        self._new_load_generation()
+        stats = {'mode': mode, 'min_ts': min_ts, 'max_ts': max_ts, 'rows': rows,
+                 'seconds': time.time() - start_time}
+        logging.info(f"songplays {mode} of ts {min_ts}..{max_ts} in {stats['seconds']:.2f}s")
+        return stats
         
-    def get_popular_songs(self):
+    def _refresh_rollups(self, cur, min_ts, max_ts):
+        """Recomputes the daily rollup rows of every day from min_ts to max_ts."""
+        first_day = min_ts - min_ts % DAY_MS
+        end_day = max_ts - max_ts % DAY_MS + DAY_MS
+        for query in refresh_rollup_queries:
+            cur.execute(query.format(first_day, end_day))
+
+    def _backfill_rollups(self, cur):
+        """
+        Recomputes the rollups over all of songplays if their play count
+        differs from songplays. Returns True if they were rebuilt.
         """
-        Retrieve top 5 popular songs form songplays.
+        cur.execute(rollup_coverage)
+        songplays, rolled_up = cur.fetchone()
+        if songplays == rolled_up:
+            return False
+        logging.info(f"Rollups hold {rolled_up} of {songplays} songplays, rebuilding them.")
+        self._rebuild_rollups(cur)
+        return True
+
+    def _rebuild_rollups(self, cur):
+        cur.execute(songplays_time_range)
+        min_ts, max_ts = cur.fetchone()
+        if min_ts is not None:
+            self._refresh_rollups(cur, min_ts, max_ts)
+
+    def rebuild_rollups(self):
         """
-        self.cur.execute(read_popular_songs)
-        return self.cur.fetchall()
+        Recomputes the rollups over all of songplays, e.g. after songplays
+        was loaded before the rollup tables existed.
+        """
+        with self.db.connection() as (conn, cur):
+            self._rebuild_rollups(cur)
+            conn.commit()
+        self._new_load_generation()
+
+    def _use_rollups(self, from_rollups):
+        return self.READ_FROM_ROLLUPS if from_rollups is None else from_rollups
+
+    def get_popular_songs(self, from_rollups=None):
+        """
+        Retrieve top 5 popular songs form songplays, answered from the
+        song_plays_daily rollup unless from_rollups (or READ_FROM_ROLLUPS)
+        is False.
+        """
+        return self._fetchall(read_popular_songs_rollup if self._use_rollups(from_rollups)
+                              else read_popular_songs)
     
-    def get_top_users(self):
+    def get_top_users(self, from_rollups=None):
         """
-        Retrieve top 5 users by most songplays.
+        Retrieve top 5 users by most songplays, answered from the
+        user_plays_daily rollup unless from_rollups (or READ_FROM_ROLLUPS)
+        is False.
         """
-        self.cur.execute(read_top_active_users)
-        return self.cur.fetchall()
+        return self._fetchall(read_top_active_users_rollup if self._use_rollups(from_rollups)
+                              else read_top_active_users)
     
     def get_total_users(self):
         """
         Retrieve total user count.
         """
-        self.cur.execute(read_total_users)
-        return self.cur.fetchall()
+        return self._fetchall(read_total_users)
     
     def get_total_songs(self):
         """
         Retrieve total song count.
         """
-        self.cur.execute(read_total_songs)
-        return self.cur.fetchall()
+        return self._fetchall(read_total_songs)
+
+    def _fetchall(self, query):
+        if self.result_cache is None:
+            return self._query(query)
+        return self.result_cache.get_or_load(query, lambda: self._query(query))
+
+    def _query(self, query):
+        with self.db.connection() as (conn, cur):
+            cur.execute(query)
+            rows = cur.fetchall()
+            conn.commit()
+            return rows
+
+    def _new_load_generation(self):
+        """Drops cached read results once a load has been committed."""
+        if self.result_cache is not None:
+            self.result_cache.invalidate()
+
+    def cache_stats(self):
+        """Hit/miss/latency stats of the read cache (None if disabled)."""
+        return None if self.result_cache is None else self.result_cache.stats()
 
 def main():
-    etl = ETLManager()
+    etl = ETLManager(backend_from_config()())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,88 @@
+from concurrent.futures import ThreadPoolExecutor
+from data_manager import ETLManager
+from instrumentation import StatementRecorder
+from local_backend import LocalConnectionManager
+from settings import settings
+from unittest import mock
+import configparser
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dwh_template.cfg')
+
+# Runs for about two seconds on SQLite.
+SLOW_QUERY = """
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 5000000)
+    SELECT COUNT(*) FROM n
+"""
+
+class LocalTestCase(unittest.TestCase):
+    """
+    Runs each test on the local backend with dwh.cfg replaced by a copy of
+    dwh_template.cfg in a temporary directory, changed by `options`.
+    """
+    # (section, option) -> value
+    options = {}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = configparser.ConfigParser()
+        config.read(TEMPLATE)
+        config.set('LOCAL', 'database', os.path.join(self.directory, 'test.db'))
+        config.set('LOCAL', 'data_dir', self.directory)
+        # Files written by a run stay in the temporary directory.
+        for section, option in [('ETL', 'load_state_file'), ('ETL', 'run_state_file'),
+                                ('METRICS', 'statement_log'), ('METRICS', 'load_report_dir')]:
+            config.set(section, option, os.path.join(self.directory, config.get(section, option)))
+        for (section, option), value in self.options.items():
+            config.set(section, option, value)
+        self.config_path = os.path.join(self.directory, 'dwh.cfg')
+        with open(self.config_path, 'w') as f:
+            config.write(f)
+        self.previous_path = settings.path
+        settings.path = self.config_path
+        settings.reload()
+        self.db = LocalConnectionManager(self.config_path, recorder=StatementRecorder())
+
+    def tearDown(self):
+        settings.path = self.previous_path
+        settings.reload()
+        shutil.rmtree(self.directory)
+
+
+class DeadlineTest(LocalTestCase):
+
+    def slow_query(self, *args):
+        with self.db.connection() as (conn, cur):
+            cur.execute(SLOW_QUERY)
+            return cur.fetchone()
+
+    def test_workers_take_over_the_deadline(self):
+        def submit():
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                return executor.submit(self.db.with_current_deadline(self.slow_query)).result()
+        start_time = time.monotonic()
+        with self.assertRaisesRegex(sqlite3.OperationalError, 'interrupted'):
+            self.db.with_deadline(submit, 0.2)()
+        self.assertLess(time.monotonic() - start_time, 1.5)
+
+    def test_no_deadline(self):
+        func = lambda: None
+        self.assertIs(self.db.with_current_deadline(func), func)
+
+    def test_parallel_insert_is_cancelled(self):
+        etl = ETLManager(self.db)
+        with mock.patch.object(etl, 'stage_analytical_table', side_effect=self.slow_query), \
+                mock.patch.object(etl, 'drop_load_tables') as drop_load_tables, \
+                mock.patch.object(etl, 'publish_analytical_tables') as publish:
+            with self.assertRaisesRegex(sqlite3.OperationalError, 'interrupted'):
+                self.db.with_deadline(etl._insert_parallel, 0.2)()
+        drop_load_tables.assert_called_once()
+        publish.assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,228 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+from async_execution import StatementController
+from instrumentation import InstrumentedCursor, StatementRecorder
+from local_backend import LocalConnectionManager
+from settings import get_settings
+
+logging.basicConfig(level=logging.INFO)
+
+class ConnectionManager():
+    """
+    Thread-safe pool of Redshift connections shared by every manager class.
+
+    Connections are opened with TCP keepalives so long COPY statements are
+    not cut off by idle network devices, retried with exponential backoff
+    while the cluster is still coming up, health checked before they are
+    handed out after sitting idle, and given a per-statement timeout.
+
+    ...
+
+    Attributes
+    ----------
+    minconn : int
+        connections opened up front
+    maxconn : int
+        upper bound on connections borrowed at the same time; further
+        borrowers wait for a connection to be returned
+    statement_timeout : int
+        statement timeout in milliseconds (0 disables it)
+    poll_interval : float
+        seconds between progress reports and deadline checks of running
+        statements (0 disables the StatementController)
+    recorder : StatementRecorder
+        receives timing, rowcount and query id of every statement run
+        through connection()
+    """
+    needs_cluster = True
+
+    def __init__(self, config_path='dwh.cfg', **overrides):
+        settings = get_settings(config_path)
+
+        self.connect_kwargs = {
+            'host':                 settings.DWH_HOST,
+            'dbname':               settings.DWH_DB,
+            'user':                 settings.DWH_DB_USER,
+            'password':             settings.DWH_DB_PASSWORD,
+            'port':                 settings.DWH_PORT,
+            'connect_timeout':      settings.CONNECT_TIMEOUT,
+            'keepalives':           1,
+            'keepalives_idle':      settings.KEEPALIVES_IDLE,
+            'keepalives_interval':  settings.KEEPALIVES_INTERVAL,
+            'keepalives_count':     settings.KEEPALIVES_COUNT,
+        }
+        self.minconn            = settings.POOL_MIN
+        self.maxconn            = settings.POOL_MAX
+        self.connect_retries    = settings.CONNECT_RETRIES
+        self.retry_backoff      = settings.RETRY_BACKOFF
+        self.statement_timeout  = settings.STATEMENT_TIMEOUT
+        self.health_check_after = settings.HEALTH_CHECK_AFTER
+        self.poll_interval      = settings.POLL_INTERVAL
+
+        self.recorder           = StatementRecorder.from_config(settings.config)
+
+        for key, value in overrides.items():
+            if key in self.connect_kwargs:
+                self.connect_kwargs[key] = value
+            else:
+                setattr(self, key, value)
+
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool raises PoolError when it is exhausted, so
+        # borrowers queue here instead when more threads than POOL_MAX
+        # (MAX_PARALLELISM, parallel inserts) want a connection at once.
+        self._available = threading.BoundedSemaphore(self.maxconn)
+        self._last_used = {}
+        self.controller = None
+        if self.poll_interval:
+            self.controller = StatementController(
+                lambda: psycopg2.connect(**self.connect_kwargs), self.poll_interval)
+            self.controller.install()
+        self.pool = self._retry(lambda: ThreadedConnectionPool(
+            self.minconn, self.maxconn, **self.connect_kwargs))
+        logging.info("Connected to Redshift.")
+
+    def _retry(self, connect):
+        """
+        Runs `connect`, retrying OperationalErrors with exponential backoff.
+        """
+        delay = 1.0
+        for attempt in range(1, self.connect_retries + 1):
+            try:
+                return connect()
+            except psycopg2.OperationalError as e:
+                if attempt == self.connect_retries:
+                    raise
+                logging.warning(f"Could not connect to Redshift (attempt {attempt}). "
+                                f"Retrying in {delay:.0f}s. Error: {e}")
+                time.sleep(delay)
+                delay *= self.retry_backoff
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        with self._lock:
+            last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.time() - last_used < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """
+        Borrows a healthy connection from the pool, waiting while all
+        maxconn are borrowed. Broken connections are discarded and replaced.
+        """
+        self._available.acquire()
+        try:
+            return self._getconn()
+        except BaseException:
+            self._available.release()
+            raise
+
+    def _getconn(self):
+        for _ in range(self.maxconn + 1):
+            conn = self._retry(self.pool.getconn)
+            if self._is_healthy(conn):
+                break
+            logging.warning("Discarding broken Redshift connection.")
+            self._putconn(conn, close=True)
+        else:
+            raise psycopg2.OperationalError("No healthy connection available.")
+        with self._lock:
+            first_use = id(conn) not in self._last_used
+        if first_use and self.statement_timeout:
+            with conn.cursor() as cur:
+                cur.execute(f"SET statement_timeout TO {int(self.statement_timeout)}")
+            conn.commit()
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Returns a connection to the pool."""
+        try:
+            self._putconn(conn, close)
+        finally:
+            self._available.release()
+
+    def _putconn(self, conn, close=False):
+        with self._lock:
+            if close or conn.closed:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.time()
+        self.pool.putconn(conn, close=close or bool(conn.closed))
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection and cursor for the duration of a with block.
+        Uncommitted work is rolled back if the block raises.
+        """
+        conn = self.getconn()
+        cur = InstrumentedCursor(conn.cursor(), self.recorder)
+        try:
+            yield conn, cur
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.putconn(conn)
+
+    def with_deadline(self, func, seconds):
+        """
+        Wraps `func` so that statements it runs are cancelled once `seconds`
+        have passed. Returns `func` unchanged if there is no deadline.
+        """
+        if not seconds or self.controller is None:
+            return func
+        def run_with_deadline():
+            with self.controller.deadline(seconds):
+                return func()
+        return run_with_deadline
+
+    def with_current_deadline(self, func):
+        """
+        Wraps `func` so that, run on a worker thread, its statements are
+        cancelled at the deadline of the calling thread. Returns `func`
+        unchanged if the calling thread has no deadline.
+        """
+        deadline = self.controller.current_deadline() if self.controller else None
+        if deadline is None:
+            return func
+        def run_with_deadline():
+            with self.controller.deadline_at(deadline):
+                return func()
+        return run_with_deadline
+
+    def close(self):
+        """Closes every connection in the pool and writes the metrics file."""
+        self.recorder.write_prometheus()
+        self.pool.closeall()
+        if self.controller is not None:
+            self.controller.close()
+            self.controller.uninstall()
+        logging.info("Redshift connection closed.")
+
+
+BACKENDS = {'redshift': ConnectionManager, 'local': LocalConnectionManager}
+
+def backend_from_config(config_path='dwh.cfg'):
+    """
+    Returns the connection manager class selected by [ETL] BACKEND:
+    'redshift' (default) or 'local' for the in-process SQLite backend.
+    """
+    backend = get_settings(config_path).BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    return BACKENDS[backend]
@@ -0,0 +1,146 @@
+from db_connection import ConnectionManager
+from unittest import mock
+import os
+import psycopg2
+import threading
+import unittest
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dwh_template.cfg')
+
+class FakeCursor():
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, query, vars=None):
+        if self.conn.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        self.conn.statements.append(query)
+
+    def close(self):
+        pass
+
+
+class FakeConnection():
+
+    def __init__(self, broken=False, closed=0):
+        self.broken = broken
+        self.closed = closed
+        self.statements = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakePool():
+    """Stands in for ThreadedConnectionPool, handing out `conns` in order."""
+
+    def __init__(self, minconn, maxconn, conns=None, **connect_kwargs):
+        self.conns = list(conns or [])
+        self.returned = []
+
+    def getconn(self):
+        return self.conns.pop(0) if self.conns else FakeConnection()
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+        if not close:
+            self.conns.append(conn)
+
+
+class ConnectionManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('db_connection.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def manager(self, pool=None, **overrides):
+        pool = pool or FakePool(1, 2)
+        overrides = dict({'poll_interval': 0, 'maxconn': 2}, **overrides)
+        with mock.patch('db_connection.ThreadedConnectionPool', return_value=pool):
+            return ConnectionManager(TEMPLATE, **overrides)
+
+    def test_connect_is_retried_with_backoff(self):
+        error = psycopg2.OperationalError('the database system is starting up')
+        pool = FakePool(1, 2)
+        with mock.patch('db_connection.ThreadedConnectionPool', side_effect=[error, error, pool]):
+            db = ConnectionManager(TEMPLATE, poll_interval=0, connect_retries=3, retry_backoff=2)
+        self.assertIs(db.pool, pool)
+        self.assertEqual([call.args[0] for call in self.sleep.call_args_list], [1.0, 2.0])
+
+    def test_connect_gives_up(self):
+        error = psycopg2.OperationalError('could not connect to server')
+        with mock.patch('db_connection.ThreadedConnectionPool', side_effect=error) as pool:
+            with self.assertRaises(psycopg2.OperationalError):
+                ConnectionManager(TEMPLATE, poll_interval=0, connect_retries=3)
+        self.assertEqual(pool.call_count, 3)
+
+    def test_borrowers_wait_for_a_free_connection(self):
+        db = self.manager()
+        first, second = db.getconn(), db.getconn()
+        borrowed = []
+        waiter = threading.Thread(target=lambda: borrowed.append(db.getconn()))
+        waiter.start()
+        waiter.join(0.2)
+        self.assertEqual(borrowed, [])
+        db.putconn(first)
+        waiter.join(5)
+        self.assertEqual(borrowed, [first])
+        db.putconn(second)
+        db.putconn(first)
+
+    def test_broken_connections_are_replaced(self):
+        closed, broken, healthy = FakeConnection(closed=1), FakeConnection(broken=True), FakeConnection()
+        pool = FakePool(1, 2, conns=[closed, broken, healthy])
+        db = self.manager(pool)
+        self.assertIs(db.getconn(), healthy)
+        self.assertEqual(pool.returned, [(closed, True), (broken, True)])
+        # Checked with SELECT 1 as it had never been used.
+        self.assertEqual(healthy.statements, ['SELECT 1'])
+
+    def test_recently_used_connections_are_not_checked(self):
+        conn = FakeConnection()
+        db = self.manager(FakePool(1, 2, conns=[conn]), health_check_after=60)
+        db.putconn(db.getconn())
+        conn.statements.clear()
+        self.assertIs(db.getconn(), conn)
+        self.assertEqual(conn.statements, [])
+
+    def test_statement_timeout_is_set_once(self):
+        conn = FakeConnection()
+        db = self.manager(FakePool(1, 2, conns=[conn]), statement_timeout=60000,
+                          health_check_after=60)
+        db.putconn(db.getconn())
+        db.putconn(db.getconn())
+        self.assertEqual(conn.statements, ['SELECT 1', 'SET statement_timeout TO 60000'])
+
+    def test_connection_rolls_back_and_returns(self):
+        conn = FakeConnection()
+        pool = FakePool(1, 2, conns=[conn])
+        db = self.manager(pool)
+        with self.assertRaises(ValueError):
+            with db.connection() as (conn, cur):
+                raise ValueError('bad row')
+        # One after the health check, one for the failed block.
+        self.assertEqual(conn.rollbacks, 2)
+        self.assertEqual(pool.returned, [(conn, False)])
+        # The semaphore was released: both connections can be borrowed again.
+        for conn in (db.getconn(), db.getconn()):
+            db.putconn(conn)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import re
+
+# Redshift-only table attributes. PostgreSQL has no notion of distribution
+# or sort keys, and Redshift does not enforce primary keys, so they are
+# dropped rather than emulated.
+_TABLE_ATTRIBUTES = re.compile(
+    r'\b(diststyle\s+(auto|even|all|key)|distkey\s*\(\s*\w+\s*\)|'
+    r'(compound\s+|interleaved\s+)?sortkey\s*\([^)]*\))', re.I)
+_PRIMARY_KEY = re.compile(r',\s*primary\s+key\s*\([^)]*\)', re.I)
+_IDENTITY = re.compile(r'\bBIGINT\s+IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\)', re.I)
+_WEEKDAY = re.compile(r'\bEXTRACT\s*\(\s*weekday\s+FROM', re.I)
+_COPY = re.compile(r"^\s*COPY\s+(\w+)\s+FROM\s+'([^']+)'", re.I)
+_COPY_JSON = re.compile(r"\bJSON\s+'([^']+)'", re.I)
+_JSONPATH = re.compile(r"^\$(?:\['([^']+)'\]|\.(\w+))$")
+
+# Redshift built-ins used by sql_queries that PostgreSQL lacks. The values
+# differ from Redshift's, which is fine as long as both sides of a join are
+# computed by the same database.
+postgres_functions = [("""
+    CREATE OR REPLACE FUNCTION fnv_hash(value TEXT) RETURNS BIGINT AS $$
+        SELECT ('x' || SUBSTR(MD5(value), 1, 16))::BIT(64)::BIGINT
+    $$ LANGUAGE SQL IMMUTABLE STRICT
+""")]
+
+def to_postgres(query):
+    """
+    Translates a statement from sql_queries into PostgreSQL:
+    - DISTSTYLE/DISTKEY/SORTKEY attributes are removed
+    - primary keys are removed, since Redshift treats them as informational
+    - BIGINT IDENTITY(seed, step) becomes BIGSERIAL, so that
+      CREATE TABLE ... (LIKE ... INCLUDING DEFAULTS) keeps generating ids
+    - EXTRACT(weekday ...) becomes EXTRACT(dow ...)
+    COPY statements are not translated: parse them with parse_copy and
+    load the files they name (see benchmark.run_json_copy).
+    Run postgres_functions once per database for FNV_HASH.
+    """
+    query = _TABLE_ATTRIBUTES.sub('', query)
+    query = _PRIMARY_KEY.sub('', query)
+    query = _IDENTITY.sub('BIGSERIAL', query)
+    query = _WEEKDAY.sub('EXTRACT(dow FROM', query)
+    return query
+
+def parse_copy(query):
+    """
+    Splits a COPY ... FROM 's3://...' [JSON '...'] statement from
+    sql_queries into (table, source url, JSONPaths url). The JSONPaths
+    url is None for JSON 'auto'. Returns None for other statements.
+    """
+    match = _COPY.match(query)
+    if not match:
+        return None
+    json_format = _COPY_JSON.search(query)
+    jsonpaths = json_format.group(1) if json_format else None
+    if jsonpaths and jsonpaths.lower() == 'auto':
+        jsonpaths = None
+    return match.group(1), match.group(2), jsonpaths
+
+def jsonpath_fields(document):
+    """
+    Returns the record fields a JSONPaths document ({'jsonpaths': [...]})
+    maps to the table columns, in column order.
+    """
+    return [next(part for part in _JSONPATH.match(path).groups() if part)
+            for path in document['jsonpaths']]
+
+_LIKE_TABLE = re.compile(r'\bCREATE\s+(TEMP\s+|TEMPORARY\s+)?TABLE\s+(\w+)\s*\(\s*LIKE\s+(\w+)'
+                         r'(?:\s+INCLUDING\s+DEFAULTS)?\s*\)', re.I)
+_IDENTITY_COLUMN = re.compile(r'\bBIGINT\s+IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\)(\s+NOT\s+NULL)?', re.I)
+_EPOCH_EXTRACT = re.compile(r"\bEXTRACT\s*\(\s*(\w+)\s+FROM\s+timestamp\s+'epoch'\s*\+\s*(.+?)"
+                            r"\s*\*\s*interval\s+'1 second'\s*\)", re.I)
+_DELETE_USING = re.compile(r'\bDELETE\s+FROM\s+(\w+)\s+USING\s+(\w+(?:\s+(?!WHERE\b)\w+)?)\s+WHERE\s+(.*)',
+                           re.I | re.S)
+_INSERT_INTO = re.compile(r'\bINSERT\s+INTO\s+\w+\s*', re.I)
+_STRFTIME = {'hour': '%H', 'day': '%d', 'month': '%m', 'year': '%Y', 'weekday': '%w', 'dow': '%w'}
+
+def _epoch_part(match):
+    part, seconds = match.group(1).lower(), match.group(2)
+    if part == 'week':
+        # ISO week: the week of the year that holds the Thursday of this week
+        return (f"CAST((CAST(strftime('%j', date({seconds}, 'unixepoch', '-3 days', "
+                f"'weekday 4')) AS INTEGER) - 1) / 7 + 1 AS INTEGER)")
+    return f"CAST(strftime('{_STRFTIME[part]}', {seconds}, 'unixepoch') AS INTEGER)"
+
+def _closing_paren(query, start):
+    depth = 0
+    for position in range(start, len(query)):
+        if query[position] == '(':
+            depth += 1
+        elif query[position] == ')':
+            depth -= 1
+            if depth == 0:
+                return position
+    raise ValueError(f"Unbalanced parentheses in: {query}")
+
+def _unwrap_insert_select(query):
+    """INSERT INTO t [(columns)] (SELECT ...) -> INSERT INTO t [(columns)] SELECT ..."""
+    match = _INSERT_INTO.search(query)
+    if not match:
+        return query
+    position = match.end()
+    for _ in range(2):
+        if position >= len(query) or query[position] != '(':
+            return query
+        end = _closing_paren(query, position)
+        inner = query[position + 1:end]
+        if inner.lstrip()[:6].upper() == 'SELECT':
+            return query[:position] + inner + query[end + 1:]
+        position = end + 1
+        while position < len(query) and query[position].isspace():
+            position += 1
+    return query
+
+def to_sqlite(query):
+    """
+    Translates a statement from sql_queries into SQLite:
+    - table attributes and primary keys are removed as for PostgreSQL, and
+      BIGINT IDENTITY becomes an INTEGER PRIMARY KEY (SQLite's rowid)
+    - CREATE TABLE a (LIKE b) becomes CREATE TABLE a AS SELECT from b
+    - EXTRACT(part FROM timestamp 'epoch' + ...) becomes strftime()
+    - DELETE FROM a USING b WHERE ... becomes a delete of the joined rowids
+    - INSERT INTO a (SELECT ...) loses the parentheses SQLite rejects
+    COPY, CREATE PROCEDURE and CALL are run by local_backend instead.
+    FNV_HASH and MD5 are registered on the connection by local_backend.
+    """
+    query = _TABLE_ATTRIBUTES.sub('', query)
+    query = _PRIMARY_KEY.sub('', query)
+    query = _IDENTITY_COLUMN.sub('INTEGER PRIMARY KEY', query)
+    query = _LIKE_TABLE.sub(lambda m: f"CREATE {m.group(1) or ''}TABLE {m.group(2)} AS "
+                                      f"SELECT * FROM {m.group(3)} WHERE 0", query)
+    query = _EPOCH_EXTRACT.sub(_epoch_part, query)
+    query = _DELETE_USING.sub(lambda m: f"DELETE FROM {m.group(1)} WHERE rowid IN "
+                                        f"(SELECT {m.group(1)}.rowid FROM {m.group(1)}, {m.group(2)} "
+                                        f"WHERE {m.group(3).rstrip().rstrip(';')})", query)
+    return _unwrap_insert_select(query)
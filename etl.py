@@ -1,44 +1,130 @@
-import psycopg2
+import argparse
 import logging
-import configparser
 from infrastructure import InfrastructureManager
 from redshift import RedshiftManager
 from data_manager import ETLManager
+from db_connection import backend_from_config
+from scheduler import StepScheduler
+from run_state import RunStateStore
+from settings import settings
 
 logging.basicConfig(level=logging.INFO)
 
-def open_db_connection():
+def build_pipeline(redshift, etl, max_parallelism, run_state=None):
     """
-    Creates a connection to Redshift based on params in the config file.
+    Declares the table setup, staging, transform and test steps together
+    with their dependencies.
+
+    ...
+
+    Attributes
+    ----------
+    redshift : RedshiftManager
+        used for the table creation steps
+    etl : ETLManager
+        used for the load, transform and test steps
+    max_parallelism : int
+        maximum number of steps running at the same time
+    run_state : RunStateStore
+        started store the steps are checkpointed in (optional)
+
+    Per-step deadlines in seconds are read from the [DEADLINES] section of
+    dwh.cfg, with `default` applying to every step not listed.
     """
-    config = configparser.ConfigParser()
-    config.read_file(open('dwh.cfg'))
-
-    DWH_HOST            = config.get('CLUSTER', 'DWH_HOST')
-    DWH_DB              = config.get('CLUSTER', 'DWH_DB')  
-    DWH_DB_USER         = config.get('CLUSTER', 'DWH_DB_USER')
-    DWH_DB_PASSWORD     = config.get('CLUSTER', 'DWH_DB_PASSWORD')
-    DWH_PORT            = config.get('CLUSTER', 'DWH_PORT')
-    
-    try:
-        conn = psycopg2.connect(f"""
-            host={DWH_HOST} dbname={DWH_DB} user={DWH_DB_USER} 
-            password={DWH_DB_PASSWORD} port={DWH_PORT}
-            """)
-        cur = conn.cursor()
-        logging.info("Connected to Redshift.")
-        return conn, cur
-    except Exception as e:
-        logging.warning(f"Could not connect to Redshift. Error: {e}")
-        
-def close_db_connection(conn):
+    pipeline = StepScheduler(max_parallelism, run_state)
+    deadlines = etl.STEP_DEADLINES
+
+    def add(name, func, depends_on=None):
+        # Statements of a step still running after its deadline are cancelled.
+        seconds = deadlines.get(name, deadlines.get('default'))
+        pipeline.add(name, etl.db.with_deadline(func, seconds), depends_on)
+
+    add('create_staging_tables', redshift.create_staging_tables)
+    add('create_analytical_tables', redshift.create_analytical_tables)
+    add('copy_staging_events', etl.copy_staging_events, ['create_staging_tables'])
+    add('copy_staging_songs', etl.copy_staging_songs, ['create_staging_tables'])
+
+    sources = {'users': 'copy_staging_events', 'time': 'copy_staging_events',
+               'songs': 'copy_staging_songs', 'artists': 'copy_staging_songs'}
+    if etl.INSERT_MODE == 'atomic':
+        # All four inserts in one transaction, after both staging tables.
+        add('insert_analytical_data', lambda: etl.insert_analytical_data('atomic'),
+            ['create_analytical_tables', 'copy_staging_events', 'copy_staging_songs'])
+        dimensions_loaded = ['insert_analytical_data']
+    elif etl.INSERT_MODE == 'upsert':
+        # Each dimension is merged in place; there is nothing to publish.
+        for table, source in sources.items():
+            add(f'upsert_{table}',
+                lambda table=table: etl.upsert_analytical_table(table),
+                ['create_analytical_tables', source])
+        dimensions_loaded = [f'upsert_{table}' for table in sources]
+    elif etl.INSERT_MODE == 'parallel':
+        for table, source in sources.items():
+            add(f'stage_{table}',
+                lambda table=table: etl.stage_analytical_table(table),
+                ['create_analytical_tables', source])
+        add('publish_analytical_tables', etl.publish_analytical_tables,
+            [f'stage_{table}' for table in sources])
+        dimensions_loaded = ['publish_analytical_tables']
+    else:
+        raise ValueError(f"Unknown insert mode: {etl.INSERT_MODE}")
+    add('update_song_lookup', etl.update_song_lookup,
+        ['create_analytical_tables', 'copy_staging_songs'])
+    add('upsert_songplay_data', etl.upsert_songplay_data,
+        ['create_analytical_tables', 'copy_staging_events', 'update_song_lookup'])
+
+    add('get_total_users', etl.get_total_users, dimensions_loaded)
+    add('get_total_songs', etl.get_total_songs, dimensions_loaded)
+    add('get_popular_songs', etl.get_popular_songs, ['upsert_songplay_data'])
+    add('get_top_users', etl.get_top_users, ['upsert_songplay_data'])
+    return pipeline
+
+def copy_seconds(recorder):
+    """
+    Wall-clock time from the start of the first staging COPY recorded so
+    far to the end of the last one. The events and songs COPYs run at the
+    same time, so the sum of their durations would overstate the load.
+    """
+    spans = [(totals['first_start'], totals['last_end'])
+             for (statement, _), totals in recorder.totals.items()
+             if statement.startswith('staging_') and '_copy' in statement]
+    if not spans:
+        return 0.0
+    return max(end for _, end in spans) - min(start for start, _ in spans)
+
+def warm_start(infrastructure, etl):
+    """
+    Lines the load state up with the cluster. A cluster restored from a
+    snapshot already holds everything loaded before, so an incremental
+    load only copies the new objects. A cluster created empty has to load
+    the full history again, so the load state is reset.
     """
-    Closes Redshift connection.
+    if infrastructure.restored_snapshot:
+        logging.info(f'Warm start from snapshot {infrastructure.restored_snapshot}.')
+        if not etl.INCREMENTAL or etl.INSERT_MODE != 'upsert':
+            logging.warning('Warm start without incremental = true and insert_mode = upsert '
+                            'reloads the full history from S3.')
+    elif infrastructure.created_empty and etl.INCREMENTAL:
+        logging.info('Cluster was created empty. Loading the full history.')
+        etl.load_state.reset()
+
+def run_inputs(pipeline):
+    """
+    Settings and step graph a run depends on. A failed run is only resumed
+    by a run with the same inputs.
     """
-    conn.close()
-    logging.info("Redshift connection closed.")
+    return {
+        'backend': settings.BACKEND,
+        'log_data': settings.LOG_DATA,
+        'song_data': settings.SONG_DATA,
+        'incremental': settings.INCREMENTAL,
+        'insert_mode': settings.INSERT_MODE,
+        'copy_profile': settings.COPY_PROFILE,
+        'compact_songs': settings.COMPACT_SONGS,
+        'steps': {name: step.depends_on for name, step in pipeline.steps.items()},
+    }
 
-def main(destroy):
+def main(destroy, from_step=None, only_steps=None):
     """
     Imports 3 helper classes which do the heavy lifting
     1. InfrastructureManager for creating and tearing down infrastructure.
@@ -54,6 +140,13 @@ def main(destroy):
     ----------
     destroy : boolean
         if set to true then all the infrastructure will be deleted at the end of the ETL
+    from_step : str
+        rerun this step and every step downstream of it
+    only_steps : list
+        run only these steps
+
+    Every step is checkpointed in the run state file. If the previous run
+    failed, this run resumes it at its first incomplete step.
     """
     
     logging.info('Starting job.')
@@ -61,75 +154,90 @@ def main(destroy):
         logging.info('Destroy setting is activated. \
             Infrastructure will be destroyed at the end.')
     
-    # Create infrastructure
-    infrastructure = InfrastructureManager()
-    logging.info('Starting infrastructure creation...')
-    infrastructure.create_role()
-    infrastructure.attach_policy_to_role()
-    infrastructure.create_redshift_cluster()
-    infrastructure.open_incoming_tcp_port()
-    infrastructure.update_config_file()
-    logging.info('Finished infrastructure creation!')
-    
-    # Create database connection
-    conn, cur = open_db_connection()
-    
-    # Setup Redshift tables
-    redshift = RedshiftManager(conn, cur)
-    logging.info('Creating Redshift tables...')
-    redshift.create_staging_tables()
-    redshift.create_analytical_tables()
-    logging.info('Staging tables created!')
+    # Create infrastructure. The local backend runs on SQLite and needs none.
+    backend = backend_from_config()
+    if backend.needs_cluster:
+        infrastructure = InfrastructureManager()
+        if settings.SIZING_MODE != 'fixed':
+            infrastructure.size_for_load()
+        logging.info('Starting infrastructure creation...')
+        infrastructure.provision()
+        infrastructure.scale_for_load()
+        logging.info('Finished infrastructure creation!')
     
-    # Retrieve data from S3 and store in Refshift staging
-    etl = ETLManager(conn, cur)
-    logging.info('Retrieving data from S3 into Redshift staging tables...')
-    etl.copy_staging_events()
-    etl.copy_staging_songs()
-    logging.info('Finished retrieving S3 data. Staging tables are ready!')
+    # Create database connection pool
+    db = backend()
     
-    # Create analytical tables
-    logging.info('Creating analytical tables...')
-    etl.insert_analytical_data()
-    etl.upsert_songplay_data()
+    # Setup Redshift tables, load staging data and build the analytical
+    # tables. Independent steps run concurrently on their own connections.
+    redshift = RedshiftManager(db)
+    etl = ETLManager(db)
+    if backend.needs_cluster:
+        # Auto sizing may have picked another size than dwh.cfg holds.
+        etl.slices = infrastructure.slices
+        warm_start(infrastructure, etl)
+    run_state = RunStateStore(settings.RUN_STATE_FILE)
+    pipeline = build_pipeline(redshift, etl, etl.MAX_PARALLELISM, run_state)
+    # A cluster created or restored by this run has none of the work of a
+    # failed earlier run, so there is nothing to resume.
+    new_cluster = backend.needs_cluster and bool(
+        infrastructure.created_empty or infrastructure.restored_snapshot)
+    run_state.start(run_inputs(pipeline), resume=not new_cluster,
+                    reopen=bool(from_step or only_steps))
+    etl.load_reporter.run_id = run_state.run['run_id']
+    results = pipeline.run(from_step, only_steps)
     logging.info('Analytical tables have been created!')
+    if backend.needs_cluster and settings.SIZING_MODE != 'fixed':
+        infrastructure.record_load(copy_seconds(db.recorder), etl.copied)
+        if not destroy:
+            infrastructure.scale_back()
     
     # Test data
     logging.info('Running some tests...')
     logging.info('Total users:')
-    logging.info(etl.get_total_users())
+    logging.info(results['get_total_users'])
     logging.info('Total songs:')
-    logging.info(etl.get_total_songs())
+    logging.info(results['get_total_songs'])
     logging.info('Most popular songs:')
-    logging.info(etl.get_popular_songs())
+    logging.info(results['get_popular_songs'])
     logging.info('Most active users:')
-    logging.info(etl.get_top_users())
+    logging.info(results['get_top_users'])
+    if etl.result_cache is not None:
+        logging.info(f'Read cache: {etl.cache_stats()}')
     
     # Destroy everything if required
     if destroy:
-        # Drop Redshift tables
+        # Drop Redshift tables. With a warm start the analytical tables are
+        # kept for the final snapshot the next run restores from.
         logging.info('Dropping Redshift tables...')
-        redshift.drop_analytical_tables()
+        if not (backend.needs_cluster and settings.WARM_START):
+            redshift.drop_analytical_tables()
         redshift.drop_staging_tables()
         logging.info('Redshift tables droppped!')
             
         # Teardown infrastructure
-        logging.info('Starting infrastructure teardown...')
-        infrastructure.drop_redshift()
-        infrastructure.drop_role_policy()
-        infrastructure.drop_role()
-        infrastructure.reset_config_file()
-        logging.info('Finished infrustructure teardown!')
+        if backend.needs_cluster:
+            logging.info('Starting infrastructure teardown...')
+            infrastructure.teardown()
+            logging.info('Finished infrustructure teardown!')
     
-    # Close database connection
-    close_db_connection(conn)
+    # Close database connections
+    db.close()
     
     logging.info('Job complete.')
 
 if __name__ == "__main__":
     """
-    Set destroy = True so that all infrastructure is removed
-    at the end of the ETL.
+    All infrastructure is removed at the end of the ETL unless
+    --keep-infrastructure is passed.
     """
-    destroy=True
-    main(destroy)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the Sparkify ETL job.")
+    parser.add_argument('--keep-infrastructure', action='store_true',
+                        help="keep the cluster and tables at the end of the job")
+    parser.add_argument('--from-step',
+                        help="rerun this step and every step downstream of it")
+    parser.add_argument('--only-step', action='append', dest='only_steps',
+                        help="run only this step (can be repeated)")
+    args = parser.parse_args()
+    main(destroy=not args.keep_infrastructure, from_step=args.from_step,
+         only_steps=args.only_steps)
@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+from etl import copy_seconds, warm_start
+from instrumentation import StatementRecorder
+
+class CopySecondsTest(unittest.TestCase):
+
+    def test_concurrent_copies_count_once(self):
+        recorder = StatementRecorder()
+        # Both COPYs finish now, so they ran side by side for 2 and 3 seconds.
+        recorder.record('staging_events_copy', 2.0, 100)
+        recorder.record('staging_songs_copy_manifest', 3.0, 100)
+        recorder.record('song_lookup_insert', 30.0, 100)
+        self.assertAlmostEqual(copy_seconds(recorder), 3.0, places=1)
+
+    def test_no_copies(self):
+        recorder = StatementRecorder()
+        recorder.record('staging_events_truncate', 1.0, 0)
+        self.assertEqual(copy_seconds(recorder), 0.0)
+
+
+class WarmStartTest(unittest.TestCase):
+
+    def etl(self, incremental=True, insert_mode='upsert'):
+        return mock.Mock(INCREMENTAL=incremental, INSERT_MODE=insert_mode)
+
+    def test_restored_cluster_keeps_the_load_state(self):
+        infrastructure = mock.Mock(restored_snapshot='sparkify-final-20260101-000000',
+                                   created_empty=False)
+        etl = self.etl()
+        warm_start(infrastructure, etl)
+        etl.load_state.reset.assert_not_called()
+
+    def test_restore_without_upsert_warns(self):
+        infrastructure = mock.Mock(restored_snapshot='sparkify-final-20260101-000000',
+                                   created_empty=False)
+        with self.assertLogs(level='WARNING'):
+            warm_start(infrastructure, self.etl(insert_mode='parallel'))
+
+    def test_empty_cluster_reloads_the_full_history(self):
+        infrastructure = mock.Mock(restored_snapshot=None, created_empty=True)
+        etl = self.etl()
+        warm_start(infrastructure, etl)
+        etl.load_state.reset.assert_called_once()
+        etl = self.etl(incremental=False)
+        warm_start(infrastructure, etl)
+        etl.load_state.reset.assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
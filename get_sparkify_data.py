@@ -2,90 +2,342 @@
 # Download S3 files to sparkify folder
 # Print the downloaded files
 
-import configparser
-import boto3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import json
 import os
+import queue
+import threading
+import time
+import aws_clients
 
-config = configparser.ConfigParser()
-config.read_file(open('dwh.cfg'))
 
-KEY             = config.get('AWS', 'KEY')
-SECRET          = config.get('AWS', 'SECRET')
-REGION          = config.get('AWS', 'REGION')
-LOG_DATA        = config.get('S3', 'LOG_DATA')
-LOG_JSONPATH    = config.get('S3', 'LOG_JSONPATH')
-SONG_DATA       = config.get('S3', 'SONG_DATA')
+class S3Loader:
+    """
+    Helper class for listing and downloading the Sparkify S3 data.
 
+    ...
 
-class S3Loader:
-    def __init__(self):
-        self.s3_client = boto3.client('s3',
-                                 region_name=REGION,
-                                 aws_access_key_id=KEY,
-                                 aws_secret_access_key=SECRET)
-
-        self.s3_resource = boto3.resource('s3',
-                                 region_name=REGION,
-                                 aws_access_key_id=KEY,
-                                 aws_secret_access_key=SECRET)
-    
-    def list_s3_objects(self, bucket):
-        object_list = self.s3_client.list_objects_v2(Bucket=bucket)
-        for obj in object_list['Contents']:
+    Attributes
+    ----------
+    s3_client : boto3 S3 client
+        shared, thread-safe client used by every download worker
+    max_workers : int
+        number of download threads (1 means sequential downloads)
+    """
+    def __init__(self, s3_client=None, max_workers=16):
+        self.max_workers = max_workers
+        if s3_client is None:
+            # One client for all workers. The connection pool must be at
+            # least as large as the thread pool or workers queue on sockets.
+            s3_client = aws_clients.client('s3', max_pool_connections=max(10, max_workers))
+        self.s3_client = s3_client
+        from boto3.s3.transfer import TransferConfig
+        self.transfer_config = TransferConfig(use_threads=False)
+
+    def list_s3_objects(self, bucket, prefix=''):
+        for obj in self.iter_s3_objects(bucket, prefix):
             print(obj['Key'])
-            
-    def count_s3_objects(self, bucket):
-        bucket = self.s3_resource.Bucket(bucket)
-        count_obj = 0
-        for i in bucket.objects.all():
-            count_obj = count_obj + 1
-        return count_obj
 
-    def download_all_files(self, bucket, local):
+    def count_s3_objects(self, bucket, prefix=''):
+        return sum(1 for _ in self.iter_s3_objects(bucket, prefix))
+
+    def iter_s3_objects(self, bucket, prefix='', start_after=None, delimiter=None):
         """
+        Yields object entries (Key, Size, ETag, ...) page by page, so callers
+        can start working before the whole listing has been fetched.
+
         params:
+        - bucket: s3 bucket with target contents
         - prefix: pattern to match in s3
-        - local: local path to folder in which to place files
+        - start_after: only keys that sort after this key are listed
+        - delimiter: when set, only objects directly under the prefix are listed
+        """
+        kwargs = {'Bucket': bucket, 'Prefix': prefix}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        if delimiter:
+            kwargs['Delimiter'] = delimiter
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get('Contents', []):
+                yield obj
+
+    def list_common_prefixes(self, bucket, prefix=''):
+        """
+        Returns the sub-prefixes one level below a prefix, e.g.
+        'song_data/A/' -> ['song_data/A/A/', 'song_data/A/B/', ...].
+        """
+        prefixes = []
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+            prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        return prefixes
+
+    def discover_shards(self, bucket, prefix='', depth=2):
+        """
+        Splits a prefix into listing shards by walking `depth` levels of
+        sub-prefixes. Returns (prefix, shallow) tuples: shallow shards only
+        cover the objects sitting directly in an intermediate level, the
+        deepest prefixes are listed recursively.
+        """
+        shards = []
+        level = [prefix]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for _ in range(depth):
+                shards.extend((p, True) for p in level)
+                children = executor.map(
+                    lambda p: self.list_common_prefixes(bucket, p), level)
+                level = [c for found in children for c in found]
+                if not level:
+                    break
+        shards.extend((p, False) for p in level)
+        return shards
+
+    def iter_s3_objects_sharded(self, bucket, shards, start_after=None, max_workers=None):
+        """
+        Lists several shards concurrently and yields (shard, object) tuples
+        as pages arrive. At most a few pages per worker are buffered.
+
+        params:
+        - bucket: s3 bucket with target contents
+        - shards: (prefix, shallow) tuples from discover_shards
+        - start_after: optional dict of shard prefix -> last key already seen
+        - max_workers: overrides the number of listing threads
+        """
+        workers = max_workers or self.max_workers
+        start_after = start_after or {}
+        pages = queue.Queue(maxsize=workers * 4)
+        done = object()
+        stop = threading.Event()
+
+        def list_shard(shard):
+            prefix, shallow = shard
+            try:
+                for obj in self.iter_s3_objects(bucket, prefix,
+                        start_after=start_after.get(prefix),
+                        delimiter='/' if shallow else None):
+                    if stop.is_set():
+                        return
+                    pages.put((shard, obj))
+            finally:
+                pages.put(done)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(list_shard, shard) for shard in shards]
+            remaining = len(futures)
+            try:
+                while remaining:
+                    item = pages.get()
+                    if item is done:
+                        remaining -= 1
+                        continue
+                    yield item
+            finally:
+                # Unblock workers if the consumer stopped early.
+                stop.set()
+                while remaining:
+                    if pages.get() is done:
+                        remaining -= 1
+            for future in futures:
+                future.result()
+
+    def sync_manifest(self, bucket, prefix='', manifest_path='s3_manifest.json',
+                      depth=2, append_only=False):
+        """
+        Brings a local manifest of key/size/ETag up to date and yields the
+        objects that are new or changed since the previous run.
+
+        With append_only=True each shard is only re-listed from the last key
+        recorded for it, which is correct for prefixes where new keys always
+        sort last (log_data is named by date). Otherwise every shard is
+        re-listed concurrently and keys that disappeared are dropped from
+        the manifest.
+
+        params:
         - bucket: s3 bucket with target contents
+        - prefix: pattern to match in s3
+        - manifest_path: local JSON file holding the manifest
+        - depth: number of sub-prefix levels to fan the listing out over
+        - append_only: only list keys after the last key seen per shard
         """
-        keys = []
-        dirs = []
-        next_token = ''
-        base_kwargs = {
-            'Bucket':bucket,
-        }
-        processed_keys = 0
-        while next_token is not None:
-            kwargs = base_kwargs.copy()
-            if next_token != '':
-                kwargs.update({'ContinuationToken': next_token})
-            results = self.s3_client.list_objects_v2(**kwargs)
-            contents = results.get('Contents')
-            for i in contents:
-                k = i.get('Key')
-                if k[-1] != '/':
-                    keys.append(k)
+        manifest = S3Manifest(manifest_path, bucket, prefix)
+        start_time = time.time()
+        shards = self.discover_shards(bucket, prefix, depth)
+        start_after = manifest.last_keys if append_only else None
+        seen = set()
+        new_objects = 0
+        complete = False
+        try:
+            for (shard_prefix, _), obj in self.iter_s3_objects_sharded(
+                    bucket, shards, start_after=start_after):
+                seen.add(obj['Key'])
+                if manifest.record(shard_prefix, obj):
+                    new_objects += 1
+                    yield obj
+            complete = True
+        finally:
+            if complete and not append_only:
+                manifest.retain(seen)
+            manifest.save()
+        print(f"Listed {len(shards)} shards in {time.time() - start_time:.2f}s. "
+              f"New or changed objects: {new_objects}, "
+              f"total in manifest: {len(manifest.objects)}")
+
+    def download_all_files(self, bucket, local, prefix='', max_workers=None):
+        """
+        Downloads every object under a prefix using a bounded thread pool.
+        Files that already exist locally with a matching size/ETag are
+        skipped, so an interrupted download can simply be re-run.
+
+        params:
+        - bucket: s3 bucket with target contents
+        - local: local path to folder in which to place files
+        - prefix: pattern to match in s3
+        - max_workers: overrides the number of download threads
+
+        Returns a dict with the download statistics.
+        """
+        workers = max_workers or self.max_workers
+        print(f"Starting downloads with {workers} workers...")
+        stats = {'listed': 0, 'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+        start_time = time.time()
+
+        def collect(finished):
+            for future in finished:
+                obj = pending.pop(future)
+                try:
+                    downloaded = future.result()
+                except Exception as e:
+                    print(f"Failed to download {obj['Key']}: {e}")
+                    stats['failed'] += 1
+                    continue
+                if downloaded:
+                    stats['downloaded'] += 1
+                    stats['bytes'] += obj.get('Size', 0)
                 else:
-                    dirs.append(k)
-            processed_keys += len(contents)
-            print(f"Processed keys: {processed_keys}")
-            next_token = results.get('NextContinuationToken')
-        total_directories = len(dirs)
-        total_keys = len(keys)
-        print(f"Total directories found: {total_directories}")
-        print(f"Total keys found: {total_keys}")
-        print("Starting processing directories...")
-        for d in dirs:
-            dest_pathname = os.path.join(local, d)
-            if not os.path.exists(os.path.dirname(dest_pathname)):
-                os.makedirs(os.path.dirname(dest_pathname))
-        print("Starting processing keys...")
-        for k in keys:
-            dest_pathname = os.path.join(local, k)
-            if not os.path.exists(os.path.dirname(dest_pathname)):
-                os.makedirs(os.path.dirname(dest_pathname))
-            self.s3_client.download_file(bucket, k, dest_pathname)      
+                    stats['skipped'] += 1
+
+        # Keys are streamed from the listing straight into the pool; only a
+        # bounded number of downloads is ever in flight.
+        pending = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for obj in self.iter_s3_objects(bucket, prefix):
+                if obj['Key'].endswith('/'):
+                    continue
+                stats['listed'] += 1
+                if stats['listed'] % 1000 == 0:
+                    print(f"Processed keys: {stats['listed']}")
+                pending[executor.submit(self.download_file, bucket, obj, local)] = obj
+                if len(pending) >= workers * 4:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+            collect(list(pending))
+        stats['seconds'] = time.time() - start_time
+        elapsed = max(stats['seconds'], 1e-9)
+        stats['objects_per_sec'] = stats['downloaded'] / elapsed
+        stats['bytes_per_sec'] = stats['bytes'] / elapsed
+        print(f"Listed: {stats['listed']}, downloaded: {stats['downloaded']}, skipped: {stats['skipped']}, "
+              f"failed: {stats['failed']} in {stats['seconds']:.2f}s "
+              f"({stats['objects_per_sec']:.1f} objects/sec, "
+              f"{stats['bytes_per_sec'] / 1024 / 1024:.2f} MB/sec)")
+        return stats
+
+    def download_file(self, bucket, obj, local):
+        """
+        Downloads a single listed object unless an identical copy is already
+        on disk. Returns True if the file was downloaded.
+
+        params:
+        - bucket: s3 bucket with target contents
+        - obj: entry from list_objects_v2 'Contents' (Key, Size, ETag)
+        - local: local path to folder in which to place files
+        """
+        dest_pathname = os.path.join(local, obj['Key'])
+        if is_local_copy_current(dest_pathname, obj.get('Size'), obj.get('ETag')):
+            return False
+        os.makedirs(os.path.dirname(dest_pathname), exist_ok=True)
+        # download_file writes to a temporary name and renames on success,
+        # so a killed run never leaves a truncated file behind.
+        self.s3_client.download_file(bucket, obj['Key'], dest_pathname,
+                                     Config=self.transfer_config)
+        return True
+
+
+def is_local_copy_current(path, size, etag=None):
+    """
+    Checks whether a local file matches an S3 object by size and, for
+    single-part uploads, by ETag (the MD5 of the content).
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) != size:
+        return False
+    etag = (etag or '').strip('"')
+    if not etag or '-' in etag:
+        # Multipart ETags are not a plain MD5, so size is all we can compare.
+        return True
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest() == etag
+
+
+class S3Manifest:
+    """
+    Local JSON record of the objects listed under a bucket prefix.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        location of the manifest file
+    objects : dict
+        key -> {'size': ..., 'etag': ...}
+    last_keys : dict
+        shard prefix -> highest key listed in that shard
+    """
+    def __init__(self, path, bucket, prefix=''):
+        self.path = path
+        self.bucket = bucket
+        self.prefix = prefix
+        self.clear()
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('bucket') == bucket and data.get('prefix') == prefix:
+                self.objects = data.get('objects', {})
+                self.last_keys = data.get('last_keys', {})
+
+    def clear(self):
+        self.objects = {}
+        self.last_keys = {}
+
+    def record(self, shard_prefix, obj):
+        """
+        Adds a listed object. Returns True if the key is new or its
+        size/ETag changed.
+        """
+        key = obj['Key']
+        if key > self.last_keys.get(shard_prefix, ''):
+            self.last_keys[shard_prefix] = key
+        entry = {'size': obj.get('Size'), 'etag': obj.get('ETag', '').strip('"')}
+        if self.objects.get(key) == entry:
+            return False
+        self.objects[key] = entry
+        return True
+
+    def retain(self, keys):
+        """Drops every object that is not in `keys`."""
+        self.objects = {k: v for k, v in self.objects.items() if k in keys}
 
+    def save(self):
+        """Writes the manifest atomically so a crash never corrupts it."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'bucket': self.bucket, 'prefix': self.prefix,
+                       'last_keys': self.last_keys, 'objects': self.objects}, f)
+        os.replace(tmp_path, self.path)
 
 if __name__ == "__main__":
     s3 = S3Loader()
@@ -0,0 +1,146 @@
+from get_sparkify_data import S3Loader, S3Manifest, is_local_copy_current
+from unittest import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+BUCKET = 'sparkify-src'
+
+class S3TestCase(unittest.TestCase):
+    """Runs each test against a moto bucket and a temporary local folder."""
+
+    def setUp(self):
+        from moto import mock_aws
+        import boto3
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.directory = tempfile.mkdtemp()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket=BUCKET)
+        self.loader = S3Loader(self.s3, max_workers=4)
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        shutil.rmtree(self.directory)
+
+    def put(self, key, body):
+        self.s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+
+    def local(self, key):
+        with open(os.path.join(self.directory, key), 'rb') as f:
+            return f.read()
+
+
+class DownloadTest(S3TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(20):
+            self.put(f'log_data/2018/11/{i:02d}.json', f'{{"ts": {i}}}'.encode())
+        self.put('log_data/2018/', b'')
+
+    def test_download_all_files(self):
+        stats = self.loader.download_all_files(BUCKET, self.directory, 'log_data')
+        self.assertEqual((stats['listed'], stats['downloaded'], stats['skipped'], stats['failed']),
+                         (20, 20, 0, 0))
+        self.assertEqual(self.local('log_data/2018/11/07.json'), b'{"ts": 7}')
+
+    def test_resume_skips_current_files(self):
+        self.loader.download_all_files(BUCKET, self.directory, 'log_data', max_workers=1)
+        # An interrupted run: one file missing, one left from an older upload.
+        os.remove(os.path.join(self.directory, 'log_data/2018/11/03.json'))
+        self.put('log_data/2018/11/04.json', b'{"ts": 40}')
+        stats = self.loader.download_all_files(BUCKET, self.directory, 'log_data')
+        self.assertEqual((stats['downloaded'], stats['skipped']), (2, 18))
+        self.assertEqual(self.local('log_data/2018/11/04.json'), b'{"ts": 40}')
+
+    def test_failed_downloads_are_counted(self):
+        download_file = self.s3.download_file
+        def flaky(bucket, key, *args, **kwargs):
+            if key.endswith('05.json'):
+                raise OSError('connection reset')
+            return download_file(bucket, key, *args, **kwargs)
+        with mock.patch.object(self.s3, 'download_file', side_effect=flaky):
+            stats = self.loader.download_all_files(BUCKET, self.directory, 'log_data')
+        self.assertEqual((stats['downloaded'], stats['failed']), (19, 1))
+        stats = self.loader.download_all_files(BUCKET, self.directory, 'log_data')
+        self.assertEqual((stats['downloaded'], stats['skipped'], stats['failed']), (1, 19, 0))
+
+    def test_is_local_copy_current(self):
+        path = os.path.join(self.directory, 'file.json')
+        with open(path, 'wb') as f:
+            f.write(b'abc')
+        md5 = '900150983cd24fb0d6963f7d28e17f72'
+        self.assertTrue(is_local_copy_current(path, 3, f'"{md5}"'))
+        self.assertFalse(is_local_copy_current(path, 3, '"0' + md5[1:] + '"'))
+        self.assertFalse(is_local_copy_current(path, 4, md5))
+        # Multipart ETags only compare the size.
+        self.assertTrue(is_local_copy_current(path, 3, '"abc-2"'))
+        self.assertFalse(is_local_copy_current(path + '.missing', 3))
+
+
+class ListingTest(S3TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.keys = ['song_data/top.json']
+        for first in 'AB':
+            self.keys.append(f'song_data/{first}/mid.json')
+            for second in 'XYZ':
+                for i in range(3):
+                    self.keys.append(f'song_data/{first}/{second}/{i}.json')
+        for key in self.keys:
+            self.put(key, key.encode())
+        self.manifest_path = os.path.join(self.directory, 's3_manifest.json')
+
+    def sync(self, **kwargs):
+        return [obj['Key'] for obj in self.loader.sync_manifest(
+            BUCKET, 'song_data/', self.manifest_path, **kwargs)]
+
+    def test_discover_shards(self):
+        shards = self.loader.discover_shards(BUCKET, 'song_data/', depth=2)
+        self.assertEqual(sorted(p for p, shallow in shards if shallow),
+                         ['song_data/', 'song_data/A/', 'song_data/B/'])
+        self.assertEqual(sorted(p for p, shallow in shards if not shallow),
+                         [f'song_data/{f}/{s}/' for f in 'AB' for s in 'XYZ'])
+
+    def test_sharded_listing_covers_every_key_once(self):
+        shards = self.loader.discover_shards(BUCKET, 'song_data/')
+        keys = [obj['Key'] for _, obj in self.loader.iter_s3_objects_sharded(BUCKET, shards)]
+        self.assertEqual(sorted(keys), sorted(self.keys))
+
+    def test_consumer_can_stop_early(self):
+        shards = self.loader.discover_shards(BUCKET, 'song_data/')
+        listing = self.loader.iter_s3_objects_sharded(BUCKET, shards, max_workers=2)
+        next(listing)
+        listing.close()
+
+    def test_sync_manifest(self):
+        self.assertEqual(sorted(self.sync()), sorted(self.keys))
+        self.assertEqual(self.sync(), [])
+        self.put('song_data/A/X/0.json', b'changed')
+        self.put('song_data/B/Z/9.json', b'new')
+        self.s3.delete_object(Bucket=BUCKET, Key='song_data/top.json')
+        self.assertEqual(sorted(self.sync()), ['song_data/A/X/0.json', 'song_data/B/Z/9.json'])
+        manifest = S3Manifest(self.manifest_path, BUCKET, 'song_data/')
+        self.assertNotIn('song_data/top.json', manifest.objects)
+        self.assertEqual(len(manifest.objects), len(self.keys))
+
+    def test_append_only_lists_after_the_last_key(self):
+        self.sync(append_only=True)
+        self.put('song_data/B/Z/9.json', b'new')
+        with mock.patch.object(self.loader, 'iter_s3_objects',
+                               wraps=self.loader.iter_s3_objects) as iter_s3_objects:
+            self.assertEqual(self.sync(append_only=True), ['song_data/B/Z/9.json'])
+        start_after = {call.args[1]: call.kwargs['start_after']
+                       for call in iter_s3_objects.call_args_list}
+        self.assertEqual(start_after['song_data/B/Z/'], 'song_data/B/Z/2.json')
+
+    def test_manifest_of_another_prefix_is_ignored(self):
+        self.sync()
+        manifest = S3Manifest(self.manifest_path, BUCKET, 'log_data/')
+        self.assertEqual((manifest.objects, manifest.last_keys), ({}, {}))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,68 +1,127 @@
-import configparser
-import boto3
 import json
-import pandas as pd
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from cluster_sizing import choose_cluster_size, elastic_node_count, slice_throughput, \
+    read_history, record_load
+from compaction import slice_count, GZIP_RATIO
+from get_sparkify_data import S3Loader
+from load_state import LoadStateManager, parse_s3_url
+from settings import settings
+import aws_clients
 
 logging.basicConfig(level=logging.INFO)
 
-config = configparser.ConfigParser()
-config.read_file(open('dwh.cfg'))
-
-KEY                         = config.get('AWS', 'KEY')
-SECRET                      = config.get('AWS', 'SECRET')
-REGION                      = config.get('AWS', 'REGION')
-
-DWH_ROLE_NAME               = config.get('ROLE', 'DWH_ROLE_NAME')
-DWH_CLUSTER_TYPE            = config.get('CLUSTER', 'DWH_CLUSTER_TYPE')
-DWH_NUM_NODES               = config.get('CLUSTER', 'DWH_NUM_NODES')
-DWH_NODE_TYPE               = config.get('CLUSTER', 'DWH_NODE_TYPE')
-DWH_CLUSTER_IDENTIFIER      = config.get('CLUSTER', 'DWH_CLUSTER_IDENTIFIER')
-DWH_DB                      = config.get('CLUSTER', 'DWH_DB')
-DWH_DB_USER                 = config.get('CLUSTER', 'DWH_DB_USER')
-DWH_DB_PASSWORD             = config.get('CLUSTER', 'DWH_DB_PASSWORD')
-DWH_PORT                    = config.get('CLUSTER', 'DWH_PORT')
-
 class InfrastructureManager():
     """
     1. Creates infrastructure (AWS role, Redshift cluster)
     2. Tears down infrastructure
     3. Updates config file based on infrastructure status
     4. Contains various helper methods to get infrastructure information
-    """
-    def __init__(self):
-        self.ec2 = boto3.resource('ec2', region_name=REGION,
-                        aws_access_key_id=KEY,
-                        aws_secret_access_key=SECRET)
 
-        self.s3 = boto3.client('s3', region_name=REGION,
-                        aws_access_key_id=KEY,
-                        aws_secret_access_key=SECRET)
+    Creating the manager makes no AWS calls; the boto3 clients are the
+    shared ones from aws_clients, created on first use. provision() and
+    teardown() run the individual steps with the independent ones
+    overlapped and wait on boto3 waiters polling every WAITER_DELAY seconds.
 
-        self.iam = boto3.client('iam', region_name=REGION,
-                        aws_access_key_id=KEY,
-                        aws_secret_access_key=SECRET)
+    With WARM_START set, teardown() takes a final snapshot named
+    <SNAPSHOT_PREFIX>-<UTC timestamp> and keeps the newest SNAPSHOTS_KEPT of
+    them, and provision() restores the cluster from the newest one, so a
+    run only needs to load what arrived since the last one.
 
-        self.redshift = boto3.client('redshift', region_name=REGION,
-                        aws_access_key_id=KEY,
-                        aws_secret_access_key=SECRET)
-        
-        self.cluster_status = self.set_cluster_status()
+    SIZING_MODE picks the cluster size: 'fixed' uses DWH_NODE_TYPE and
+    DWH_NUM_NODES, 'auto' creates (or restores) the cluster at the size
+    size_for_load() picked for the data to load, and 'elastic' keeps the
+    configured size and resizes to the picked node count for the load only
+    (scale_for_load()/scale_back()).
+    """
+    def __init__(self):
+        self._ec2 = None
+        self.cluster_status = None
         self.cluster_arn = ""
         self.cluster_host = ""
+        self.restored_snapshot = None
+        self.created_empty = False
+        self.node_type = settings.DWH_NODE_TYPE
+        self.num_nodes = settings.DWH_NUM_NODES
+        self.load_size = None
+        self.sizing = None
         
+    @property
+    def ec2(self):
+        if self._ec2 is None:
+            self._ec2 = aws_clients.resource('ec2')
+        return self._ec2
+
+    @property
+    def s3(self):
+        return aws_clients.client('s3')
+
+    @property
+    def iam(self):
+        return aws_clients.client('iam')
+
+    @property
+    def redshift(self):
+        return aws_clients.client('redshift')
+
+    @property
+    def slices(self):
+        """Slices of the cluster at its current (or picked) size."""
+        return slice_count(self.num_nodes, self.node_type)
+
     def set_cluster_status(self):
         """
-        Updates the current status of the Redshift cluster.
+        Updates and returns the current status of the Redshift cluster.
         """
         try:
             cluster_status = self.redshift.describe_clusters(
-                ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]['ClusterStatus']
+                ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]['ClusterStatus']
             self.cluster_status = cluster_status
         except Exception as e:
             logging.warning("Redshift Cluster doesn't exist or has been deleted.")
             self.cluster_status = "No Cluster"
+        return self.cluster_status
+
+    def _wait(self, client, name, **kwargs):
+        client.get_waiter(name).wait(**kwargs, WaiterConfig={
+            'Delay': settings.WAITER_DELAY, 'MaxAttempts': settings.WAITER_MAX_ATTEMPTS})
+
+    def provision(self):
+        """
+        Creates all infrastructure and updates dwh.cfg. The policy is
+        attached and the security group opened while the cluster boots or
+        is restored from the latest snapshot. Raises if the cluster could
+        not be created, without waiting for it or opening the port.
+        """
+        start_time = time.time()
+        self.create_role()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            policy = executor.submit(self.attach_policy_to_role)
+            self.create_redshift_cluster(wait=False)
+            ingress = executor.submit(self.open_incoming_tcp_port)
+            self.wait_for_cluster()
+            policy.result()
+            ingress.result()
+        self.update_config_file()
+        logging.info(f"Infrastructure provisioned in {time.time() - start_time:.0f}s.")
+
+    def teardown(self):
+        """
+        Removes all infrastructure and resets dwh.cfg. The role is removed
+        while the cluster is being deleted (and snapshotted with WARM_START).
+        """
+        start_time = time.time()
+        self.drop_redshift(wait=False)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            role = executor.submit(lambda: (self.drop_role_policy(), self.drop_role()))
+            self.wait_for_cluster_deletion()
+            role.result()
+        if settings.WARM_START:
+            self.prune_snapshots()
+        self.reset_config_file()
+        logging.info(f"Infrastructure removed in {time.time() - start_time:.0f}s.")
         
     def print_cluster_information(self):
         """
@@ -70,10 +129,11 @@ class InfrastructureManager():
         """
         try:
             props = self.redshift.describe_clusters(
-                ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+                ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
             keysToShow = ["ClusterIdentifier", "NodeType", "ClusterStatus", 
                         "MasterUsername", "DBName", "Endpoint", "NumberOfNodes", 'VpcId']
             x = [(k, v) for k,v in props.items() if k in keysToShow]
+            import pandas as pd
             print(pd.DataFrame(data=x, columns=["Key", "Value"]))
         except Exception as e:
             logging.warning("Redshift Cluster doesn't exist.")
@@ -82,7 +142,7 @@ class InfrastructureManager():
         """
         Returns the Arn of the created AWS IAM Role.
         """
-        roleArn = self.iam.get_role(RoleName=DWH_ROLE_NAME)['Role']['Arn']
+        roleArn = self.iam.get_role(RoleName=settings.DWH_ROLE_NAME)['Role']['Arn']
         return roleArn
 
     def create_role(self):
@@ -92,7 +152,7 @@ class InfrastructureManager():
         try:
             logging.info('Creating role...')
             self.iam.create_role(
-                RoleName=DWH_ROLE_NAME
+                RoleName=settings.DWH_ROLE_NAME
                 , Description="Role for accessing S3 from Redshift."
                 , AssumeRolePolicyDocument = json.dumps({
                     'Statement': [{
@@ -102,6 +162,8 @@ class InfrastructureManager():
                         , 'Version': '2012-10-17'  
                 })
             )
+            self.iam.get_waiter('role_exists').wait(RoleName=settings.DWH_ROLE_NAME,
+                WaiterConfig={'Delay': 1, 'MaxAttempts': 30})
             logging.info('Role created!')
 
         except Exception as e:
@@ -113,45 +175,85 @@ class InfrastructureManager():
         """
         try:
             logging.info("Attaching policy to role...")
-            response = self.iam.attach_role_policy(RoleName=DWH_ROLE_NAME
+            response = self.iam.attach_role_policy(RoleName=settings.DWH_ROLE_NAME
                 , PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
             response_code = response['ResponseMetadata']['HTTPStatusCode']
             if response_code == 200: logging.info('Policy attached!')
         except Exception as e:
             logging.warning(f"Failed to attach policy to role.")
             
-    def create_redshift_cluster(self):
-        logging.info(f"Cluster status: {self.cluster_status}")
+    def create_redshift_cluster(self, wait=True):
+        """
+        Starts creating the Redshift cluster unless it already exists, and
+        waits until it is available if `wait` is set. A failed snapshot
+        restore falls back to creating an empty cluster; if that fails too
+        the error is raised, before any waiting.
+        """
+        logging.info(f"Cluster status: {self.set_cluster_status()}")
         if self.cluster_status == 'available':
             logging.info("Redshift cluster already exists. Skipping creation.")
             return
             
+        snapshot = self.latest_snapshot() if self.cluster_status == 'No Cluster' \
+            and settings.WARM_START else None
+        if snapshot:
+            try:
+                logging.info(f"Restoring redshift cluster from snapshot {snapshot}...")
+                self.redshift.restore_from_cluster_snapshot(
+                    ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER,
+                    SnapshotIdentifier=snapshot,
+                    NodeType=self.node_type,
+                    NumberOfNodes=self.num_nodes,
+                    Port=settings.DWH_PORT,
+                    IamRoles=[self.get_role_arn()]
+                )
+                self.restored_snapshot = snapshot
+                logging.info('Cluster restore started...')
+            except Exception as e:
+                logging.warning(f"Failed to restore from snapshot {snapshot}: {e}")
+                snapshot = None
+
+        if self.cluster_status == 'No Cluster' and not snapshot:
+            try:
+                logging.info("Creating redshift cluster...")
+                response = self.redshift.create_cluster(        
+                    ClusterType=settings.DWH_CLUSTER_TYPE,
+                    NodeType=self.node_type,
+                    NumberOfNodes=self.num_nodes,
+                    ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER,
+                    DBName=settings.DWH_DB,
+                    MasterUsername=settings.DWH_DB_USER,
+                    MasterUserPassword=settings.DWH_DB_PASSWORD,
+                    Port=settings.DWH_PORT,
+                    IamRoles=[self.get_role_arn()]
+                )
+                response_code = response['ResponseMetadata']['HTTPStatusCode']
+                if response_code == 200: logging.info('Cluster creation started...')
+                self.created_empty = True
+            except Exception as e:
+                # Waiting on a cluster that is not being created would only
+                # time out after WAITER_DELAY * WAITER_MAX_ATTEMPTS seconds.
+                logging.warning(f"Failed to start cluster creation: {e}")
+                raise
+
+        if wait:
+            self.wait_for_cluster()
+
+    def wait_for_cluster(self):
+        """
+        Blocks until the cluster is available. Raises a WaiterError if it
+        does not become available within WAITER_MAX_ATTEMPTS polls.
+        """
+        start_time = time.time()
         try:
-            logging.info("Creating redshift cluster...")
-            response = self.redshift.create_cluster(        
-                ClusterType=DWH_CLUSTER_TYPE,
-                NodeType=DWH_NODE_TYPE,
-                NumberOfNodes=int(DWH_NUM_NODES),
-                ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,
-                DBName=DWH_DB,
-                MasterUsername=DWH_DB_USER,
-                MasterUserPassword=DWH_DB_PASSWORD,
-                Port=int(DWH_PORT),
-                IamRoles=[self.get_role_arn()]
-            )
-            response_code = response['ResponseMetadata']['HTTPStatusCode']
-            if response_code == 200: logging.info('Cluster creation started...')
-            
-            while self.cluster_status != 'available':
-                time.sleep(30)
-                self.set_cluster_status()
-                logging.info(f"Cluster status: {self.cluster_status}. Waiting...")
-            
-            logging.info('Cluster created! Cluster info:')
-            self.print_cluster_information()
-            
+            self._wait(self.redshift, 'cluster_available',
+                       ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)
         except Exception as e:
-            logging.warning(f"Failed to start cluster creation.")
+            logging.warning(f"Cluster did not become available: {e}")
+            raise
+        self.cluster_status = 'available'
+        logging.info(f'Cluster available after {time.time() - start_time:.0f}s! Cluster info:')
+        self.print_cluster_information()
     
     def open_incoming_tcp_port(self):
         """
@@ -159,8 +261,12 @@ class InfrastructureManager():
         """
         try:
             logging.info("Opening incoming TCP port...")
-            props = self.redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
-            vpc = self.ec2.Vpc(id=props['VpcId'])
+            props = self.redshift.describe_clusters(
+                ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+            # A cluster without a subnet group is launched in the default VPC.
+            vpc_id = props.get('VpcId') or list(self.ec2.vpcs.filter(
+                Filters=[{'Name': 'isDefault', 'Values': ['true']}]))[0].id
+            vpc = self.ec2.Vpc(id=vpc_id)
             defaultSg = list(vpc.security_groups.all())[0]
             print(f"DefaultSg: {defaultSg}")
             
@@ -168,8 +274,8 @@ class InfrastructureManager():
                 GroupName= defaultSg.group_name,  
                 CidrIp='0.0.0.0/0', 
                 IpProtocol='TCP',
-                FromPort=int(DWH_PORT),
-                ToPort=int(DWH_PORT)
+                FromPort=settings.DWH_PORT,
+                ToPort=settings.DWH_PORT
             )
         except Exception as e:
             logging.warning(f"{e}")
@@ -181,16 +287,14 @@ class InfrastructureManager():
         try:
             logging.info("Updating config file with cluster settings...")
             props = self.redshift.describe_clusters(
-                ClusterIdentifier=DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+                ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
             
             self.cluster_host = props['Endpoint']['Address']
             self.cluster_arn = props['IamRoles'][0]['IamRoleArn']
+            self.node_type = props['NodeType']
+            self.num_nodes = props['NumberOfNodes']
             
-            config.set('CLUSTER', 'DWH_HOST', self.cluster_host)
-            config.set('ROLE', 'DWH_ROLE_ARN', self.cluster_arn)
-
-            with open('dwh.cfg', 'w') as configfile:
-                config.write(configfile)
+            settings.save(DWH_HOST=self.cluster_host, DWH_ROLE_ARN=self.cluster_arn)
             logging.info("Config file has been updated!")
         except Exception as e:
             logging.warning(f"{e}")
@@ -202,45 +306,225 @@ class InfrastructureManager():
         try:
             logging.info("Resettinc config file...")
             
-            config.set('CLUSTER', 'DWH_HOST', 'Not specified')
-            config.set('ROLE', 'DWH_ROLE_ARN', 'Not specified')
-
-            with open('dwh.cfg', 'w') as configfile:
-                config.write(configfile)
+            settings.save(DWH_HOST='Not specified', DWH_ROLE_ARN='Not specified')
             logging.info("Config file has been updated!")
         except Exception as e:
             logging.warning(f"{e}")
             
-    def drop_redshift(self):
+    def drop_redshift(self, wait=True):
         """
-        Tearsdown Redshift cluster.
+        Tearsdown Redshift cluster. With WARM_START set a final snapshot is
+        taken first.
         """
+        if settings.WARM_START:
+            snapshot = self.final_snapshot_name()
+            options = {'SkipFinalClusterSnapshot': False,
+                       'FinalClusterSnapshotIdentifier': snapshot,
+                       'FinalClusterSnapshotRetentionPeriod': settings.SNAPSHOT_RETENTION_DAYS}
+        else:
+            options = {'SkipFinalClusterSnapshot': True}
         try:
             logging.info("Deleting redshift cluster...")
-            self.redshift.delete_cluster(ClusterIdentifier=DWH_CLUSTER_IDENTIFIER,  
-                SkipFinalClusterSnapshot=True)
-            
-            while self.cluster_status != 'No Cluster':
-                time.sleep(30)
-                self.set_cluster_status()
-                logging.info(f"Cluster status: {self.cluster_status}. Waiting...")
-            
-            logging.info('Cluster deleted!')
-            
+            self.redshift.delete_cluster(ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER, **options)
+            if settings.WARM_START:
+                logging.info(f"Taking final snapshot {snapshot}...")
         except Exception as e:
             logging.warning(f"Failed to start cluster deletion.")
+            return
+
+        if wait:
+            self.wait_for_cluster_deletion()
+
+    def wait_for_cluster_deletion(self):
+        """Blocks until the cluster no longer exists."""
+        start_time = time.time()
+        try:
+            self._wait(self.redshift, 'cluster_deleted',
+                       ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)
+            self.cluster_status = 'No Cluster'
+            logging.info(f'Cluster deleted after {time.time() - start_time:.0f}s!')
+        except Exception as e:
+            logging.warning(f"Cluster deletion did not finish: {e}")
             
+    def measure_load(self):
+        """
+        Returns the bytes and number of objects the next run will COPY from
+        LOG_DATA and SONG_DATA, in total and per staging table under
+        'tables'. Incremental runs onto an existing or restored cluster only
+        count the objects that were not loaded yet. With COMPACT_SONGS the
+        songs are counted at their estimated gzipped size.
+        """
+        increment = settings.INCREMENTAL and (self.set_cluster_status() != 'No Cluster'
+                                     or (settings.WARM_START and self.latest_snapshot()))
+        if increment:
+            load_state = LoadStateManager(settings.LOAD_STATE_FILE, settings.MANIFEST_PREFIX,
+                                          s3_client=self.s3)
+            objects = {'staging_events': load_state.pending_objects(settings.LOG_DATA,
+                                                                    append_only=True),
+                       'staging_songs': load_state.pending_objects(settings.SONG_DATA)}
+        else:
+            loader = S3Loader(s3_client=self.s3)
+            objects = {table: [obj for obj in loader.iter_s3_objects(*parse_s3_url(url))
+                               if not obj['Key'].endswith('/')]
+                       for table, url in (('staging_events', settings.LOG_DATA),
+                                          ('staging_songs', settings.SONG_DATA))}
+        tables = {table: {'bytes': sum(obj.get('Size', 0) for obj in table_objects),
+                          'objects': len(table_objects)}
+                  for table, table_objects in objects.items()}
+        if settings.COMPACT_SONGS:
+            # COPY reads the gzipped parts instead. There are at least as
+            # many parts as slices, so the object count still bounds how
+            # many slices are busy.
+            tables['staging_songs']['bytes'] = int(tables['staging_songs']['bytes'] * GZIP_RATIO)
+        self.load_size = {'bytes': sum(table['bytes'] for table in tables.values()),
+                          'objects': sum(table['objects'] for table in tables.values()),
+                          'tables': tables}
+        logging.info(f"Next load: {self.load_size['objects']} objects, "
+                     f"{self.load_size['bytes'] / 1024 ** 2:.1f} MB.")
+        return self.load_size
+
+    def size_for_load(self, total_bytes=None, object_count=None):
+        """
+        Picks the cheapest size that loads the data within
+        TARGET_LOAD_MINUTES * 60 at the per-slice throughput of past loads
+        (SLICE_MB_PER_SECOND before there are any). Measures the data with
+        measure_load() unless sizes are passed. In 'auto' mode the cluster
+        is then created at that size; in 'elastic' mode only the node
+        count is used, within what an elastic resize can reach.
+        """
+        if total_bytes is None:
+            load_size = self.measure_load()
+            total_bytes, object_count = load_size['bytes'], load_size['objects']
+        else:
+            self.load_size = {'bytes': total_bytes, 'objects': object_count}
+        throughput = slice_throughput(read_history(settings.LOAD_HISTORY_FILE),
+                                      default=settings.SLICE_MB_PER_SECOND * 1024 * 1024)
+        node_types = [settings.DWH_NODE_TYPE] if settings.SIZING_MODE == 'elastic' \
+            else settings.SIZING_NODE_TYPES
+        self.sizing = choose_cluster_size(total_bytes, object_count,
+                                          settings.TARGET_LOAD_MINUTES * 60, throughput,
+                                          node_types, settings.SIZING_MAX_NODES)
+        if settings.SIZING_MODE == 'elastic':
+            self.sizing['num_nodes'] = elastic_node_count(settings.DWH_NUM_NODES,
+                                                          self.sizing['num_nodes'])
+        elif settings.SIZING_MODE == 'auto':
+            self.node_type = self.sizing['node_type']
+            self.num_nodes = self.sizing['num_nodes']
+        logging.info(f"Sized for the load: {self.sizing['num_nodes']} x "
+                     f"{self.sizing['node_type']}, estimated COPY time "
+                     f"{self.sizing['estimated_seconds']:.0f}s.")
+        return self.sizing
+
+    def resize(self, num_nodes, node_type=None):
+        """
+        Resizes the cluster and waits until it is available again. Tries an
+        elastic resize first and falls back to a classic resize.
+        """
+        node_type = node_type or self.node_type
+        if (node_type, num_nodes) == (self.node_type, self.num_nodes):
+            return
+        start_time = time.time()
+        logging.info(f"Resizing cluster to {num_nodes} x {node_type}...")
+        try:
+            self.redshift.resize_cluster(ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER,
+                NodeType=node_type, NumberOfNodes=num_nodes, Classic=False)
+        except Exception as e:
+            logging.warning(f"Elastic resize not possible, using classic resize: {e}")
+            self.redshift.modify_cluster(ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER,
+                NodeType=node_type, NumberOfNodes=num_nodes)
+        self._wait(self.redshift, 'cluster_available', ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)
+        self.node_type, self.num_nodes = node_type, num_nodes
+        logging.info(f"Cluster resized after {time.time() - start_time:.0f}s.")
+
+    def scale_for_load(self):
+        """In 'elastic' mode, resizes the cluster to the size picked for the load."""
+        if settings.SIZING_MODE == 'elastic' and self.sizing:
+            self.resize(self.sizing['num_nodes'])
+
+    def scale_back(self):
+        """In 'elastic' mode, resizes the cluster back to DWH_NUM_NODES."""
+        if settings.SIZING_MODE == 'elastic':
+            self.resize(settings.DWH_NUM_NODES, settings.DWH_NODE_TYPE)
+
+    def record_load(self, seconds, copied=None):
+        """
+        Adds the COPY time of the load to LOAD_HISTORY_FILE, which later
+        runs estimate their throughput from. `copied` holds the bytes and
+        objects a staging table's COPY actually read (ETLManager.copied);
+        the measured size is used for the tables it does not cover.
+        """
+        if not self.load_size or not seconds:
+            return None
+        tables = dict(self.load_size.get('tables', {}), **(copied or {}))
+        if {'staging_events', 'staging_songs'} <= set(tables):
+            total_bytes = sum(table['bytes'] for table in tables.values())
+            objects = sum(table['objects'] for table in tables.values())
+        else:
+            total_bytes, objects = self.load_size['bytes'], self.load_size['objects']
+        return record_load(settings.LOAD_HISTORY_FILE, total_bytes, objects,
+                           self.node_type, self.num_nodes, seconds)
+
+    @staticmethod
+    def final_snapshot_name(now=None):
+        """Name of the final snapshot taken at `now` (UTC, defaults to the current time)."""
+        now = now or datetime.now(timezone.utc)
+        return f"{settings.SNAPSHOT_PREFIX}-{now:%Y%m%d-%H%M%S}"
+
+    def list_snapshots(self):
+        """
+        Returns the available final snapshots of the cluster, newest first.
+        """
+        snapshots = []
+        paginator = self.redshift.get_paginator('describe_cluster_snapshots')
+        for page in paginator.paginate(SnapshotType='manual'):
+            snapshots.extend(
+                snapshot for snapshot in page['Snapshots']
+                if snapshot['ClusterIdentifier'] == settings.DWH_CLUSTER_IDENTIFIER
+                and snapshot['SnapshotIdentifier'].startswith(f"{settings.SNAPSHOT_PREFIX}-")
+                and snapshot['Status'] == 'available')
+        return sorted(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'],
+                      reverse=True)
+
+    def latest_snapshot(self):
+        """
+        Returns the identifier of the newest final snapshot, or None.
+        """
+        try:
+            snapshots = self.list_snapshots()
+        except Exception as e:
+            logging.warning(f"Failed to list snapshots: {e}")
+            return None
+        return snapshots[0]['SnapshotIdentifier'] if snapshots else None
+
+    def prune_snapshots(self, keep=None):
+        """
+        Deletes all but the newest `keep` final snapshots (SNAPSHOTS_KEPT by
+        default) and returns the identifiers of the deleted ones.
+        """
+        keep = settings.SNAPSHOTS_KEPT if keep is None else keep
+        deleted = []
+        try:
+            for snapshot in self.list_snapshots()[max(keep, 1):]:
+                self.redshift.delete_cluster_snapshot(
+                    SnapshotIdentifier=snapshot['SnapshotIdentifier'])
+                deleted.append(snapshot['SnapshotIdentifier'])
+        except Exception as e:
+            logging.warning(f"Failed to prune snapshots: {e}")
+        if deleted:
+            logging.info(f"Deleted old snapshots: {', '.join(deleted)}")
+        return deleted
+
     def drop_role_policy(self):
         """
         Removes the S3 Read policy from the IAM Role.
         """
         try:
             logging.info("Detaching policy from role...")
-            self.iam.detach_role_policy(RoleName=DWH_ROLE_NAME, 
+            self.iam.detach_role_policy(RoleName=settings.DWH_ROLE_NAME, 
                 PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
             logging.info("Policy detached!")
         except Exception as e:
-            logging.warning(f"Failed to start cluster deletion.")
+            logging.warning(f"Failed to detach policy from role.")
             
     def drop_role(self):     
         """
@@ -248,7 +532,7 @@ class InfrastructureManager():
         """   
         try:
             logging.info("Deleting role...")
-            self.iam.delete_role(RoleName=DWH_ROLE_NAME)
+            self.iam.delete_role(RoleName=settings.DWH_ROLE_NAME)
             logging.info("Role deleted!")
         except Exception as e:
             logging.warning(f"Failed to delete role.")
@@ -7,10 +7,7 @@ def main():
     infrastructure = InfrastructureManager()
         
     logging.info('Starting infrastructure teardown...')
-    infrastructure.drop_redshift()
-    infrastructure.drop_role_policy()
-    infrastructure.drop_role()
-    infrastructure.reset_config_file
+    infrastructure.teardown()
     logging.info('Finished infrustructure teardown!')
 
 if __name__ == "__main__":
@@ -1,25 +1,223 @@
+from datetime import datetime, timezone
 from infrastructure import InfrastructureManager
+from settings import settings
+from unittest import mock
+import aws_clients
+import configparser
 import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
 
 logging.basicConfig(level=logging.INFO)
 
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dwh_template.cfg')
+
+class MotoTestCase(unittest.TestCase):
+    """
+    Runs each test against moto with dwh.cfg replaced by a copy of
+    dwh_template.cfg in a temporary directory, changed by `options`.
+    """
+    # (section, option) -> value
+    options = {}
+
+    def setUp(self):
+        from moto import mock_aws
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.directory = tempfile.mkdtemp()
+        config = configparser.ConfigParser()
+        config.read(TEMPLATE)
+        config.set('PROVISIONING', 'waiter_delay', '1')
+        config.set('PROVISIONING', 'waiter_max_attempts', '5')
+        config.set('SIZING', 'history_file', os.path.join(self.directory, 'load_history.jsonl'))
+        for (section, option), value in self.options.items():
+            config.set(section, option, value)
+        self.config_path = os.path.join(self.directory, 'dwh.cfg')
+        with open(self.config_path, 'w') as f:
+            config.write(f)
+        self.previous_path = settings.path
+        settings.path = self.config_path
+        settings.reload()
+        aws_clients.reset()
+
+    def tearDown(self):
+        settings.path = self.previous_path
+        settings.reload()
+        aws_clients.reset()
+        self.mock_aws.stop()
+        shutil.rmtree(self.directory)
+
+
+class ProvisionTest(MotoTestCase):
+
+    def test_provision(self):
+        infrastructure = InfrastructureManager()
+        infrastructure.provision()
+        self.assertEqual(infrastructure.cluster_status, 'available')
+        self.assertTrue(infrastructure.created_empty)
+        settings.reload()
+        self.assertNotEqual(settings.DWH_HOST, 'Not specified')
+        self.assertEqual(settings.DWH_ROLE_ARN, infrastructure.get_role_arn())
+
+    def test_failed_creation_does_not_wait(self):
+        from botocore.exceptions import ClientError
+        infrastructure = InfrastructureManager()
+        error = ClientError({'Error': {'Code': 'ClusterQuotaExceeded', 'Message': 'quota'}},
+                            'CreateCluster')
+        with mock.patch.object(infrastructure.redshift, 'create_cluster', side_effect=error), \
+                mock.patch.object(infrastructure, 'wait_for_cluster') as wait_for_cluster, \
+                mock.patch.object(infrastructure, 'open_incoming_tcp_port') as open_port:
+            with self.assertRaises(ClientError):
+                infrastructure.provision()
+        wait_for_cluster.assert_not_called()
+        open_port.assert_not_called()
+        self.assertFalse(infrastructure.created_empty)
+        settings.reload()
+        self.assertEqual(settings.DWH_HOST, 'Not specified')
+
+
+class SizingTest(MotoTestCase):
+    options = {('S3', 'log_data'): 's3://sparkify-src/log_data',
+               ('S3', 'song_data'): 's3://sparkify-src/song_data',
+               ('SIZING', 'mode'): 'auto',
+               ('SIZING', 'target_load_minutes'): '1',
+               ('SIZING', 'slice_mb_per_second'): '1'}
+
+    def setUp(self):
+        super().setUp()
+        s3 = aws_clients.client('s3')
+        s3.create_bucket(Bucket='sparkify-src',
+                         CreateBucketConfiguration={'LocationConstraint': settings.REGION})
+        for i in range(3):
+            s3.put_object(Bucket='sparkify-src', Key=f'log_data/2018/11/{i}.json', Body=b'x' * 1000)
+        for i in range(5):
+            s3.put_object(Bucket='sparkify-src', Key=f'song_data/A/{i}.json', Body=b'x' * 200)
+
+    def test_measure_load(self):
+        load_size = InfrastructureManager().measure_load()
+        self.assertEqual(load_size['tables'], {'staging_events': {'bytes': 3000, 'objects': 3},
+                                               'staging_songs': {'bytes': 1000, 'objects': 5}})
+        self.assertEqual((load_size['bytes'], load_size['objects']), (4000, 8))
+
+    def test_measure_compacted_songs(self):
+        settings.save(COMPACT_SONGS=True)
+        load_size = InfrastructureManager().measure_load()
+        self.assertEqual(load_size['tables']['staging_songs'], {'bytes': 200, 'objects': 5})
+        self.assertEqual(load_size['bytes'], 3200)
+
+    def test_size_for_load(self):
+        infrastructure = InfrastructureManager()
+        # 4000 bytes at 1 MB/s per slice load in a minute on the cheapest size.
+        sizing = infrastructure.size_for_load()
+        self.assertTrue(sizing['meets_target'])
+        self.assertEqual((infrastructure.node_type, infrastructure.num_nodes),
+                         (sizing['node_type'], sizing['num_nodes']))
+        sizing = infrastructure.size_for_load(600 * 1024 * 1024, 100)
+        self.assertGreaterEqual(sizing['slices'], 10)
+        self.assertEqual(infrastructure.num_nodes, sizing['num_nodes'])
+
+    def test_record_load_uses_copied_sizes(self):
+        from cluster_sizing import read_history
+        infrastructure = InfrastructureManager()
+        infrastructure.measure_load()
+        infrastructure.record_load(2.0, {'staging_songs': {'bytes': 150, 'objects': 4}})
+        entry = read_history(settings.LOAD_HISTORY_FILE)[-1]
+        # The events as measured, the songs as copied.
+        self.assertEqual((entry['bytes'], entry['objects'], entry['seconds']), (3150, 7, 2.0))
+        self.assertIsNone(InfrastructureManager().record_load(2.0))
+
+
+class ResizeTest(MotoTestCase):
+    options = {('SIZING', 'mode'): 'elastic',
+               ('CLUSTER', 'dwh_num_nodes'): '4'}
+
+    def test_scale_for_load_and_back(self):
+        infrastructure = InfrastructureManager()
+        infrastructure.provision()
+        infrastructure.size_for_load(100 * 1024 ** 3, 1000)
+        # An elastic resize at most doubles the node count.
+        self.assertEqual(infrastructure.sizing['num_nodes'], 8)
+        infrastructure.scale_for_load()
+        cluster = infrastructure.redshift.describe_clusters(
+            ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+        self.assertEqual((cluster['NumberOfNodes'], infrastructure.num_nodes), (8, 8))
+        infrastructure.scale_back()
+        cluster = infrastructure.redshift.describe_clusters(
+            ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)['Clusters'][0]
+        self.assertEqual((cluster['NumberOfNodes'], infrastructure.num_nodes), (4, 4))
+
+    def test_resize_to_same_size_is_skipped(self):
+        infrastructure = InfrastructureManager()
+        with mock.patch.object(infrastructure, '_wait') as wait:
+            infrastructure.resize(settings.DWH_NUM_NODES, settings.DWH_NODE_TYPE)
+        wait.assert_not_called()
+
+
+class WarmStartTest(MotoTestCase):
+    options = {('SNAPSHOTS', 'warm_start'): 'true',
+               ('SNAPSHOTS', 'keep'): '2'}
+
+    def test_teardown_snapshots_and_provision_restores(self):
+        infrastructure = InfrastructureManager()
+        infrastructure.provision()
+        self.assertIsNone(infrastructure.latest_snapshot())
+        infrastructure.teardown()
+        snapshot = infrastructure.latest_snapshot()
+        self.assertTrue(snapshot.startswith(f"{settings.SNAPSHOT_PREFIX}-"))
+        settings.reload()
+        self.assertEqual(settings.DWH_HOST, 'Not specified')
+
+        infrastructure = InfrastructureManager()
+        infrastructure.provision()
+        self.assertEqual(infrastructure.restored_snapshot, snapshot)
+        self.assertFalse(infrastructure.created_empty)
+        self.assertEqual(infrastructure.cluster_status, 'available')
+
+    def test_failed_restore_creates_an_empty_cluster(self):
+        infrastructure = InfrastructureManager()
+        infrastructure.provision()
+        infrastructure.teardown()
+        infrastructure = InfrastructureManager()
+        with mock.patch.object(infrastructure.redshift, 'restore_from_cluster_snapshot',
+                               side_effect=RuntimeError('snapshot is not available')):
+            infrastructure.provision()
+        self.assertIsNone(infrastructure.restored_snapshot)
+        self.assertTrue(infrastructure.created_empty)
+
+    def test_prune_snapshots(self):
+        infrastructure = InfrastructureManager()
+        infrastructure.provision()
+        names = [f"{settings.SNAPSHOT_PREFIX}-2026010{day}-000000" for day in range(1, 5)]
+        for name in names + ['manual-backup']:
+            infrastructure.redshift.create_cluster_snapshot(
+                SnapshotIdentifier=name, ClusterIdentifier=settings.DWH_CLUSTER_IDENTIFIER)
+            time.sleep(0.01)
+        self.assertEqual(infrastructure.latest_snapshot(), names[-1])
+        self.assertEqual(sorted(infrastructure.prune_snapshots()), names[:2])
+        self.assertEqual([snapshot['SnapshotIdentifier']
+                          for snapshot in infrastructure.list_snapshots()], names[:1:-1])
+        # Snapshots not taken by teardown() are left alone.
+        infrastructure.redshift.describe_cluster_snapshots(SnapshotIdentifier='manual-backup')
+
+    def test_final_snapshot_name(self):
+        now = datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+        self.assertEqual(InfrastructureManager.final_snapshot_name(now),
+                         f"{settings.SNAPSHOT_PREFIX}-20260102-030405")
+
+
 def main():
-    infrastructure = InfrastructureManager
-    
+    infrastructure = InfrastructureManager()
+
     logging.info('Starting infrastructure creation...')
-    infrastructure.create_role()
-    infrastructure.attach_policy_to_role()
-    infrastructure.create_redshift_cluster()
-    infrastructure.open_incoming_tcp_port()
-    infrastructure.update_config_file()
+    infrastructure.provision()
     logging.info('Finished infrustructure creation!')
-    
+
     logging.info('Starting infrastructure teardown...')
-    infrastructure.drop_redshift()
-    infrastructure.drop_role_policy()
-    infrastructure.drop_role()
-    infrastructure.reset_config_file
+    infrastructure.teardown()
     logging.info('Finished infrustructure teardown!')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,216 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+import sql_queries
+
+logging.basicConfig(level=logging.INFO)
+
+def _build_statement_index():
+    """
+    Maps the SQL strings defined in sql_queries back to their variable
+    names. Templates (strings filled with str.format) are matched with a
+    regex in which every placeholder matches anything. A placeholder can
+    swallow the extra text of a longer template (staging_events_copy
+    matches staging_events_copy_manifest), so templates are tried from the
+    most literal text to the least.
+    """
+    exact = {}
+    templates = []
+    for name, value in vars(sql_queries).items():
+        if name.startswith('_') or not isinstance(value, str):
+            continue
+        exact.setdefault(_normalize(value), name)
+        if re.search(r'\{\d*\}', value):
+            parts = re.split(r'(\{\d*\})', _normalize(value))
+            literal = [part for part in parts if not re.fullmatch(r'\{\d*\}', part)]
+            pattern = ''.join(
+                '.*?' if re.fullmatch(r'\{\d*\}', part) else re.escape(part)
+                for part in parts)
+            templates.append((sum(map(len, literal)), name, re.compile(pattern, re.S)))
+    templates.sort(key=lambda template: -template[0])
+    return exact, [(name, pattern) for _, name, pattern in templates]
+
+def _normalize(query):
+    return ' '.join(query.split())
+
+_STATEMENTS = None
+
+def statement_name(query):
+    """
+    Returns the sql_queries variable name a statement was built from, or
+    'adhoc:<first words>' for statements that are not defined there.
+    """
+    global _STATEMENTS
+    if _STATEMENTS is None:
+        _STATEMENTS = _build_statement_index()
+    exact, templates = _STATEMENTS
+    normalized = _normalize(query if isinstance(query, str) else str(query))
+    if normalized in exact:
+        return exact[normalized]
+    for name, pattern in templates:
+        if pattern.fullmatch(normalized):
+            return name
+    return 'adhoc:' + ' '.join(normalized.split()[:3])
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class StatementRecorder():
+    """
+    Collects one record per executed statement, appends it as a JSON line
+    to `log_path` and keeps per-statement totals for a Prometheus text file.
+
+    ...
+
+    Attributes
+    ----------
+    log_path : str
+        JSON lines file the records are appended to (None disables it)
+    prometheus_path : str
+        Prometheus textfile collector file (None disables it)
+    fetch_query_id : bool
+        look up pg_last_query_id() after each statement (Redshift only)
+    """
+    def __init__(self, log_path=None, prometheus_path=None, fetch_query_id=False):
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.fetch_query_id = fetch_query_id
+        self.totals = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def labels(self, **labels):
+        """
+        Attaches labels (e.g. copy_profile='fast_staging') to every
+        statement recorded by the current thread inside the with block.
+        """
+        previous = getattr(self._local, 'labels', {})
+        self._local.labels = {**previous, **labels}
+        try:
+            yield
+        finally:
+            self._local.labels = previous
+
+    @classmethod
+    def from_config(cls, config):
+        """Builds a recorder from the [METRICS] section of dwh.cfg."""
+        return cls(
+            log_path=config.get('METRICS', 'STATEMENT_LOG', fallback='') or None,
+            prometheus_path=config.get('METRICS', 'PROMETHEUS_FILE', fallback='') or None,
+            fetch_query_id=config.getboolean('METRICS', 'REDSHIFT_QUERY_ID', fallback=False))
+
+    def record(self, statement, seconds, rowcount, query_id=None, error=None):
+        labels = dict(getattr(self._local, 'labels', {}))
+        entry = {
+            'ts': time.time(),
+            'statement': statement,
+            'labels': labels,
+            'seconds': round(seconds, 6),
+            'rowcount': rowcount,
+            'query_id': query_id,
+            'status': 'error' if error else 'ok',
+        }
+        if error:
+            entry['error'] = str(error)
+        with self._lock:
+            key = (statement, tuple(sorted(labels.items())))
+            totals = self.totals.setdefault(key,
+                {'count': 0, 'seconds': 0.0, 'rows': 0, 'errors': 0,
+                 'first_start': None, 'last_end': None})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            # Wall-clock span of the executions, for statements that overlap.
+            start_time = entry['ts'] - seconds
+            if totals['first_start'] is None or start_time < totals['first_start']:
+                totals['first_start'] = start_time
+            totals['last_end'] = max(totals['last_end'] or entry['ts'], entry['ts'])
+            totals['rows'] += max(rowcount or 0, 0)
+            totals['errors'] += 1 if error else 0
+            if self.log_path:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def write_prometheus(self, path=None):
+        """Writes the per-statement totals in Prometheus text format."""
+        path = path or self.prometheus_path
+        if not path:
+            return
+        lines = [
+            '# HELP sparkify_statement_seconds_total Wall time spent in a statement.',
+            '# TYPE sparkify_statement_seconds_total counter',
+        ]
+        metrics = [('seconds', 'sparkify_statement_seconds_total'),
+                   ('count', 'sparkify_statement_executions_total'),
+                   ('rows', 'sparkify_statement_rows_total'),
+                   ('errors', 'sparkify_statement_errors_total')]
+        with self._lock:
+            totals = dict(self.totals)
+        for key, metric in metrics:
+            if key != 'seconds':
+                lines.append(f'# TYPE {metric} counter')
+            for (statement, labels), values in sorted(totals.items()):
+                label_text = ','.join(f'{name}="{_escape(value)}"'
+                                      for name, value in (('statement', statement),) + labels)
+                lines.append(f'{metric}{{{label_text}}} {values[key]}')
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+
+class InstrumentedCursor():
+    """
+    Wraps a DB-API cursor and reports every execute() to a StatementRecorder.
+    All other attributes are passed through to the wrapped cursor.
+
+    ...
+
+    Attributes
+    ----------
+    cursor : DB-API cursor
+        the wrapped cursor
+    recorder : StatementRecorder
+        receives one record per statement
+    """
+    def __init__(self, cursor, recorder):
+        self.cursor = cursor
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, query, vars=None):
+        name = statement_name(query)
+        start_time = time.time()
+        try:
+            if vars is None:
+                result = self.cursor.execute(query)
+            else:
+                result = self.cursor.execute(query, vars)
+        except Exception as e:
+            self.recorder.record(name, time.time() - start_time, -1, error=e)
+            raise
+        seconds = time.time() - start_time
+        query_id = self._last_query_id() if self.recorder.fetch_query_id else None
+        self.recorder.record(name, seconds, self.cursor.rowcount, query_id)
+        return result
+
+    def _last_query_id(self):
+        # A separate cursor keeps the result set of this one intact.
+        try:
+            with self.cursor.connection.cursor() as cur:
+                cur.execute("SELECT pg_last_query_id()")
+                return cur.fetchone()[0]
+        except Exception as e:
+            logging.debug(f"Could not read query id: {e}")
+            return None
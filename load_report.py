@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from sql_queries import last_copy_id, cluster_slices, load_file_scans, load_commits, \
+    load_errors, failed_copy_id
+
+logging.basicConfig(level=logging.INFO)
+
+# A file or slice taking longer than this multiple of the median is a straggler.
+STRAGGLER_FACTOR = 3.0
+# Files and slices faster than this are never stragglers.
+STRAGGLER_MIN_SECONDS = 1.0
+# Largest slice over the mean slice (in bytes) above which a load is skewed.
+SKEW_THRESHOLD = 1.5
+
+def _rates(rows, size, seconds):
+    return {
+        'rows_per_second': rows / seconds if seconds else None,
+        'mb_per_second': size / 1024 ** 2 / seconds if seconds else None,
+    }
+
+def _stragglers(items):
+    """Names of the items whose seconds stand out from the median."""
+    median = statistics.median(item['seconds'] for item in items.values()) if items else 0
+    return sorted(name for name, item in items.items()
+                  if item['seconds'] >= STRAGGLER_MIN_SECONDS
+                  and item['seconds'] > STRAGGLER_FACTOR * median)
+
+def build_report(table, query_id, scans, commits=(), errors=(), wall_seconds=None,
+                 slices=None):
+    """
+    Builds the load report of one COPY.
+
+    scans are (slice, file, rows, bytes, loadtime in microseconds) rows of
+    stl_file_scan, commits (file, lines scanned, errors) rows of
+    stl_load_commits and errors the rows of stl_load_errors. `slices` is
+    the number of slices of the cluster, so idle slices count towards skew.
+    """
+    files, by_slice = {}, {}
+    for slice_id, name, rows, size, loadtime in scans:
+        rows, size, seconds = int(rows or 0), int(size or 0), (loadtime or 0) / 1e6
+        entry = files.setdefault(name, {'rows': 0, 'bytes': 0, 'seconds': 0.0, 'slices': []})
+        entry['rows'] += rows
+        entry['bytes'] += size
+        entry['seconds'] += seconds
+        entry['slices'].append(slice_id)
+        busy = by_slice.setdefault(slice_id, {'rows': 0, 'bytes': 0, 'seconds': 0.0, 'files': 0})
+        busy['rows'] += rows
+        busy['bytes'] += size
+        busy['seconds'] += seconds
+        busy['files'] += 1
+    for name, scanned, rejected in commits:
+        # stl_file_scan cuts names off at 90 characters.
+        for file_name, entry in files.items():
+            if name.startswith(file_name):
+                entry['errors'] = entry.get('errors', 0) + int(rejected or 0)
+    for entry in list(files.values()) + list(by_slice.values()):
+        entry.update(_rates(entry['rows'], entry['bytes'], entry['seconds']))
+
+    slice_count = max(slices or 0, len(by_slice))
+    total_rows = sum(entry['rows'] for entry in files.values())
+    total_bytes = sum(entry['bytes'] for entry in files.values())
+    mean_slice_bytes = total_bytes / slice_count if slice_count else 0
+    skew = max((entry['bytes'] for entry in by_slice.values()), default=0) / mean_slice_bytes \
+        if mean_slice_bytes else None
+    return {
+        'table': table,
+        'query_id': query_id,
+        'files': files,
+        'slices': {str(slice_id): entry for slice_id, entry in sorted(by_slice.items())},
+        'errors': [dict(zip(['slice', 'file', 'line', 'column', 'code', 'reason'], error))
+                   for error in errors],
+        'summary': {
+            'files': len(files),
+            'rows': total_rows,
+            'bytes': total_bytes,
+            'wall_seconds': wall_seconds,
+            **_rates(total_rows, total_bytes, wall_seconds),
+            'rejected_rows': sum(int(rejected or 0) for _, _, rejected in commits),
+            'active_slices': len(by_slice),
+            'idle_slices': slice_count - len(by_slice),
+            'slice_skew': skew,
+            'skewed': skew is not None and skew > SKEW_THRESHOLD,
+            'straggler_files': _stragglers(files),
+            'straggler_slices': _stragglers(by_slice),
+        },
+    }
+
+
+class LoadReporter():
+    """
+    Reports how a staging COPY went, file by file and slice by slice:
+    rows, bytes and time from stl_file_scan, rejected rows from
+    stl_load_commits and stl_load_errors. Flags straggling files and slices
+    and uneven slices, logs a summary and writes the report as JSON. A
+    COPY that fails gets a partial report with its load errors.
+
+    On the local backend the same system tables are filled in by the local
+    COPY, so the reports are built the same way.
+
+    ...
+
+    Attributes
+    ----------
+    db : ConnectionManager or LocalConnectionManager
+        pool the system tables are read through
+    directory : str
+        reports go to <directory>/<run id>/<table>-<query id>.json
+        (None only logs them)
+    """
+    def __init__(self, db, directory=None):
+        self.db = db
+        self.directory = directory
+        self.run_id = None
+        self._slices = None
+        # Failed COPYs already reported. A pooled session keeps the load
+        # errors of every COPY that failed on it.
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def copy(self, cur, table, query):
+        """
+        Runs a COPY into `table` on `cur` and returns its query id. If the
+        COPY fails, its transaction is rolled back, a partial report with
+        the rows of stl_load_errors is saved and the error is raised again.
+        """
+        try:
+            cur.execute(query)
+        except Exception:
+            self.report_failure(cur, table)
+            raise
+        cur.execute(last_copy_id)
+        return cur.fetchone()[0]
+
+    def report_failure(self, cur, table):
+        """
+        Builds, logs and saves the partial report of the COPY that just
+        failed on the session of `cur`. Returns the report, or None if the
+        COPY left no load errors or they cannot be read.
+        """
+        try:
+            cur.connection.rollback()
+            cur.execute(failed_copy_id)
+            query_id = cur.fetchone()[0]
+            with self._lock:
+                if query_id is None or query_id in self._failed:
+                    logging.warning(f"COPY into {table} failed without load errors.")
+                    return None
+                self._failed.add(query_id)
+            cur.execute(load_file_scans.format(query_id))
+            scans = cur.fetchall()
+            cur.execute(load_errors.format(query_id))
+            errors = cur.fetchall()
+            cur.connection.rollback()
+        except Exception as e:
+            logging.warning(f"Could not read the load errors of {table}: {e}")
+            return None
+        report = build_report(table, query_id, scans, errors=errors, slices=self._slices)
+        report['failed'] = True
+        for error in report['errors'][:5]:
+            logging.error(f"COPY into {table} failed: {error['file']} line {error['line']}, "
+                          f"column {error['column']}: {error['reason']}")
+        if self.directory:
+            self._save(report)
+        return report
+
+    def report(self, table, query_id, wall_seconds=None):
+        """
+        Builds, logs and saves the report of the committed COPY `query_id`.
+        Returns its summary, or None if the system tables cannot be read.
+        """
+        if query_id is None or query_id < 0:
+            return None
+        try:
+            with self.db.connection() as (conn, cur):
+                if self._slices is None:
+                    cur.execute(cluster_slices)
+                    self._slices = cur.fetchone()[0]
+                cur.execute(load_file_scans.format(query_id))
+                scans = cur.fetchall()
+                cur.execute(load_commits.format(query_id))
+                commits = cur.fetchall()
+                cur.execute(load_errors.format(query_id))
+                errors = cur.fetchall()
+        except Exception as e:
+            logging.warning(f"Could not read the load report of {table}: {e}")
+            return None
+        report = build_report(table, query_id, scans, commits, errors, wall_seconds,
+                              self._slices)
+        self._log(report)
+        if self.directory:
+            self._save(report)
+        return report['summary']
+
+    def _log(self, report):
+        summary = report['summary']
+        rate = summary['mb_per_second']
+        logging.info(f"Loaded {summary['rows']} rows, {summary['bytes'] / 1024 ** 2:.1f} MB from "
+                     f"{summary['files']} files into {report['table']} on "
+                     f"{summary['active_slices']} slices"
+                     + (f" ({rate:.1f} MB/s)." if rate is not None else "."))
+        if summary['rejected_rows']:
+            logging.warning(f"{report['table']}: {summary['rejected_rows']} rejected rows.")
+        if summary['skewed']:
+            logging.warning(f"{report['table']}: slices are skewed, the largest holds "
+                            f"{summary['slice_skew']:.1f}x the mean, "
+                            f"{summary['idle_slices']} slices idle.")
+        if summary['straggler_files']:
+            logging.warning(f"{report['table']}: straggling files "
+                            f"{', '.join(summary['straggler_files'][:5])}")
+        if summary['straggler_slices']:
+            logging.warning(f"{report['table']}: straggling slices "
+                            f"{', '.join(map(str, summary['straggler_slices']))}")
+
+    def _save(self, report):
+        directory = os.path.join(self.directory, self.run_id or time.strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{report['table']}-{report['query_id']}.json")
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
+        logging.info(f"Load report written to {path}")
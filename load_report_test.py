@@ -0,0 +1,185 @@
+from data_generator import SparkifyDataGenerator
+from data_manager import ETLManager
+from data_manager_test import LocalTestCase
+from load_report import build_report
+from settings import settings
+from sql_queries import create_staging_table_queries
+import etl
+import glob
+import json
+import os
+import unittest
+
+FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName', 'length', 'level',
+          'location', 'method', 'page', 'registration', 'sessionId', 'song', 'status', 'ts',
+          'userAgent', 'userId']
+
+def event(ts, song='Hello'):
+    return {'artist': 'Adele', 'song': song, 'length': 295.5, 'page': 'NextSong', 'ts': ts,
+            'sessionId': 1, 'userId': 1, 'level': 'free', 'location': 'Berlin',
+            'userAgent': 'curl'}
+
+
+class StagingCopyTestCase(LocalTestCase):
+    """Copies log_data files written to the local data directory."""
+
+    def setUp(self):
+        super().setUp()
+        self.write('log_json_path.json', json.dumps(
+            {'jsonpaths': [f"$['{field}']" for field in FIELDS]}))
+        self.etl = ETLManager(self.db)
+        with self.db.connection() as (conn, cur):
+            for query in create_staging_table_queries:
+                cur.execute(query)
+            conn.commit()
+
+    def write(self, key, text):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def write_events(self, key, events):
+        self.write(f'log_data/{key}', '\n'.join(json.dumps(event) for event in events))
+
+    def staged_events(self):
+        with self.db.connection() as (conn, cur):
+            cur.execute("SELECT COUNT(*) FROM staging_events")
+            return cur.fetchone()[0]
+
+    def reports(self):
+        reports = []
+        for path in sorted(glob.glob(os.path.join(settings.LOAD_REPORT_DIR, '*', '*.json'))):
+            with open(path) as f:
+                reports.append(json.load(f))
+        return reports
+
+
+class BuildReportTest(unittest.TestCase):
+
+    def test_files_and_slices(self):
+        # slice, file, rows, bytes, loadtime in microseconds
+        scans = [(0, 'log_data/a.json', 100, 1000, 1000000),
+                 (1, 'log_data/b.json', 100, 1000, 1000000),
+                 (0, 'log_data/c.json', 300, 3000, 1000000)]
+        commits = [('log_data/b.json', 102, 2)]
+        errors = [(1, 'log_data/b.json', 7, 'ts', 1216, 'Invalid timestamp')]
+        report = build_report('staging_events', 42, scans, commits, errors, wall_seconds=2.0,
+                              slices=4)
+        summary = report['summary']
+        self.assertEqual((summary['files'], summary['rows'], summary['bytes']), (3, 500, 5000))
+        self.assertEqual(summary['rows_per_second'], 250)
+        self.assertEqual((summary['active_slices'], summary['idle_slices']), (2, 2))
+        # Slice 0 holds 4000 of 5000 bytes spread over 4 slices.
+        self.assertAlmostEqual(summary['slice_skew'], 3.2)
+        self.assertTrue(summary['skewed'])
+        self.assertEqual(summary['rejected_rows'], 2)
+        self.assertEqual(report['files']['log_data/b.json']['errors'], 2)
+        self.assertEqual(report['slices']['0']['files'], 2)
+        self.assertEqual(report['errors'], [{'slice': 1, 'file': 'log_data/b.json', 'line': 7,
+                                             'column': 'ts', 'code': 1216,
+                                             'reason': 'Invalid timestamp'}])
+
+    def test_stragglers(self):
+        scans = [(slice_id, f'song_data/{slice_id}.json', 10, 100, 1500000)
+                 for slice_id in range(4)]
+        scans.append((0, 'song_data/slow.json', 10, 100, 9000000))
+        summary = build_report('staging_songs', 1, scans, slices=4)['summary']
+        self.assertEqual(summary['straggler_files'], ['song_data/slow.json'])
+        self.assertEqual(summary['straggler_slices'], [0])
+        self.assertIsNone(summary['wall_seconds'])
+        self.assertIsNone(summary['mb_per_second'])
+
+    def test_fast_files_are_never_stragglers(self):
+        scans = [(0, 'a.json', 1, 10, 1000), (1, 'b.json', 1, 10, 100000)]
+        summary = build_report('staging_songs', 1, scans)['summary']
+        self.assertEqual((summary['straggler_files'], summary['straggler_slices']), ([], []))
+
+
+class StagingReportTest(StagingCopyTestCase):
+
+    def test_report_of_a_copy(self):
+        self.write_events('2018-11-01.json', [event(ts) for ts in range(5)])
+        self.write_events('2018-11-02.json', [event(ts) for ts in range(5, 8)])
+        summary = self.etl.copy_staging_events(incremental=False)
+        self.assertEqual((summary['files'], summary['rows'], summary['rejected_rows']), (2, 8, 0))
+        self.assertEqual(summary['active_slices'] + summary['idle_slices'], self.db.slices)
+        [report] = self.reports()
+        self.assertEqual(report['summary'], summary)
+        self.assertNotIn('failed', report)
+        self.assertEqual(sorted(os.path.basename(name) for name in report['files']),
+                         ['2018-11-01.json', '2018-11-02.json'])
+
+
+class LocalPipelineTest(LocalTestCase):
+    """Runs the whole pipeline of etl.main on generated data."""
+    options = {('ETL', 'backend'): 'local',
+               ('ETL', 'insert_mode'): 'upsert'}
+
+    def setUp(self):
+        super().setUp()
+        self.generated = SparkifyDataGenerator(n_users=10, n_songs=200, n_days=3).write(self.directory)
+
+    def count(self, table):
+        with self.db.connection() as (conn, cur):
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            return cur.fetchone()[0]
+
+    def test_run_and_rerun_a_step(self):
+        etl.main(destroy=False)
+        with open(settings.RUN_STATE_FILE) as f:
+            run = json.load(f)[-1]
+        self.assertEqual(run['status'], 'complete')
+        summaries = {name: run['steps'][name]['result']
+                     for name in ('copy_staging_events', 'copy_staging_songs')}
+        self.assertEqual(summaries['copy_staging_events']['rows'], self.generated['events'])
+        self.assertEqual(summaries['copy_staging_songs']['rows'], self.generated['songs'])
+        self.assertEqual(len(glob.glob(os.path.join(settings.LOAD_REPORT_DIR, '*', '*.json'))), 2)
+        songplays = self.count('songplays')
+        self.assertGreater(songplays, 0)
+
+        # Re-running the copy does not stage the songs twice.
+        etl.main(destroy=False, from_step='copy_staging_songs')
+        self.assertEqual(self.count('staging_songs'), self.generated['songs'])
+        self.assertEqual(self.count('songplays'), songplays)
+
+
+class FailedCopyTest(StagingCopyTestCase):
+
+    def test_failed_copy_saves_a_partial_report(self):
+        self.write_events('2018-11-01.json', [event(1000), event(2000)])
+        self.etl.copy_staging_events(incremental=False)
+        self.write_events('2018-11-02.json', [event(3000)])
+        self.write('log_data/2018-11-03.json', json.dumps(event(4000)) + '\n{"ts": 5000,')
+        with self.assertRaises(ValueError):
+            self.etl.copy_staging_events(incremental=False)
+        # The staging rows of the first load are back after the rollback.
+        self.assertEqual(self.staged_events(), 2)
+        report = self.reports()[-1]
+        self.assertTrue(report['failed'])
+        self.assertEqual(report['table'], 'staging_events')
+        self.assertEqual(len(report['errors']), 1)
+        error = report['errors'][0]
+        self.assertTrue(error['file'].endswith('2018-11-03.json'))
+        self.assertEqual(error['line'], 2)
+
+    def test_unloadable_record(self):
+        self.write_events('2018-11-01.json', [event(1000), event(2000, song={'title': 'Hello'})])
+        with self.assertRaises(Exception):
+            self.etl.copy_staging_events(incremental=False)
+        self.assertEqual(self.staged_events(), 0)
+        [report] = self.reports()
+        self.assertEqual(report['errors'][0]['line'], 2)
+
+    def test_each_failure_is_reported_once(self):
+        self.write('log_data/2018-11-01.json', '{')
+        with self.db.connection() as (conn, cur):
+            with self.assertRaises(ValueError):
+                self.etl.load_reporter.copy(cur, 'staging_events', "COPY staging_events FROM "
+                                            "'s3://bucket/log_data' JSON 'auto'")
+            # A later failure on the same session without load errors of its own.
+            self.assertIsNone(self.etl.load_reporter.report_failure(cur, 'staging_events'))
+        self.assertEqual(len(self.reports()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from get_sparkify_data import S3Loader, S3Manifest
+
+logging.basicConfig(level=logging.INFO)
+
+# Serializes updates of state files: the staging COPYs run concurrently and
+# each marks its own source loaded in the same file.
+_state_lock = threading.Lock()
+
+def parse_s3_url(url):
+    """
+    Splits "'s3://bucket/some/prefix'" (quotes optional, as stored in
+    dwh.cfg) into ('bucket', 'some/prefix').
+    """
+    url = url.strip().strip("'\"")
+    if not url.startswith('s3://'):
+        raise ValueError(f"Not an S3 url: {url}")
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+class LoadStateManager():
+    """
+    Tracks which S3 objects have already been loaded into the staging tables
+    and writes COPY manifests that only contain the objects not loaded yet.
+    The S3 listing of every source is kept in a listing manifest next to
+    the state file and only brought up to date on each run.
+
+    ...
+
+    Attributes
+    ----------
+    state_path : str
+        local JSON file with the load high-water mark per source prefix
+    manifest_prefix : str
+        s3://bucket/prefix under which generated COPY manifests are uploaded
+    s3_client : boto3 S3 client
+        used both for listing sources and uploading manifests
+    """
+    def __init__(self, state_path, manifest_prefix, s3_client=None):
+        self.state_path = state_path
+        self.manifest_prefix = manifest_prefix
+        self.s3_loader = S3Loader(s3_client=s3_client)
+        self.s3_client = self.s3_loader.s3_client
+        self.state = self._read()
+
+    def pending_objects(self, source_url, append_only=False):
+        """
+        Returns the objects under source_url that have not been loaded yet
+        or whose ETag changed since they were loaded.
+
+        With append_only=True the listing only fetches keys after the last
+        key listed per shard, which is correct for sources where new keys
+        always sort last (log_data is named by date). Otherwise the source
+        is re-listed shard by shard.
+        """
+        bucket, prefix = parse_s3_url(source_url)
+        loaded = self.state.get(self._source_key(source_url), {})
+        listing_path = self.listing_path(source_url)
+        for _ in self.s3_loader.sync_manifest(bucket, prefix, listing_path,
+                                              append_only=append_only):
+            pass
+        listing = S3Manifest(listing_path, bucket, prefix)
+        pending = [{'Key': key, 'Size': entry['size'], 'ETag': entry['etag']}
+                   for key, entry in sorted(listing.objects.items())
+                   if not key.endswith('/') and loaded.get(key) != entry['etag']]
+        logging.info(f"{len(pending)} new objects to load from {bucket}/{prefix}.")
+        return pending
+
+    def listing_path(self, source_url):
+        """Local listing manifest of a source, next to the state file."""
+        digest = hashlib.sha1(self._source_key(source_url).encode('utf-8')).hexdigest()[:12]
+        return f"{os.path.splitext(self.state_path)[0]}-{digest}.listing.json"
+
+    def write_copy_manifest(self, source_url, objects, name):
+        """
+        Uploads a Redshift COPY manifest listing `objects` and returns its
+        s3:// url.
+        """
+        bucket, _ = parse_s3_url(source_url)
+        manifest = {'entries': [
+            {'url': f"s3://{bucket}/{obj['Key']}", 'mandatory': True}
+            for obj in objects]}
+        manifest_bucket, manifest_prefix = parse_s3_url(self.manifest_prefix)
+        key = f"{manifest_prefix.rstrip('/')}/{name}-{int(time.time())}.manifest".lstrip('/')
+        self.s3_client.put_object(Bucket=manifest_bucket, Key=key,
+                                  Body=json.dumps(manifest).encode('utf-8'))
+        logging.info(f"Wrote COPY manifest with {len(objects)} entries to s3://{manifest_bucket}/{key}")
+        return f"s3://{manifest_bucket}/{key}"
+
+    def mark_loaded(self, source_url, objects):
+        """
+        Records objects as loaded. Call only after the COPY has committed.
+        The file is re-read first, so sources marked loaded meanwhile by
+        another manager are kept.
+        """
+        with _state_lock:
+            self.state = self._read()
+            loaded = self.state.setdefault(self._source_key(source_url), {})
+            for obj in objects:
+                loaded[obj['Key']] = obj.get('ETag', '').strip('"')
+            tmp_path = f"{self.state_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.state_path)
+
+    def prune_manifests(self, name):
+        """
+        Deletes every COPY manifest written for `name`. Call once the
+        objects they list are marked loaded; manifests left behind by failed
+        runs are removed as well.
+        """
+        manifest_bucket, manifest_prefix = parse_s3_url(self.manifest_prefix)
+        prefix = f"{manifest_prefix.rstrip('/')}/{name}-".lstrip('/')
+        keys = [obj['Key'] for obj in self.s3_loader.iter_s3_objects(manifest_bucket, prefix)
+                if obj['Key'].endswith('.manifest')]
+        for i in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(Bucket=manifest_bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + 1000]], 'Quiet': True})
+        if keys:
+            logging.info(f"Pruned {len(keys)} COPY manifests of {name}.")
+
+    def reset(self):
+        """
+        Forgets every loaded object, e.g. after the tables were recreated
+        empty, so the next load copies the full history again.
+        """
+        with _state_lock:
+            self.state = {}
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+
+    def _read(self):
+        if not os.path.exists(self.state_path):
+            return {}
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _source_key(self, source_url):
+        return 's3://{}/{}'.format(*parse_s3_url(source_url))
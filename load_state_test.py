@@ -0,0 +1,104 @@
+from load_state import LoadStateManager, parse_s3_url
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+SOURCE = "'s3://sparkify-src/log_data'"
+SONGS = "'s3://sparkify-src/song_data'"
+MANIFESTS = 's3://sparkify-manifests/manifests/'
+
+class LoadStateTest(unittest.TestCase):
+
+    def setUp(self):
+        from moto import mock_aws
+        import boto3
+        self.mock_aws = mock_aws()
+        self.mock_aws.start()
+        self.directory = tempfile.mkdtemp()
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        for bucket in ('sparkify-src', 'sparkify-manifests'):
+            self.s3.create_bucket(Bucket=bucket)
+        for day in range(1, 4):
+            self.put(f'log_data/2018/11/2018-11-0{day}-events.json', b'{}')
+        self.put('song_data/A/song.json', b'{}')
+        self.state_path = os.path.join(self.directory, 'load_state.json')
+
+    def tearDown(self):
+        self.mock_aws.stop()
+        shutil.rmtree(self.directory)
+
+    def put(self, key, body):
+        self.s3.put_object(Bucket='sparkify-src', Key=key, Body=body)
+
+    def manager(self):
+        return LoadStateManager(self.state_path, MANIFESTS, s3_client=self.s3)
+
+    def keys(self, objects):
+        return [obj['Key'] for obj in objects]
+
+    def test_parse_s3_url(self):
+        self.assertEqual(parse_s3_url(SOURCE), ('sparkify-src', 'log_data'))
+        self.assertEqual(parse_s3_url('s3://bucket'), ('bucket', ''))
+        with self.assertRaises(ValueError):
+            parse_s3_url('/local/log_data')
+
+    def test_only_new_and_changed_objects_are_pending(self):
+        manager = self.manager()
+        pending = manager.pending_objects(SOURCE, append_only=True)
+        self.assertEqual(len(pending), 3)
+        manager.mark_loaded(SOURCE, pending)
+        self.assertEqual(manager.pending_objects(SOURCE, append_only=True), [])
+        self.put('log_data/2018/11/2018-11-04-events.json', b'{}')
+        self.assertEqual(self.keys(self.manager().pending_objects(SOURCE, append_only=True)),
+                         ['log_data/2018/11/2018-11-04-events.json'])
+        self.put('log_data/2018/11/2018-11-01-events.json', b'{"changed": 1}')
+        self.assertEqual(self.keys(self.manager().pending_objects(SOURCE)),
+                         ['log_data/2018/11/2018-11-01-events.json',
+                          'log_data/2018/11/2018-11-04-events.json'])
+
+    def test_mark_loaded_keeps_other_sources(self):
+        events, songs = self.manager(), self.manager()
+        event_objects = events.pending_objects(SOURCE)
+        song_objects = songs.pending_objects(SONGS)
+        events.mark_loaded(SOURCE, event_objects)
+        songs.mark_loaded(SONGS, song_objects)
+        with open(self.state_path) as f:
+            state = json.load(f)
+        self.assertEqual(sorted(state), ['s3://sparkify-src/log_data', 's3://sparkify-src/song_data'])
+        self.assertEqual(self.manager().pending_objects(SOURCE), [])
+
+    def test_copy_manifest(self):
+        manager = self.manager()
+        objects = manager.pending_objects(SOURCE)
+        url = manager.write_copy_manifest(SOURCE, objects, 'staging_events')
+        bucket, key = parse_s3_url(url)
+        manifest = json.loads(self.s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+        self.assertEqual(manifest['entries'][0],
+                         {'url': 's3://sparkify-src/log_data/2018/11/2018-11-01-events.json',
+                          'mandatory': True})
+        self.assertEqual(len(manifest['entries']), 3)
+
+    def test_prune_manifests(self):
+        manager = self.manager()
+        objects = manager.pending_objects(SOURCE)
+        manager.write_copy_manifest(SOURCE, objects, 'staging_events')
+        self.s3.put_object(Bucket='sparkify-manifests', Key='manifests/staging_events-1.manifest',
+                           Body=b'{}')
+        manager.write_copy_manifest(SONGS, manager.pending_objects(SONGS), 'staging_songs')
+        manager.prune_manifests('staging_events')
+        keys = [obj['Key'] for obj in
+                self.s3.list_objects_v2(Bucket='sparkify-manifests').get('Contents', [])]
+        self.assertEqual(len(keys), 1)
+        self.assertTrue(keys[0].startswith('manifests/staging_songs-'))
+
+    def test_reset(self):
+        manager = self.manager()
+        manager.mark_loaded(SOURCE, manager.pending_objects(SOURCE))
+        manager.reset()
+        self.assertFalse(os.path.exists(self.state_path))
+        self.assertEqual(len(self.manager().pending_objects(SOURCE)), 3)
+
+if __name__ == "__main__":
+    unittest.main()
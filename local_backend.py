@@ -0,0 +1,346 @@
+import hashlib
+import itertools
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from compaction import iter_json_records, _read_local
+from dialect import to_sqlite, parse_copy, jsonpath_fields
+from instrumentation import InstrumentedCursor, StatementRecorder
+from settings import get_settings
+
+logging.basicConfig(level=logging.INFO)
+
+_CREATE_PROCEDURE = re.compile(r'^\s*CREATE\s+(?:OR\s+REPLACE\s+)?PROCEDURE\s+(\w+)\s*\(([^)]*)\)'
+                               r'\s*AS\s+\$\$\s*BEGIN\b(.*)\bEND\s*;\s*\$\$', re.I | re.S)
+_CALL = re.compile(r'^\s*CALL\s+(\w+)\s*\(([^)]*)\)', re.I)
+
+# Stand-ins for the Redshift system tables the load reports read.
+system_tables = [
+    "CREATE TABLE IF NOT EXISTS stv_slices (slice INTEGER)",
+    "CREATE TABLE IF NOT EXISTS stl_file_scan (query INTEGER, slice INTEGER, name TEXT, "
+    "lines INTEGER, bytes INTEGER, loadtime INTEGER)",
+    "CREATE TABLE IF NOT EXISTS stl_load_commits (query INTEGER, slice INTEGER, filename TEXT, "
+    "lines_scanned INTEGER, errors INTEGER, status INTEGER)",
+    "CREATE TABLE IF NOT EXISTS stl_load_errors (query INTEGER, slice INTEGER, filename TEXT, "
+    "line_number INTEGER, colname TEXT, err_code INTEGER, err_reason TEXT, session INTEGER)",
+]
+
+_FAILED_COLUMN = re.compile(r'constraint failed: \w+\.(\w+)')
+
+def fnv_hash(value):
+    """64-bit FNV-1a hash of the text of `value`, as a signed BIGINT."""
+    if value is None:
+        return None
+    result = 0xcbf29ce484222325
+    for byte in str(value).encode('utf-8'):
+        result = ((result ^ byte) * 0x100000001b3) & 0xffffffffffffffff
+    return result - (1 << 64) if result >= (1 << 63) else result
+
+def md5(value):
+    return None if value is None else hashlib.md5(str(value).encode('utf-8')).hexdigest()
+
+def split_statements(body):
+    """Splits a procedure body on the semicolons outside string literals."""
+    statements, current, quoted = [], [], False
+    for char in body:
+        if char == "'":
+            quoted = not quoted
+        if char == ';' and not quoted:
+            statements.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    statements.append(''.join(current))
+    return [statement for statement in statements if statement.strip()]
+
+
+def local_files(data_dir, url):
+    """
+    Files below `data_dir` standing in for the S3 objects under `url`,
+    sorted by key: s3://<bucket>/<key> maps to <data_dir>/<key>.
+    """
+    url = url.strip().strip("'")
+    if url.startswith('s3://'):
+        url = os.path.join(data_dir, url[len('s3://'):].partition('/')[2])
+    if os.path.isfile(url):
+        return [url]
+    directory, prefix = os.path.split(url)
+    paths = []
+    for root, _, files in os.walk(directory or '.'):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.relpath(path, directory or '.').startswith(prefix):
+                paths.append(path)
+    if not paths:
+        raise FileNotFoundError(f"No local files for {url}")
+    return sorted(paths)
+
+
+class LocalCursor():
+    """
+    DB-API cursor for LocalConnectionManager. Statements from sql_queries
+    are translated to SQLite; COPY reads JSON files below the data
+    directory, and CREATE PROCEDURE/CALL run the procedure body statement
+    by statement.
+
+    ...
+
+    Attributes
+    ----------
+    connection : sqlite3.Connection
+        connection the statements run on
+    backend : LocalConnectionManager
+        holds the data directory and the created procedures
+    """
+    def __init__(self, connection, backend):
+        self.connection = connection
+        self.backend = backend
+        self.cursor = connection.cursor()
+        self.rowcount = -1
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, query, vars=None):
+        if parse_copy(query):
+            self.rowcount = self._copy(query)
+        elif _CREATE_PROCEDURE.match(query):
+            self._create_procedure(query)
+            self.rowcount = -1
+        elif _CALL.match(query):
+            self._call(query)
+            self.rowcount = -1
+        else:
+            query = to_sqlite(query).replace('%s', '?')
+            self.cursor.execute(query, vars or ())
+            self.rowcount = self.cursor.rowcount
+        return self
+
+    def _create_procedure(self, query):
+        name, params, body = _CREATE_PROCEDURE.match(query).groups()
+        params = [param.split()[0] for param in params.split(',') if param.strip()]
+        with self.backend._lock:
+            self.backend.procedures[name.lower()] = (params, split_statements(body))
+
+    def _call(self, query):
+        name, args = _CALL.match(query).groups()
+        with self.backend._lock:
+            params, statements = self.backend.procedures[name.lower()]
+        args = [arg.strip() for arg in args.split(',') if arg.strip()]
+        for statement in statements:
+            for param, arg in zip(params, args):
+                statement = re.sub(rf'\b{param}\b', arg, statement)
+            self.cursor.execute(to_sqlite(statement))
+
+    def _copy(self, query):
+        """Loads every JSON record below the mapped source into the table."""
+        table, source, jsonpaths = parse_copy(query)
+        paths = self.backend.local_files(source)
+        columns = [row[1] for row in self.cursor.execute(f"PRAGMA table_info({table})")]
+        if jsonpaths:
+            fields = jsonpath_fields(next(iter_json_records(_read_local(
+                self.backend.local_files(jsonpaths)[0]))))
+        else:
+            fields = columns
+        insert = (f"INSERT INTO {table} ({', '.join(columns[:len(fields)])}) "
+                  f"VALUES ({', '.join('?' * len(fields))})")
+        # Files are spread over the slices like Redshift does, and every
+        # file is logged to the system tables under the COPY's query id.
+        query_id = self.backend.next_copy_id()
+        rows = 0
+        for number, path in enumerate(paths):
+            start_time = time.perf_counter()
+            slice_id = number % self.backend.slices
+            records = []
+            try:
+                records = [[record.get(field) for field in fields]
+                           for record in iter_json_records(_read_local(path))]
+                self.cursor.executemany(insert, records)
+            except (sqlite3.Error, ValueError) as e:
+                self._abort_copy(query_id, slice_id, path, insert, records, e)
+                raise
+            loadtime = int((time.perf_counter() - start_time) * 1e6)
+            self.cursor.execute("INSERT INTO stl_file_scan VALUES (?, ?, ?, ?, ?, ?)",
+                (query_id, slice_id, path[:90], len(records), os.path.getsize(path), loadtime))
+            self.cursor.execute("INSERT INTO stl_load_commits VALUES (?, ?, ?, ?, 0, 1)",
+                (query_id, slice_id, path, len(records)))
+            rows += len(records)
+        self.backend._local.last_copy_id = query_id
+        return rows
+
+    def _abort_copy(self, query_id, slice_id, path, insert, records, error):
+        """
+        Fails the COPY like Redshift does: the transaction is rolled back
+        and the error is kept in stl_load_errors under this session.
+        """
+        self.connection.rollback()
+        # JSON errors carry their line, rows that do not insert are searched.
+        line_number = getattr(error, 'lineno', None)
+        for number, record in enumerate(records, 1):
+            try:
+                self.cursor.execute(insert, record)
+            except sqlite3.Error:
+                line_number = number
+                break
+        self.connection.rollback()
+        column = _FAILED_COLUMN.search(str(error))
+        self.cursor.execute("INSERT INTO stl_load_errors VALUES (?, ?, ?, ?, ?, ?, ?, pg_backend_pid())",
+            (query_id, slice_id, path, line_number, column.group(1) if column else None,
+             getattr(error, 'sqlite_errorcode', 0), str(error)))
+        self.connection.commit()
+
+
+class LocalConnectionManager():
+    """
+    In-process stand-in for ConnectionManager that runs the pipeline on a
+    SQLite database, reading S3 sources from a local directory, e.g. one
+    written by data_generator.py. s3://<bucket>/<key> maps to
+    <data_dir>/<key>. No cluster, role or network access is needed.
+
+    ...
+
+    Attributes
+    ----------
+    database : str
+        SQLite database file (shared by all connections)
+    data_dir : str
+        local directory standing in for the S3 buckets
+    procedures : dict
+        procedure name -> (parameters, statements) created so far
+    slices : int
+        slices the files of a COPY are spread over in the load reports
+    recorder : StatementRecorder
+        receives timing and rowcount of every statement run
+        through connection()
+    """
+    needs_cluster = False
+
+    def __init__(self, config_path='dwh.cfg', **overrides):
+        settings = get_settings(config_path)
+
+        self.database = settings.LOCAL_DATABASE
+        self.data_dir = settings.LOCAL_DATA_DIR
+        self.timeout  = settings.LOCAL_TIMEOUT
+        self.slices   = settings.LOCAL_SLICES
+        self.recorder = StatementRecorder.from_config(settings.config)
+        self.recorder.fetch_query_id = False
+
+        for key, value in overrides.items():
+            setattr(self, key, value)
+
+        self.procedures = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._copy_id = None
+        self._sessions = itertools.count(1)
+        with self.connection() as (conn, cur):
+            cur.execute("PRAGMA journal_mode=WAL")
+            for query in system_tables:
+                cur.execute(query)
+            # Databases created before stl_load_errors had a session column.
+            cur.execute("PRAGMA table_info(stl_load_errors)")
+            if 'session' not in [row[1] for row in cur.fetchall()]:
+                cur.execute("ALTER TABLE stl_load_errors ADD COLUMN session INTEGER")
+            cur.execute("DELETE FROM stv_slices")
+            cur.executemany("INSERT INTO stv_slices VALUES (?)",
+                            [(slice_id,) for slice_id in range(self.slices)])
+            conn.commit()
+        logging.info(f"Using local database {self.database}.")
+
+    def local_files(self, url):
+        """Files standing in for the S3 objects under `url`, sorted by key."""
+        return local_files(self.data_dir, url)
+
+    def next_copy_id(self):
+        """Query id for the next local COPY, unique within the database."""
+        with self._lock:
+            if self._copy_id is None:
+                conn = sqlite3.connect(self.database, timeout=self.timeout)
+                try:
+                    self._copy_id = conn.execute(
+                        "SELECT COALESCE(MAX(query), 0) FROM stl_load_commits").fetchone()[0]
+                finally:
+                    conn.close()
+            self._copy_id += 1
+            return self._copy_id
+
+    def getconn(self):
+        # Writers take the lock when their transaction starts, so concurrent
+        # pipeline steps wait for each other instead of failing to upgrade.
+        conn = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False,
+                               isolation_level='IMMEDIATE')
+        conn.create_function('fnv_hash', 1, fnv_hash, deterministic=True)
+        conn.create_function('md5', 1, md5, deterministic=True)
+        conn.create_function('pg_last_copy_id', 0,
+                             lambda: getattr(self._local, 'last_copy_id', -1))
+        session = next(self._sessions)
+        conn.create_function('pg_backend_pid', 0, lambda: session)
+        conn.set_progress_handler(self._past_deadline, 10000)
+        return conn
+
+    def _past_deadline(self):
+        # A true return value makes SQLite abort the running statement.
+        deadline = getattr(self._local, 'deadline', None)
+        return deadline is not None and time.monotonic() >= deadline
+
+    def with_deadline(self, func, seconds):
+        """
+        Wraps `func` so that statements it runs are interrupted once
+        `seconds` have passed. Returns `func` unchanged if there is no deadline.
+        """
+        if not seconds:
+            return func
+        return self._run_until(func, lambda: time.monotonic() + seconds)
+
+    def with_current_deadline(self, func):
+        """
+        Wraps `func` so that, run on a worker thread, its statements are
+        interrupted at the deadline of the calling thread. Returns `func`
+        unchanged if the calling thread has no deadline.
+        """
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return func
+        return self._run_until(func, lambda: deadline)
+
+    def _run_until(self, func, deadline):
+        def run_with_deadline():
+            previous = getattr(self._local, 'deadline', None)
+            self._local.deadline = deadline()
+            try:
+                return func()
+            finally:
+                self._local.deadline = previous
+        return run_with_deadline
+
+    def putconn(self, conn, close=False):
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        Opens a connection and cursor for the duration of a with block.
+        Uncommitted work is rolled back if the block raises.
+        """
+        conn = self.getconn()
+        cur = InstrumentedCursor(LocalCursor(conn, self), self.recorder)
+        try:
+            yield conn, cur
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.putconn(conn)
+
+    def close(self):
+        """Writes the metrics file; connections are closed after every use."""
+        self.recorder.write_prometheus()
+        logging.info("Local database closed.")
@@ -1,13 +1,12 @@
-import configparser
 import logging
+from db_connection import backend_from_config
+from table_design import TableDesignAdvisor, parse_create_table
 from sql_queries import create_staging_table_queries, drop_staging_table_queries, \
     create_analytical_table_queries, drop_analytical_table_queries
+from settings import settings
     
 logging.basicConfig(level=logging.INFO)
 
-config = configparser.ConfigParser()
-config.read_file(open('dwh.cfg'))
-
 class RedshiftManager():
     """
     Helper class for creating and dropping Redshift tables.
@@ -16,46 +15,75 @@ class RedshiftManager():
 
     Attributes
     ----------
-    conn : psycopg2 connection
-        an object representing the connection to the database
-    cur : psycopg2 cursor
-        an object representing the database cursor
+    db : ConnectionManager or LocalConnectionManager
+        pool from which every method borrows its own connection
     """
-    def __init__(self, conn, cur):
-        self.conn = conn
-        self.cur = cur
-                        
+    def __init__(self, db):
+        self.db = db
+
     def drop_staging_tables(self):
         """Drops all staging tables."""
         logging.info("Dropping staging tables...")
-        for query in drop_staging_table_queries:
-            self.cur.execute(query)
-            self.conn.commit()
+        self._execute_all(drop_staging_table_queries)
 
     def drop_analytical_tables(self):
         """Drops all analytical tables."""
         logging.info("Dropping analytical tables...")
-        for query in drop_analytical_table_queries:
-            self.cur.execute(query)
-            self.conn.commit()
+        self._execute_all(drop_analytical_table_queries)
 
-    def create_staging_tables(self):
-        """Creates all staging tables."""
+    def create_staging_tables(self, advised=None):
+        """
+        Creates all staging tables. With advised=True (or TABLE_DESIGN =
+        advised in dwh.cfg) explicit distribution and sort keys are used.
+        """
         logging.info("Creating staging tables...")
-        for query in create_staging_table_queries:
-            self.cur.execute(query)
-            self.conn.commit()
+        self._execute_all(self._table_ddl(create_staging_table_queries, advised))
             
-    def create_analytical_tables(self):
-        """Drops all staging tables."""
+    def create_analytical_tables(self, advised=None):
+        """
+        Creates all analytical tables. With advised=True (or TABLE_DESIGN =
+        advised in dwh.cfg) explicit distribution and sort keys are used.
+        """
         logging.info("Creating analytical tables...")
-        for query in create_analytical_table_queries:
-            self.cur.execute(query)
-            self.conn.commit()
+        self._execute_all(self._table_ddl(create_analytical_table_queries, advised))
+
+    def advise_table_design(self):
+        """
+        Returns a TableDesignAdvisor using the cluster's table sizes and
+        recent redistribution costs, or only the SQL if those are unavailable.
+        """
+        try:
+            return TableDesignAdvisor.from_redshift(self.db)
+        except Exception as e:
+            logging.warning(f"Could not read table statistics, advising from SQL only. Error: {e}")
+            return TableDesignAdvisor()
+
+    def apply_table_design(self, advisor=None):
+        """Changes the distribution and sort keys of existing tables in place."""
+        advisor = advisor or self.advise_table_design()
+        for table, choice in advisor.analyze().items():
+            logging.info(f"{table}: {choice['diststyle']} {choice['distkey'] or ''} "
+                         f"sortkey {choice['sortkey']} ({choice['reason']})")
+        self._execute_all(advisor.alter_statements())
+
+    def _table_ddl(self, queries, advised):
+        if advised is None:
+            advised = settings.TABLE_DESIGN == 'advised'
+        if not advised:
+            return queries
+        ddl = self.advise_table_design().ddl()
+        return [ddl.get(parse_create_table(query)[0], query) for query in queries]
+
+    def _execute_all(self, queries):
+        """Runs each query in its own transaction on a pooled connection."""
+        with self.db.connection() as (conn, cur):
+            for query in queries:
+                cur.execute(query)
+                conn.commit()
 
 
 def main():
-    redshift = RedshiftManager()
+    redshift = RedshiftManager(backend_from_config()())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,249 @@
+import datetime
+import decimal
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO)
+
+def _rows(rows):
+    """Rows as a list of tuples, the shape every cache hit returns."""
+    return [tuple(row) for row in rows]
+
+def _encode(value):
+    # Types psycopg2 returns that JSON has no equivalent for are tagged, so
+    # a disk hit returns the same values as a memory hit. Anything else
+    # cannot round-trip and is not written to disk at all.
+    if isinstance(value, decimal.Decimal):
+        return {'__decimal__': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {'__time__': value.isoformat()}
+    if isinstance(value, datetime.timedelta):
+        return {'__timedelta__': value.total_seconds()}
+    raise TypeError(f"Cannot cache a {type(value).__name__} on disk")
+
+def _decode(obj):
+    if '__decimal__' in obj:
+        return decimal.Decimal(obj['__decimal__'])
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    if '__date__' in obj:
+        return datetime.date.fromisoformat(obj['__date__'])
+    if '__time__' in obj:
+        return datetime.time.fromisoformat(obj['__time__'])
+    if '__timedelta__' in obj:
+        return datetime.timedelta(seconds=obj['__timedelta__'])
+    return obj
+
+class ResultCache():
+    """
+    Caches the rows returned by read queries, keyed by query text,
+    parameters and load generation. Entries live in an in-memory LRU and,
+    with `directory` set, in JSON files that other processes share.
+
+    Every committed load calls invalidate(), which starts a new load
+    generation. Entries of older generations are never returned. With a
+    directory the generation is kept in a file next to the entries, so a
+    load in one process invalidates the cache of every other process.
+
+    ...
+
+    Attributes
+    ----------
+    max_entries : int
+        entries kept in memory before the least recently used is evicted
+    directory : str
+        folder for the on-disk store (None keeps the cache in memory only)
+    ttl : float
+        seconds an entry stays valid, in memory and on disk (None never
+        expires)
+    """
+    def __init__(self, max_entries=128, directory=None, ttl=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.counters = {'hits': 0, 'disk_hits': 0, 'misses': 0,
+                         'hit_seconds': 0.0, 'miss_seconds': 0.0, 'invalidations': 0}
+        self._generation = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds a cache from the [CACHE] section of dwh.cfg, or returns None
+        if it is disabled.
+        """
+        if not config.getboolean('CACHE', 'ENABLED', fallback=False):
+            return None
+        ttl = config.getfloat('CACHE', 'TTL', fallback=0)
+        return cls(max_entries=config.getint('CACHE', 'MAX_ENTRIES', fallback=128),
+                   directory=config.get('CACHE', 'DIRECTORY', fallback='') or None,
+                   ttl=ttl or None)
+
+    @property
+    def generation(self):
+        """Current load generation."""
+        if not self.directory:
+            return self._generation
+        try:
+            with open(self._generation_path()) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _generation_path(self):
+        return os.path.join(self.directory, 'generation')
+
+    @contextmanager
+    def _generation_lock(self):
+        """
+        Holds an exclusive lock on the generation across threads and, with
+        a directory, across processes sharing it.
+        """
+        with self._lock:
+            if not self.directory:
+                yield
+                return
+            with open(f"{self._generation_path()}.lock", 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def key(self, query, params=None, generation=None):
+        generation = self.generation if generation is None else generation
+        text = json.dumps([' '.join(query.split()), params, generation], default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_or_load(self, query, load, params=None):
+        """
+        Returns the cached rows for `query`, or calls `load()` and caches
+        its result under the generation current when the lookup started.
+        """
+        start_time = time.time()
+        key = self.key(query, params)
+        rows, source = self._lookup(key)
+        if source:
+            self._count('disk_hits' if source == 'disk' else 'hits', 'hit_seconds', start_time)
+            return rows
+        rows = _rows(load())
+        with self._lock:
+            self._remember(key, rows)
+        if self.directory:
+            self._write(key, rows)
+        self._count('misses', 'miss_seconds', start_time)
+        return rows
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self.entries:
+                created, rows = self.entries[key]
+                if not self._expired(created):
+                    self.entries.move_to_end(key)
+                    return rows, 'memory'
+                del self.entries[key]
+        if self.directory:
+            entry = self._read(key)
+            if entry is not None:
+                created, rows = entry
+                with self._lock:
+                    self._remember(key, rows, created)
+                return rows, 'disk'
+        return None, None
+
+    def _expired(self, created):
+        return bool(self.ttl) and time.time() - created > self.ttl
+
+    def _remember(self, key, rows, created=None):
+        self.entries[key] = (time.time() if created is None else created, rows)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read(self, key):
+        # Another thread or process may invalidate the entry at any point,
+        # which only makes this lookup a miss.
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            with open(path) as f:
+                entry = json.load(f, object_hook=_decode)
+        except (OSError, ValueError):
+            return None
+        if self._expired(entry['created']):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry['created'], _rows(entry['rows'])
+
+    def _write(self, key, rows):
+        path = os.path.join(self.directory, f"{key}.json")
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'created': time.time(), 'rows': rows}, f, default=_encode)
+        except TypeError as e:
+            # Only kept in memory, where the rows are the loaded objects.
+            logging.debug(f"Result not cached on disk: {e}")
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+
+    def _count(self, counter, seconds, start_time):
+        with self._lock:
+            self.counters[counter] += 1
+            self.counters[seconds] += time.time() - start_time
+
+    def invalidate(self):
+        """
+        Starts a new load generation and drops every cached entry. The
+        generation file is re-read and replaced under a file lock, so
+        concurrent loads in other processes never share a generation.
+        """
+        with self._generation_lock():
+            self.entries.clear()
+            self._generation += 1
+            self.counters['invalidations'] += 1
+            if self.directory:
+                generation = self.generation + 1
+                tmp_path = f"{self._generation_path()}.{os.getpid()}-{threading.get_ident()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    f.write(str(generation))
+                os.replace(tmp_path, self._generation_path())
+                for name in os.listdir(self.directory):
+                    if name.endswith('.json'):
+                        try:
+                            os.remove(os.path.join(self.directory, name))
+                        except FileNotFoundError:
+                            pass
+
+    def stats(self):
+        """Hit/miss counts, hit ratio and mean lookup latency in seconds."""
+        with self._lock:
+            counters = dict(self.counters)
+        hits = counters['hits'] + counters['disk_hits']
+        lookups = hits + counters['misses']
+        return {
+            **counters,
+            'generation': self.generation,
+            'entries': len(self.entries),
+            'hit_ratio': hits / lookups if lookups else 0.0,
+            'mean_hit_seconds': counters['hit_seconds'] / hits if hits else 0.0,
+            'mean_miss_seconds': counters['miss_seconds'] / counters['misses']
+                                 if counters['misses'] else 0.0,
+        }
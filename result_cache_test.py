@@ -0,0 +1,78 @@
+import datetime
+import decimal
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from result_cache import ResultCache
+
+def _invalidate(directory, times):
+    cache = ResultCache(directory=directory)
+    for _ in range(times):
+        cache.invalidate()
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory_hit_expires(self):
+        cache = ResultCache(ttl=60)
+        loads = []
+        load = lambda: loads.append(1) or [(1,)]
+        with mock.patch('result_cache.time.time', return_value=1000.0):
+            cache.get_or_load('SELECT 1', load)
+            cache.get_or_load('SELECT 1', load)
+        self.assertEqual(len(loads), 1)
+        with mock.patch('result_cache.time.time', return_value=1061.0):
+            self.assertEqual(cache.get_or_load('SELECT 1', load), [(1,)])
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(cache.counters['hits'], 1)
+
+    def test_disk_hit_keeps_created_time(self):
+        with mock.patch('result_cache.time.time', return_value=1000.0):
+            ResultCache(directory=self.directory, ttl=60).get_or_load('SELECT 1', lambda: [(1,)])
+        cache = ResultCache(directory=self.directory, ttl=60)
+        with mock.patch('result_cache.time.time', return_value=1030.0):
+            cache.get_or_load('SELECT 1', lambda: [(2,)])
+        # Expires 60 seconds after the other process loaded it, not after
+        # this one read it from disk.
+        with mock.patch('result_cache.time.time', return_value=1061.0):
+            self.assertEqual(cache.get_or_load('SELECT 1', lambda: [(2,)]), [(2,)])
+        self.assertEqual(cache.counters['disk_hits'], 1)
+
+    def test_round_trip(self):
+        row = (decimal.Decimal('1.50'), datetime.datetime(2018, 11, 1, 21, 1, 46),
+               datetime.date(2018, 11, 1), datetime.time(21, 1), datetime.timedelta(seconds=90),
+               'Hello', 3, 2.5, None, True)
+        ResultCache(directory=self.directory).get_or_load('SELECT row', lambda: [row])
+        cache = ResultCache(directory=self.directory)
+        self.assertEqual(cache.get_or_load('SELECT row', lambda: []), [row])
+        self.assertEqual(cache.counters['disk_hits'], 1)
+
+    def test_unencodable_rows_stay_in_memory(self):
+        row = (b'bytes', 1)
+        cache = ResultCache(directory=self.directory)
+        self.assertEqual(cache.get_or_load('SELECT bytes', lambda: [row]), [row])
+        self.assertEqual(cache.get_or_load('SELECT bytes', lambda: []), [row])
+        self.assertEqual(os.listdir(self.directory), [])
+        other = ResultCache(directory=self.directory)
+        self.assertEqual(other.get_or_load('SELECT bytes', lambda: []), [])
+
+    def test_invalidate_across_processes(self):
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=_invalidate, args=(self.directory, 25))
+                     for _ in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(ResultCache(directory=self.directory).generation, 100)
+
+if __name__ == "__main__":
+    unittest.main()
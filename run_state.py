@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+# Runs kept in the state file; older ones are dropped when a run starts.
+MAX_RUNS = 20
+
+def fingerprint(inputs):
+    """Short hash of the JSON of `inputs`."""
+    text = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+def _jsonable(value):
+    return json.loads(json.dumps(value, default=str))
+
+
+class RunStateStore():
+    """
+    Records pipeline runs in a JSON file. For every step it keeps the
+    status ('running', 'done' or 'failed'), its inputs, its result and
+    timing. A run that did not complete is resumed by the next run with
+    the same inputs: its finished steps are skipped and their recorded
+    results reused.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        JSON file holding the most recent MAX_RUNS runs
+    run : dict
+        the current run, set by start()
+    """
+    def __init__(self, path):
+        self.path = path
+        self.runs = []
+        self.run = None
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.runs = json.load(f)
+
+    def start(self, inputs, resume=True, reopen=False):
+        """
+        Resumes the last run if it did not complete and had the same
+        inputs, otherwise (or with resume=False) starts a new one. With
+        `reopen` a completed last run is continued as well, e.g. to rerun
+        some of its steps. Returns the run.
+        """
+        key = fingerprint(inputs)
+        with self._lock:
+            last = self.runs[-1] if self.runs else None
+            if (resume and last and last['fingerprint'] == key
+                    and (reopen or last['status'] != 'complete')):
+                self.run = last
+                self.run['attempts'] += 1
+                done = [name for name, step in self.run['steps'].items()
+                        if step['status'] == 'done']
+                logging.info(f"Resuming run {self.run['run_id']} (attempt {self.run['attempts']}), "
+                             f"{len(done)} steps already done.")
+            else:
+                if resume and last and last['status'] != 'complete':
+                    logging.warning(f"Inputs changed since run {last['run_id']}, starting a new run.")
+                self.run = {
+                    'run_id': time.strftime('%Y%m%d-%H%M%S'),
+                    'fingerprint': key,
+                    'inputs': _jsonable(inputs),
+                    'started': time.time(),
+                    'attempts': 1,
+                    'status': 'running',
+                    'steps': {},
+                }
+                self.runs = (self.runs + [self.run])[-MAX_RUNS:]
+            self.run['status'] = 'running'
+            self._save()
+        return self.run
+
+    def completed_steps(self):
+        """Step name -> recorded result of every step done in this run."""
+        with self._lock:
+            return {name: step.get('result') for name, step in self.run['steps'].items()
+                    if step['status'] == 'done'}
+
+    def invalidate(self, names):
+        """Forgets the given steps so they run again."""
+        with self._lock:
+            for name in names:
+                self.run['steps'].pop(name, None)
+            self._save()
+
+    def step_started(self, name, inputs=None):
+        with self._lock:
+            self.run['steps'][name] = {'status': 'running', 'inputs': _jsonable(inputs),
+                                       'started': time.time()}
+            self._save()
+
+    def step_done(self, name, result, seconds):
+        with self._lock:
+            self.run['steps'][name].update(status='done', result=_jsonable(result),
+                                           seconds=round(seconds, 3), finished=time.time())
+            self._save()
+
+    def step_failed(self, name, error, seconds):
+        with self._lock:
+            self.run['steps'][name].update(status='failed', error=str(error),
+                                           seconds=round(seconds, 3), finished=time.time())
+            self.run['status'] = 'failed'
+            self._save()
+
+    def finish(self, step_names):
+        """Marks the run complete if every one of `step_names` is done."""
+        with self._lock:
+            steps = self.run['steps']
+            if all(steps.get(name, {}).get('status') == 'done' for name in step_names):
+                self.run['status'] = 'complete'
+                self.run['finished'] = time.time()
+            else:
+                self.run['status'] = 'incomplete'
+            self._save()
+            return self.run['status']
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.runs, f, indent=1)
+        os.replace(tmp_path, self.path)
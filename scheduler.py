@@ -0,0 +1,182 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logging.basicConfig(level=logging.INFO)
+
+class Step():
+    """
+    A single unit of work in a pipeline.
+
+    ...
+
+    Attributes
+    ----------
+    name : str
+        unique step name
+    func : callable
+        called without arguments; its return value is kept as the result
+    depends_on : list
+        names of the steps that must finish before this one starts
+    """
+    def __init__(self, name, func, depends_on=None):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on or [])
+        self.start_time = None
+        self.end_time = None
+        self.result = None
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+class StepScheduler():
+    """
+    Runs a DAG of steps, starting every step as soon as its dependencies
+    have finished, with at most `max_parallelism` steps running at once.
+
+    If a step fails no new steps are started, the running ones are allowed
+    to finish, and the error is raised.
+
+    With a run_state store every step is checkpointed, and steps done by
+    an earlier attempt of the same run are skipped with their recorded
+    result.
+
+    ...
+
+    Attributes
+    ----------
+    max_parallelism : int
+        upper bound on the number of steps running at the same time
+    steps : dict
+        step name -> Step, in the order they were added
+    run_state : RunStateStore
+        started store the steps are checkpointed in (None disables it)
+    """
+    def __init__(self, max_parallelism=4, run_state=None):
+        self.max_parallelism = max(1, int(max_parallelism))
+        self.steps = {}
+        self.run_state = run_state
+
+    def add(self, name, func, depends_on=None):
+        """Adds a step. Dependencies must have been added before."""
+        if name in self.steps:
+            raise ValueError(f"Duplicate step: {name}")
+        for dependency in depends_on or []:
+            if dependency not in self.steps:
+                raise ValueError(f"Step {name} depends on unknown step {dependency}")
+        self.steps[name] = Step(name, func, depends_on)
+        return self.steps[name]
+
+    def downstream(self, name):
+        """Returns `name` and every step that depends on it, directly or not."""
+        if name not in self.steps:
+            raise ValueError(f"Unknown step: {name}")
+        found = {name}
+        for step in self.steps.values():
+            if any(d in found for d in step.depends_on):
+                found.add(step.name)
+        return found
+
+    def _skipped(self, from_step, only_steps):
+        """
+        Step name -> recorded result of the steps that do not run: steps
+        already done in the run state, except `from_step` and everything
+        downstream of it, or all steps but `only_steps`.
+        """
+        completed = {}
+        if self.run_state is not None:
+            if from_step:
+                self.run_state.invalidate(self.downstream(from_step))
+            completed = self.run_state.completed_steps()
+        if only_steps:
+            unknown = set(only_steps) - set(self.steps)
+            if unknown:
+                raise ValueError(f"Unknown steps: {', '.join(sorted(unknown))}")
+            return {name: completed.get(name) for name in self.steps if name not in only_steps}
+        return {name: result for name, result in completed.items() if name in self.steps}
+
+    def run(self, from_step=None, only_steps=None):
+        """
+        Executes all steps and returns a dict of step name -> result.
+
+        Steps recorded as done in the run state are skipped. `from_step`
+        reruns that step and everything downstream of it; `only_steps`
+        runs just the given steps, taking their dependencies as done.
+        """
+        skipped = self._skipped(from_step, only_steps)
+        for name, result in skipped.items():
+            self.steps[name].result = result
+            logging.info(f"Skipping step: {name}")
+        done = set(skipped)
+        running = {}
+        failure = None
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_parallelism) as executor:
+            while len(done) < len(self.steps):
+                if failure is None:
+                    for step in self.steps.values():
+                        if len(running) >= self.max_parallelism:
+                            break
+                        if (step.name not in done and step not in running.values()
+                                and all(d in done for d in step.depends_on)):
+                            running[executor.submit(self._run_step, step)] = step
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(step.name)
+                    except Exception as e:
+                        logging.error(f"Step {step.name} failed: {e}")
+                        if failure is None:
+                            failure = e
+        if failure is not None:
+            raise failure
+        if self.run_state is not None:
+            self.run_state.finish(self.steps)
+        self.log_report(time.time() - start_time)
+        return {name: step.result for name, step in self.steps.items()}
+
+    def _run_step(self, step):
+        logging.info(f"Starting step: {step.name}")
+        if self.run_state is not None:
+            self.run_state.step_started(step.name, {'depends_on': step.depends_on})
+        step.start_time = time.time()
+        try:
+            step.result = step.func()
+        except Exception as e:
+            step.end_time = time.time()
+            if self.run_state is not None:
+                self.run_state.step_failed(step.name, e, step.duration)
+            raise
+        step.end_time = time.time()
+        if self.run_state is not None:
+            self.run_state.step_done(step.name, step.result, step.duration)
+        logging.info(f"Finished step: {step.name} ({step.duration:.2f}s)")
+
+    def critical_path(self):
+        """
+        Returns the chain of dependent steps with the largest total run
+        time. No amount of parallelism can finish the DAG faster than this.
+        """
+        longest = {}
+        for step in self.steps.values():
+            previous = max((longest[d] for d in step.depends_on),
+                           key=lambda path: path[0], default=(0.0, []))
+            longest[step.name] = (previous[0] + step.duration, previous[1] + [step.name])
+        return max(longest.values(), key=lambda path: path[0], default=(0.0, []))
+
+    def log_report(self, wall_time):
+        total, path = self.critical_path()
+        busy = sum(step.duration for step in self.steps.values())
+        logging.info(f"Pipeline finished in {wall_time:.2f}s "
+                     f"({busy:.2f}s of step time, parallelism {self.max_parallelism}).")
+        logging.info(f"Critical path ({total:.2f}s): " + " -> ".join(
+            f"{name} ({self.steps[name].duration:.2f}s)" for name in path))
@@ -0,0 +1,172 @@
+import configparser
+import os
+import threading
+
+DEFAULT_CONFIG_PATH = 'dwh.cfg'
+
+# A fallback of REQUIRED makes a missing option an error when it is read.
+REQUIRED = object()
+
+def _list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+# Attribute name -> (section, option, type, fallback)
+FIELDS = {
+    'KEY':                      ('AWS', 'KEY', str, REQUIRED),
+    'SECRET':                   ('AWS', 'SECRET', str, REQUIRED),
+    'REGION':                   ('AWS', 'REGION', str, REQUIRED),
+
+    'DWH_CLUSTER_TYPE':         ('CLUSTER', 'DWH_CLUSTER_TYPE', str, REQUIRED),
+    'DWH_NUM_NODES':            ('CLUSTER', 'DWH_NUM_NODES', int, REQUIRED),
+    'DWH_NODE_TYPE':            ('CLUSTER', 'DWH_NODE_TYPE', str, REQUIRED),
+    'DWH_CLUSTER_IDENTIFIER':   ('CLUSTER', 'DWH_CLUSTER_IDENTIFIER', str, REQUIRED),
+    'DWH_DB':                   ('CLUSTER', 'DWH_DB', str, REQUIRED),
+    'DWH_DB_USER':              ('CLUSTER', 'DWH_DB_USER', str, REQUIRED),
+    'DWH_DB_PASSWORD':          ('CLUSTER', 'DWH_DB_PASSWORD', str, REQUIRED),
+    'DWH_PORT':                 ('CLUSTER', 'DWH_PORT', int, REQUIRED),
+    'DWH_HOST':                 ('CLUSTER', 'DWH_HOST', str, REQUIRED),
+
+    'DWH_ROLE_NAME':            ('ROLE', 'DWH_ROLE_NAME', str, REQUIRED),
+    'DWH_ROLE_ARN':             ('ROLE', 'DWH_ROLE_ARN', str, REQUIRED),
+
+    'WAITER_DELAY':             ('PROVISIONING', 'WAITER_DELAY', int, 15),
+    'WAITER_MAX_ATTEMPTS':      ('PROVISIONING', 'WAITER_MAX_ATTEMPTS', int, 120),
+
+    'WARM_START':               ('SNAPSHOTS', 'WARM_START', bool, False),
+    'SNAPSHOT_PREFIX':          ('SNAPSHOTS', 'SNAPSHOT_PREFIX', str, 'sparkify-final'),
+    'SNAPSHOTS_KEPT':           ('SNAPSHOTS', 'KEEP', int, 3),
+    'SNAPSHOT_RETENTION_DAYS':  ('SNAPSHOTS', 'RETENTION_DAYS', int, -1),
+
+    'SIZING_MODE':              ('SIZING', 'MODE', str, 'fixed'),
+    'TARGET_LOAD_MINUTES':      ('SIZING', 'TARGET_LOAD_MINUTES', float, 15.0),
+    'SIZING_NODE_TYPES':        ('SIZING', 'NODE_TYPES', _list, []),
+    'SIZING_MAX_NODES':         ('SIZING', 'MAX_NODES', int, 0),
+    'SLICE_MB_PER_SECOND':      ('SIZING', 'SLICE_MB_PER_SECOND', float, 5.0),
+    'LOAD_HISTORY_FILE':        ('SIZING', 'HISTORY_FILE', str, 'load_history.jsonl'),
+
+    'POOL_MIN':                 ('DB', 'POOL_MIN', int, 1),
+    'POOL_MAX':                 ('DB', 'POOL_MAX', int, 8),
+    'CONNECT_TIMEOUT':          ('DB', 'CONNECT_TIMEOUT', int, 10),
+    'CONNECT_RETRIES':          ('DB', 'CONNECT_RETRIES', int, 5),
+    'RETRY_BACKOFF':            ('DB', 'RETRY_BACKOFF', float, 2.0),
+    'KEEPALIVES_IDLE':          ('DB', 'KEEPALIVES_IDLE', int, 30),
+    'KEEPALIVES_INTERVAL':      ('DB', 'KEEPALIVES_INTERVAL', int, 10),
+    'KEEPALIVES_COUNT':         ('DB', 'KEEPALIVES_COUNT', int, 5),
+    'STATEMENT_TIMEOUT':        ('DB', 'STATEMENT_TIMEOUT', int, 0),
+    'HEALTH_CHECK_AFTER':       ('DB', 'HEALTH_CHECK_AFTER', float, 60.0),
+    'POLL_INTERVAL':            ('DB', 'POLL_INTERVAL', float, 30.0),
+
+    'LOG_DATA':                 ('S3', 'LOG_DATA', str, REQUIRED),
+    'LOG_JSONPATH':             ('S3', 'LOG_JSONPATH', str, REQUIRED),
+    'SONG_DATA':                ('S3', 'SONG_DATA', str, REQUIRED),
+    'MANIFEST_PREFIX':          ('S3', 'MANIFEST_PREFIX', str, ''),
+    'COMPACTED_SONG_DATA':      ('S3', 'COMPACTED_SONG_DATA', str, ''),
+
+    'BACKEND':                  ('ETL', 'BACKEND', str, 'redshift'),
+    'INCREMENTAL':              ('ETL', 'INCREMENTAL', bool, False),
+    'LOAD_STATE_FILE':          ('ETL', 'LOAD_STATE_FILE', str, 'load_state.json'),
+    'RUN_STATE_FILE':           ('ETL', 'RUN_STATE_FILE', str, 'run_state.json'),
+    'MAX_PARALLELISM':          ('ETL', 'MAX_PARALLELISM', int, 4),
+    'INSERT_MODE':              ('ETL', 'INSERT_MODE', str, 'atomic'),
+    'COMPACT_SONGS':            ('ETL', 'COMPACT_SONGS', bool, False),
+    'COMPACT_PART_MB':          ('ETL', 'COMPACT_PART_MB', float, 64.0),
+    'COPY_PROFILE':             ('ETL', 'COPY_PROFILE', str, 'fast_staging'),
+    'TABLE_DESIGN':             ('ETL', 'TABLE_DESIGN', str, 'auto'),
+    'READ_FROM_ROLLUPS':        ('ETL', 'READ_FROM_ROLLUPS', bool, True),
+
+    'LOCAL_DATABASE':           ('LOCAL', 'DATABASE', str, 'sparkify_local.db'),
+    'LOCAL_DATA_DIR':           ('LOCAL', 'DATA_DIR', str, 'sparkify_synthetic'),
+    'LOCAL_TIMEOUT':            ('LOCAL', 'TIMEOUT', float, 60.0),
+    'LOCAL_SLICES':             ('LOCAL', 'SLICES', int, 2),
+
+    'LOAD_REPORT_DIR':          ('METRICS', 'LOAD_REPORT_DIR', str, 'load_reports'),
+}
+
+class Settings():
+    """
+    Typed, cached view of dwh.cfg. Nothing is read when the object is
+    created: the file is parsed on the first access and every option in
+    FIELDS is converted to its type once, then served from memory.
+    Sections without a fixed set of options ([DEADLINES], [COPY <profile>],
+    ...) are read through `config`.
+
+    ...
+
+    Attributes
+    ----------
+    path : str
+        config file the settings are read from and saved to
+    """
+    def __init__(self, path=DEFAULT_CONFIG_PATH):
+        self.path = path
+        self._config = None
+        self._values = {}
+        self._lock = threading.RLock()
+
+    @property
+    def config(self):
+        """Parsed ConfigParser of the file, read on first use."""
+        with self._lock:
+            if self._config is None:
+                config = configparser.ConfigParser()
+                with open(self.path) as f:
+                    config.read_file(f)
+                self._config = config
+            return self._config
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in FIELDS:
+            raise AttributeError(name)
+        with self._lock:
+            if name not in self._values:
+                self._values[name] = self._read(*FIELDS[name])
+            return self._values[name]
+
+    def _read(self, section, option, kind, fallback):
+        if not self.config.has_option(section, option):
+            if fallback is REQUIRED:
+                raise configparser.NoOptionError(option, section)
+            return fallback
+        if kind is bool:
+            return self.config.getboolean(section, option)
+        return kind(self.config.get(section, option))
+
+    def section(self, section, kind=str):
+        """Returns every option of `section` converted to `kind`, or {}."""
+        if not self.config.has_section(section):
+            return {}
+        return {option: kind(value) for option, value in self.config.items(section)}
+
+    def save(self, **values):
+        """
+        Sets the given FIELDS attributes, e.g. save(DWH_HOST='...'), and
+        writes the config file.
+        """
+        with self._lock:
+            for name, value in values.items():
+                section, option, _, _ = FIELDS[name]
+                self.config.set(section, option, str(value))
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                self.config.write(f)
+            os.replace(tmp_path, self.path)
+            self._values.clear()
+
+    def reload(self):
+        """Drops the cached values so the file is read again on next use."""
+        with self._lock:
+            self._config = None
+            self._values.clear()
+
+
+_instances = {}
+_instances_lock = threading.Lock()
+
+def get_settings(path=DEFAULT_CONFIG_PATH):
+    """Returns the shared Settings of a config file."""
+    with _instances_lock:
+        if path not in _instances:
+            _instances[path] = Settings(path)
+        return _instances[path]
+
+settings = get_settings()
@@ -6,6 +6,9 @@ user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+song_lookup_table_drop = "DROP TABLE IF EXISTS song_lookup"
+song_plays_daily_table_drop = "DROP TABLE IF EXISTS song_plays_daily"
+user_plays_daily_table_drop = "DROP TABLE IF EXISTS user_plays_daily"
 
 # CREATE TABLES
 staging_events_table_create = ("""
@@ -114,24 +117,196 @@ time_table_create = ("""
     diststyle auto;
 """)
 
+# Maps the normalized (title, artist name, duration in whole seconds) of a
+# song to its ids. Kept across loads and only extended with new songs, so
+# songplays are resolved with a single BIGINT equi-join. Distributed on
+# song_key like staging_events_keyed, so that join stays on each slice.
+song_lookup_table_create = ("""
+    CREATE TABLE IF NOT EXISTS song_lookup (
+        song_key                BIGINT                  NOT NULL
+        , song_id               VARCHAR(30)             NOT NULL
+        , artist_id             VARCHAR(30)             NOT NULL
+        , primary key(song_key)
+    )
+    diststyle key distkey(song_key);
+""")
+
+# ROLLUP TABLES
+# Songplays per UTC day (day_start in epoch milliseconds, like start_time).
+# Only the days of each loaded batch are recomputed.
+song_plays_daily_table_create = ("""
+    CREATE TABLE IF NOT EXISTS song_plays_daily (
+        day_start               BIGINT                  NOT NULL
+        , song_id               VARCHAR(30)
+        , plays                 BIGINT                  NOT NULL
+    )
+    diststyle auto;
+""")
+
+user_plays_daily_table_create = ("""
+    CREATE TABLE IF NOT EXISTS user_plays_daily (
+        day_start               BIGINT                  NOT NULL
+        , user_id               INTEGER
+        , level                 VARCHAR(10)             NOT NULL
+        , plays                 BIGINT                  NOT NULL
+    )
+    diststyle auto;
+""")
+
 # STAGING TABLES
 
+# The last placeholder of every COPY takes the options built by
+# copy_options.CopyOptionsBuilder (compression, COMPUPDATE, STATUPDATE, ...).
 staging_events_copy = ("""
     COPY staging_events FROM {}
     CREDENTIALS 'aws_iam_role={}'
     JSON {}
+    {}
 """)
 
 staging_songs_copy = ("""
     COPY staging_songs FROM {}
     CREDENTIALS 'aws_iam_role={}'
     json 'auto'
+    {}
+""")
+
+# Incremental loads: staging only holds the current batch, which is read
+# from a generated manifest of the not yet loaded S3 objects.
+staging_events_truncate = "DELETE FROM staging_events"
+staging_songs_truncate = "DELETE FROM staging_songs"
+
+staging_events_copy_manifest = ("""
+    COPY staging_events FROM '{}'
+    CREDENTIALS 'aws_iam_role={}'
+    JSON {}
+    MANIFEST
+    {}
+""")
+
+staging_songs_copy_manifest = ("""
+    COPY staging_songs FROM '{}'
+    CREDENTIALS 'aws_iam_role={}'
+    json 'auto'
+    MANIFEST
+    {}
+""")
+
+# LOAD REPORTS
+# last_copy_id must run on the session of the COPY, right after it. The
+# system tables are read by its query id once the COPY has committed.
+last_copy_id = "SELECT pg_last_copy_id()"
+cluster_slices = "SELECT COUNT(*) FROM stv_slices"
+
+# loadtime is in microseconds. name is cut off at 90 characters.
+load_file_scans = ("""
+    SELECT slice, TRIM(name), SUM(lines), SUM(bytes), SUM(loadtime)
+    FROM stl_file_scan
+    WHERE query = {}
+    GROUP BY slice, TRIM(name)
+""")
+
+load_commits = ("""
+    SELECT TRIM(filename), SUM(lines_scanned), SUM(errors)
+    FROM stl_load_commits
+    WHERE query = {}
+    GROUP BY TRIM(filename)
+""")
+
+# A failed COPY has no pg_last_copy_id(). Its rows in stl_load_errors
+# outlive the rollback, under the session that ran it.
+failed_copy_id = """
+    SELECT MAX(query) FROM stl_load_errors WHERE session = pg_backend_pid()
+"""
+
+load_errors = ("""
+    SELECT slice, TRIM(filename), line_number, TRIM(colname), err_code, TRIM(err_reason)
+    FROM stl_load_errors
+    WHERE query = {}
+    ORDER BY 2, 3
+    LIMIT 100
 """)
 
 
+# SONG LOOKUP
+# Takes the title, artist name and duration columns. Event and song sides
+# must go through the same expression so that their keys match.
+song_key_expression = ("FNV_HASH(LOWER(TRIM({})) || '|' || LOWER(TRIM({})) || '|' "
+                       "|| CAST(CAST(ROUND({}) AS INTEGER) AS VARCHAR))")
+staging_songs_key = song_key_expression.format('ss.title', 'ss.artist_name', 'ss.duration')
+staging_events_key = song_key_expression.format('se.song', 'se.artist', 'se.length')
+
+# Adds the songs of the current staging batch that are not in the lookup
+# yet. Songs sharing a key resolve to the lowest song_id.
+song_lookup_insert = ("""
+    INSERT INTO song_lookup(
+        SELECT
+            k.song_key
+            , k.song_id
+            , k.artist_id
+        FROM (
+            SELECT
+                s.song_key
+                , s.song_id
+                , s.artist_id
+                , ROW_NUMBER() OVER (PARTITION BY s.song_key ORDER BY s.song_id) AS song_rank
+            FROM (
+                SELECT
+                    {} AS song_key
+                    , ss.song_id
+                    , ss.artist_id
+                FROM staging_songs ss
+                WHERE ss.song_id IS NOT NULL
+                AND ss.artist_id IS NOT NULL
+                AND ss.title IS NOT NULL
+                AND ss.artist_name IS NOT NULL
+                AND ss.duration IS NOT NULL
+            ) s
+        ) k
+        LEFT JOIN song_lookup sl ON sl.song_key = k.song_key
+        WHERE k.song_rank = 1
+        AND sl.song_key IS NULL
+        )
+""").format(staging_songs_key)
+
+
+# The NextSong events of the staging batch with their song key, distributed
+# on it. Built on the session of the songplays load before it joins
+# song_lookup, so the key is hashed once per event and neither side of the
+# join is redistributed or broadcast.
+staging_events_keyed_drop = "DROP TABLE IF EXISTS staging_events_keyed"
+staging_events_keyed_create = ("""
+    CREATE TEMP TABLE staging_events_keyed
+    DISTSTYLE KEY DISTKEY(song_key)
+    AS SELECT
+        se.*
+        , {} AS song_key
+    FROM staging_events se
+    WHERE se.page = 'NextSong'
+""").format(staging_events_key)
+
+# NextSong events of the staging batch between ts {0} and {1} with their
+# song and artist ids. An event logged twice (same session and ts, i.e. the
+# same event hash) is only kept once. Reads staging_events_keyed.
+songplay_events = ("""(
+            SELECT
+                e.*
+                , ROW_NUMBER() OVER (PARTITION BY e.event_hash ORDER BY e.user_id) AS event_rank
+            FROM (
+                SELECT
+                    *
+                    , MD5(CAST(session_id AS VARCHAR) || '|' || CAST(ts AS VARCHAR)) AS event_hash
+                FROM staging_events_keyed
+                WHERE ts BETWEEN {0} AND {1}
+            ) e
+        ) se
+        LEFT JOIN song_lookup sl ON sl.song_key = se.song_key
+        WHERE se.event_rank = 1""")
+
+
 # STORED PROCEDURES for ANALYTICAL TABLE UPSERTS
 songplays_upsert = ("""
-    CREATE OR REPLACE PROCEDURE songplays_upsert()
+    CREATE OR REPLACE PROCEDURE songplays_upsert(min_ts BIGINT, max_ts BIGINT)
     AS $$
     BEGIN
         DROP TABLE IF EXISTS songplays_stage;
@@ -151,20 +326,19 @@ songplays_upsert = ("""
                     se.ts
                     , se.user_id
                     , se.level
-                    , ss.song_id
-                    , ss.artist_id
+                    , sl.song_id
+                    , sl.artist_id
                     , se.session_id
                     , se.location
                     , se.user_agent
-                FROM staging_events se
-                LEFT JOIN staging_songs ss ON ss.title = se.song
-                WHERE page = 'NextSong'
+                FROM {}
                 );
 
         DELETE FROM songplays  
         USING songplays_stage 
         WHERE songplays.session_id = songplays_stage.session_id
-        AND songplays.start_time = songplays_stage.start_time;
+        AND songplays.start_time = songplays_stage.start_time
+        AND songplays.start_time BETWEEN min_ts AND max_ts;
         
         INSERT INTO songplays(
                 start_time
@@ -190,8 +364,49 @@ songplays_upsert = ("""
         DROP TABLE songplays_stage;
     END;
     $$ LANGUAGE plpgsql;
+""").format(songplay_events.format('min_ts', 'max_ts'))
+
+songplays_upsert_call = "CALL songplays_upsert({}, {});"
+
+# The batch window of the events in staging, and whether songplays already
+# holds rows inside it. Without an overlap the batch is simply appended;
+# songplays_append takes the same min and max ts as the procedure.
+songplays_window = ("""
+    SELECT MIN(ts), MAX(ts)
+    FROM staging_events
+    WHERE page = 'NextSong'
+""")
+
+songplays_window_overlap = ("""
+    SELECT 1
+    FROM songplays
+    WHERE start_time BETWEEN {} AND {}
+    LIMIT 1
 """)
 
+songplays_append = ("""
+    INSERT INTO songplays(
+        start_time
+        , user_id
+        , level
+        , song_id
+        , artist_id
+        , session_id
+        , location
+        , user_agent) 
+        (SELECT
+            se.ts
+            , se.user_id
+            , se.level
+            , sl.song_id
+            , sl.artist_id
+            , se.session_id
+            , se.location
+            , se.user_agent
+        FROM {}
+        )
+""").format(songplay_events)
+
 
 # ANALYTICAL TABLES
 songplay_table_insert = ("""
@@ -208,19 +423,18 @@ songplay_table_insert = ("""
             se.ts
             , se.user_id
             , se.level
-            , ss.song_id
-            , ss.artist_id
+            , sl.song_id
+            , sl.artist_id
             , se.session_id
             , se.location
             , se.user_agent
-        FROM staging_events se
-        LEFT JOIN staging_songs ss ON ss.title = se.song
-        WHERE page = 'NextSong'
+        FROM staging_events_keyed se
+        LEFT JOIN song_lookup sl ON sl.song_key = se.song_key
         )
 """)
 
-user_table_insert = ("""
-    INSERT INTO users(
+user_table_insert_template = ("""
+    INSERT INTO {}(
         SELECT
             a.user_id
             , a.first_name
@@ -236,8 +450,8 @@ user_table_insert = ("""
         )
 """)
 
-song_table_insert = ("""
-    INSERT INTO songs(
+song_table_insert_template = ("""
+    INSERT INTO {}(
         SELECT
             DISTINCT ss.song_id
             , ss.title
@@ -249,8 +463,8 @@ song_table_insert = ("""
         )
 """)
 
-artist_table_insert = ("""
-    INSERT INTO artists(
+artist_table_insert_template = ("""
+    INSERT INTO {}(
         SELECT
             DISTINCT ss.artist_id
             , artist_name AS name
@@ -262,8 +476,8 @@ artist_table_insert = ("""
         )
 """)
 
-time_table_insert = ("""
-    INSERT INTO time(
+time_table_insert_template = ("""
+    INSERT INTO {}(
         SELECT
             DISTINCT ts AS start_time
             , EXTRACT(hour FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS hour
@@ -276,6 +490,108 @@ time_table_insert = ("""
         )
 """)
 
+user_table_insert = user_table_insert_template.format('users')
+song_table_insert = song_table_insert_template.format('songs')
+artist_table_insert = artist_table_insert_template.format('artists')
+time_table_insert = time_table_insert_template.format('time')
+
+# Dimension loads into shadow tables, published to the real tables together
+analytical_load_table_drop = "DROP TABLE IF EXISTS {}_load"
+analytical_load_table_create = "CREATE TABLE {0}_load (LIKE {0})"
+analytical_load_table_publish = "INSERT INTO {0} (SELECT * FROM {0}_load)"
+
+# Dimension upserts. The insert template of a dimension fills {table}_batch
+# with the current staging batch, which is deduplicated on the primary key
+# into {table}_merge. Rows whose hash of all columns changed are deleted and
+# re-inserted together with the new keys; unchanged rows are not touched.
+dimension_batch_drop = "DROP TABLE IF EXISTS {0}_batch"
+dimension_batch_create = "CREATE TEMP TABLE {0}_batch (LIKE {0})"
+dimension_merge_drop = "DROP TABLE IF EXISTS {0}_merge"
+dimension_merge_create = "CREATE TEMP TABLE {0}_merge (LIKE {0})"
+
+# {0} table, {1} primary key, {2} columns of d, {3} row hash of b
+dimension_merge_dedupe = ("""
+    INSERT INTO {0}_merge(
+        SELECT {2}
+        FROM (
+            SELECT
+                b.*
+                , ROW_NUMBER() OVER (PARTITION BY b.{1} ORDER BY {3}) AS row_rank
+            FROM {0}_batch b
+        ) d
+        WHERE d.row_rank = 1
+        )
+""")
+
+# {0} table, {1} primary key, {2} row hash of the table, {3} row hash of m
+dimension_merge_delete = ("""
+    DELETE FROM {0}
+    USING {0}_merge m
+    WHERE {0}.{1} = m.{1}
+    AND {2} <> {3}
+""")
+
+# {0} table, {1} primary key
+dimension_merge_insert = ("""
+    INSERT INTO {0}(
+        SELECT m.*
+        FROM {0}_merge m
+        LEFT JOIN {0} t ON t.{1} = m.{1}
+        WHERE t.{1} IS NULL
+        )
+""")
+
+# Row hashes are built from one of these per column, joined with '|'.
+row_hash_column = "COALESCE(CAST({}.{} AS VARCHAR), '')"
+row_hash_expression = "MD5({})"
+
+# ROLLUP REFRESH
+# {0} first day_start of the batch, {1} day_start after its last day
+song_plays_daily_delete = ("""
+    DELETE FROM song_plays_daily
+    WHERE day_start >= {0} AND day_start < {1}
+""")
+
+song_plays_daily_insert = ("""
+    INSERT INTO song_plays_daily(
+        SELECT
+            start_time - start_time % 86400000 AS day_start
+            , song_id
+            , COUNT(*) AS plays
+        FROM songplays
+        WHERE start_time >= {0} AND start_time < {1}
+        GROUP BY 1, 2
+        )
+""")
+
+user_plays_daily_delete = ("""
+    DELETE FROM user_plays_daily
+    WHERE day_start >= {0} AND day_start < {1}
+""")
+
+user_plays_daily_insert = ("""
+    INSERT INTO user_plays_daily(
+        SELECT
+            start_time - start_time % 86400000 AS day_start
+            , user_id
+            , level
+            , COUNT(*) AS plays
+        FROM songplays
+        WHERE start_time >= {0} AND start_time < {1}
+        GROUP BY 1, 2, 3
+        )
+""")
+
+songplays_time_range = "SELECT MIN(start_time), MAX(start_time) FROM songplays"
+
+# Every songplay is counted in exactly one user_plays_daily row, so the
+# totals differ when the rollups are missing days of songplays.
+rollup_coverage = ("""
+    SELECT
+        (SELECT COUNT(*) FROM songplays)
+        , (SELECT COALESCE(SUM(plays), 0) FROM user_plays_daily)
+""")
+
 read_total_users = ("""
     SELECT
         COUNT(*) as total_users
@@ -309,6 +625,27 @@ read_top_active_users = ("""
     LIMIT 5
 """)
 
+read_popular_songs_rollup = ("""
+    SELECT
+        song_id,
+        SUM(plays) as total_songplays
+    FROM song_plays_daily
+    WHERE song_id IS NOT NULL
+    GROUP BY 1
+    ORDER BY 2 DESC
+    LIMIT 5
+""")
+
+read_top_active_users_rollup = ("""
+    SELECT
+        user_id,
+        SUM(plays) as total_songplays
+    FROM user_plays_daily
+    GROUP BY 1
+    ORDER BY 2 DESC
+    LIMIT 5
+""")
+
 # QUERY LISTS
 # -----------------------------------
 
@@ -318,9 +655,18 @@ drop_staging_table_queries = [staging_events_table_drop, staging_songs_table_dro
 
 # Analytical queries list:
 create_analytical_table_queries = [songplay_table_create, user_table_create, 
-                                   song_table_create, artist_table_create, time_table_create]
+                                   song_table_create, artist_table_create, time_table_create,
+                                   song_lookup_table_create, song_plays_daily_table_create,
+                                   user_plays_daily_table_create]
 drop_analytical_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, 
-                                 artist_table_drop, time_table_drop]
+                                 artist_table_drop, time_table_drop, song_lookup_table_drop,
+                                 song_plays_daily_table_drop, user_plays_daily_table_drop]
 insert_analytical_table_queries = [user_table_insert, song_table_insert, 
                                    artist_table_insert, time_table_insert]
-read_analytical_tables_queries = [read_popular_songs, read_top_active_users]
\ No newline at end of file
+analytical_table_insert_templates = {'users': user_table_insert_template,
+                                     'songs': song_table_insert_template,
+                                     'artists': artist_table_insert_template,
+                                     'time': time_table_insert_template}
+read_analytical_tables_queries = [read_popular_songs, read_top_active_users]
+refresh_rollup_queries = [song_plays_daily_delete, song_plays_daily_insert,
+                          user_plays_daily_delete, user_plays_daily_insert]
\ No newline at end of file
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+from instrumentation import StatementRecorder
+from local_backend import LocalConnectionManager
+from sql_queries import create_staging_table_queries, create_analytical_table_queries, \
+    song_lookup_insert, staging_events_keyed_drop, staging_events_keyed_create, \
+    songplays_window, songplays_append, songplays_upsert, songplays_upsert_call
+
+# The songplays join before song_lookup: on the exact title only.
+EXACT_TITLE_JOIN = """
+    SELECT se.ts, ss.song_id, ss.artist_id
+    FROM staging_events se
+    LEFT JOIN staging_songs ss ON ss.title = se.song
+    WHERE page = 'NextSong'
+    ORDER BY se.ts
+"""
+
+SONGS = [
+    ('SOHELLO', 'ARADELE', 'Hello', 'Adele', 295.5),
+    ('SOYESTERDAY', 'ARBEATLES', 'Yesterday', 'The Beatles', 125.0),
+]
+
+# ts, song, artist, length
+EXACT_EVENTS = [
+    (1000, 'Hello', 'Adele', 295.5),
+    (2000, 'Yesterday', 'The Beatles', 125.0),
+]
+UNMATCHED_EVENTS = [
+    (3000, 'Unknown Song', 'Nobody', 200.0),
+    (4000, None, None, None),
+]
+
+class SongplayJoinTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = LocalConnectionManager('dwh_template.cfg',
+                                         database=os.path.join(self.directory, 'test.db'),
+                                         data_dir=self.directory, recorder=StatementRecorder())
+        with self.db.connection() as (conn, cur):
+            for query in create_staging_table_queries + create_analytical_table_queries:
+                cur.execute(query)
+            cur.executemany("INSERT INTO staging_songs (song_id, artist_id, title, artist_name, "
+                            "duration) VALUES (?, ?, ?, ?, ?)", SONGS)
+            conn.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load_events(self, events):
+        with self.db.connection() as (conn, cur):
+            cur.executemany("INSERT INTO staging_events (ts, song, artist, length, page, session_id, "
+                            "user_id, level, location, user_agent) "
+                            "VALUES (?, ?, ?, ?, 'NextSong', 1, 1, 'free', 'Berlin', 'curl')", events)
+            cur.execute("INSERT INTO staging_events (ts, page, session_id, user_id, level, location, "
+                        "user_agent) VALUES (5000, 'Home', 1, 1, 'free', 'Berlin', 'curl')")
+            conn.commit()
+
+    def songplays(self, upsert=False):
+        with self.db.connection() as (conn, cur):
+            cur.execute(song_lookup_insert)
+            cur.execute(songplays_window)
+            window = cur.fetchone()
+            cur.execute(staging_events_keyed_drop)
+            cur.execute(staging_events_keyed_create)
+            if upsert:
+                cur.execute(songplays_upsert)
+                cur.execute(songplays_upsert_call.format(*window))
+            else:
+                cur.execute(songplays_append.format(*window))
+            conn.commit()
+            cur.execute("SELECT start_time, song_id, artist_id FROM songplays ORDER BY start_time")
+            return cur.fetchall()
+
+    def exact_title_join(self):
+        with self.db.connection() as (conn, cur):
+            cur.execute(EXACT_TITLE_JOIN)
+            return cur.fetchall()
+
+    def test_matches_like_exact_join(self):
+        self.load_events(EXACT_EVENTS + UNMATCHED_EVENTS)
+        expected = self.exact_title_join()
+        self.assertEqual([row[1] for row in expected], ['SOHELLO', 'SOYESTERDAY', None, None])
+        self.assertEqual(self.songplays(), expected)
+
+    def test_upsert_matches_like_exact_join(self):
+        self.load_events(EXACT_EVENTS + UNMATCHED_EVENTS)
+        self.assertEqual(self.songplays(upsert=True), self.exact_title_join())
+
+    def test_matches_normalized_title_artist_and_duration(self):
+        # Unlike the exact join, case, surrounding spaces and fractions of
+        # a second of the duration do not matter.
+        self.load_events([(1000, ' HELLO', 'adele ', 295.7), (2000, 'Hello', 'Adele', 297.0)])
+        self.assertEqual(self.exact_title_join(),
+                         [(1000, None, None), (2000, 'SOHELLO', 'ARADELE')])
+        self.assertEqual(self.songplays(), [(1000, 'SOHELLO', 'ARADELE'), (2000, None, None)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+logging.basicConfig(level=logging.INFO)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODULES = ['settings', 'aws_clients', 'infrastructure', 'redshift', 'data_manager',
+           'db_connection', 'local_backend', 'get_sparkify_data', 'compaction', 'etl']
+
+# Modules that must not be imported by a plain `import etl`.
+DEFERRED_MODULES = ['boto3', 'botocore', 'pandas', 'numpy']
+
+def commands():
+    """Name -> command line of every startup measured."""
+    measured = {'python': [sys.executable, '-c', 'pass']}
+    for module in MODULES:
+        measured[f'import {module}'] = [sys.executable, '-c', f'import {module}']
+    measured['etl.py --help'] = [sys.executable, os.path.join(REPO_DIR, 'etl.py'), '--help']
+    return measured
+
+def time_command(command, repeat, cwd):
+    """Returns the wall times in seconds of `repeat` runs of `command`."""
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    seconds = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run(command, cwd=cwd, env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start_time)
+    return seconds
+
+def deferred_imports(cwd):
+    """Returns the DEFERRED_MODULES that `import etl` loads anyway."""
+    check = ("import sys, etl; print(' '.join(m for m in %r if m in sys.modules))"
+             % DEFERRED_MODULES)
+    output = subprocess.run([sys.executable, '-c', check], cwd=cwd, check=True,
+                            env=dict(os.environ, PYTHONPATH=REPO_DIR),
+                            capture_output=True, text=True).stdout
+    return output.split()
+
+def run(repeat):
+    """
+    Times every command in a directory without a dwh.cfg, so an import
+    that reads the config file fails instead of being measured.
+    """
+    with tempfile.TemporaryDirectory() as cwd:
+        report = {}
+        for name, command in commands().items():
+            seconds = time_command(command, repeat, cwd)
+            report[name] = {'median': statistics.median(seconds), 'min': min(seconds)}
+            logging.info(f"{name}: median {report[name]['median']:.3f}s, "
+                         f"min {report[name]['min']:.3f}s")
+        report['deferred_imports_loaded'] = deferred_imports(cwd)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the startup of the Sparkify modules.")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help="maximum median seconds of `etl.py --help`")
+    parser.add_argument('--output', default='startup_report.json')
+    args = parser.parse_args()
+
+    report = run(args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Report written to {args.output}")
+
+    failed = False
+    if report['deferred_imports_loaded']:
+        logging.error(f"import etl loads {', '.join(report['deferred_imports_loaded'])}")
+        failed = True
+    if report['etl.py --help']['median'] > args.budget:
+        logging.error(f"etl.py --help took {report['etl.py --help']['median']:.3f}s, "
+                      f"budget {args.budget:.3f}s")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
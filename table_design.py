@@ -0,0 +1,323 @@
+import logging
+import re
+import sql_queries
+
+logging.basicConfig(level=logging.INFO)
+
+# Tables below this many rows are cheap enough to copy to every node.
+SMALL_TABLE_ROWS = 3000000
+TIME_COLUMNS = ('start_time', 'ts', 'day_start')
+
+_CREATE_TABLE = re.compile(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s*\((.*)\)\s*diststyle\s+\w+',
+                           re.I | re.S)
+_DISTRIBUTION = re.compile(r'\bdiststyle\s+(\w+)(?:\s+distkey\s*\(\s*(\w+)\s*\))?', re.I)
+_PRIMARY_KEY = re.compile(r'primary\s+key\s*\(\s*(\w+)\s*\)', re.I)
+_TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN|USING|INTO|UPDATE)\s+(\w+)(?=(?:\s+(?:AS\s+)?(\w+))?)', re.I)
+_JOIN_PREDICATE = re.compile(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)')
+_GROUP_BY = re.compile(r'\bGROUP\s+BY\s+(.+?)(?=\bORDER\b|\bLIMIT\b|\bHAVING\b|\)|$)', re.I | re.S)
+_SELECT_LIST = re.compile(r'\bSELECT\s+(?:DISTINCT\s+)?(.+?)\bFROM\s+(\w+)', re.I | re.S)
+_RANGE_PREDICATE = re.compile(r'(?:(\w+)\.)?(\w+)\s+(?:BETWEEN\b|[<>]=?\s*[\w:(])', re.I)
+_KEYWORDS = {'where', 'left', 'right', 'inner', 'outer', 'full', 'join', 'on', 'group',
+             'order', 'limit', 'select', 'as', 'and', 'set', 'values', 'having', 'using'}
+
+def parse_create_table(query):
+    """
+    Returns (table, [columns], primary key) for a CREATE TABLE statement
+    from sql_queries, or None for any other statement.
+    """
+    match = _CREATE_TABLE.search(query)
+    if not match:
+        return None
+    table, body = match.groups()
+    columns = []
+    for line in body.split('\n'):
+        line = line.strip().lstrip(',').strip()
+        if line and not line.lower().startswith('primary key'):
+            columns.append(line.split()[0])
+    primary_key = _PRIMARY_KEY.search(body)
+    return table, columns, primary_key.group(1) if primary_key else None
+
+
+class TableDesignAdvisor():
+    """
+    Recommends DISTSTYLE/DISTKEY/SORTKEY choices for the star schema from
+    the join, group-by and range columns used by the statements in
+    sql_queries, optionally refined with table sizes from svv_table_info
+    and redistribution costs from svl_query_summary. Tables declared with
+    an explicit DISTSTYLE in sql_queries keep it; only the ones left on
+    AUTO are advised.
+
+    ...
+
+    Attributes
+    ----------
+    tables : dict
+        table -> {'columns': [...], 'primary_key': ..., 'ddl': ...,
+                  'diststyle': ..., 'distkey': ...}
+    usage : dict
+        table -> {'join': {column: count}, 'group': {...}, 'range': {...}}
+    table_rows : dict
+        table -> row count from svv_table_info (empty if not connected)
+    redistribution : dict
+        table -> bytes broadcast or redistributed by recent queries
+    """
+    def __init__(self, queries=None, table_rows=None, redistribution=None,
+                 small_table_rows=SMALL_TABLE_ROWS):
+        if queries is None:
+            # Templates are skipped; their formatted versions are defined too.
+            queries = [value for name, value in vars(sql_queries).items()
+                       if isinstance(value, str) and not name.startswith('_')
+                       and not re.search(r'\{\d*\}', value)]
+        self.queries = list(dict.fromkeys(queries))
+        self.table_rows = table_rows or {}
+        self.redistribution = redistribution or {}
+        self.small_table_rows = small_table_rows
+        self.tables = {}
+        for query in self.queries:
+            parsed = parse_create_table(query)
+            if parsed:
+                table, columns, primary_key = parsed
+                diststyle, distkey = _DISTRIBUTION.search(query).groups()
+                self.tables[table] = {'columns': columns, 'primary_key': primary_key, 'ddl': query,
+                                      'diststyle': diststyle.upper(), 'distkey': distkey}
+        self.usage = {table: {'join': {}, 'group': {}, 'range': {}} for table in self.tables}
+        for query in self.queries:
+            self._collect_usage(query)
+
+    @classmethod
+    def from_redshift(cls, db, **kwargs):
+        """
+        Builds an advisor that also uses table sizes from svv_table_info
+        and broadcast/redistribution bytes from svl_query_summary.
+        """
+        table_rows = {}
+        redistribution = {}
+        with db.connection() as (conn, cur):
+            cur.execute('SELECT "table", tbl_rows FROM svv_table_info')
+            table_rows = {table: int(rows or 0) for table, rows in cur.fetchall()}
+            cur.execute("""
+                SELECT TRIM(t.name), SUM(s.bytes)
+                FROM svl_query_summary s
+                JOIN stl_scan sc ON sc.query = s.query AND sc.segment = s.seg
+                JOIN stv_tbl_perm t ON t.id = sc.tbl AND t.slice = 0
+                WHERE s.label LIKE 'bcast%' OR s.label LIKE 'dist%'
+                GROUP BY 1
+            """)
+            redistribution = {table: int(size or 0) for table, size in cur.fetchall()}
+            conn.commit()
+        return cls(table_rows=table_rows, redistribution=redistribution, **kwargs)
+
+    def _resolve(self, query):
+        """
+        Returns alias -> [tables]. An alias can be reused for different
+        tables within one statement (e.g. ss in songplays_upsert).
+        """
+        aliases = {}
+        for name, alias in _TABLE_REFERENCE.findall(query):
+            table = self._base_table(name)
+            if table is None:
+                continue
+            for name in (name, table, alias):
+                if name and name.lower() not in _KEYWORDS:
+                    aliases.setdefault(name, [])
+                    if table not in aliases[name]:
+                        aliases[name].append(table)
+        return aliases
+
+    def _table_for(self, aliases, alias, column):
+        for table in aliases.get(alias, []):
+            if column in self.tables[table]['columns']:
+                return table
+        return None
+
+    def _base_table(self, name):
+        # Temp tables such as songplays_stage or users_load stand in for their base table.
+        for candidate in (name, re.sub(r'_(stage|load)$', '', name)):
+            if candidate in self.tables:
+                return candidate
+        return None
+
+    def _count(self, kind, table, column):
+        if table in self.tables and column in self.tables[table]['columns']:
+            counts = self.usage[table][kind]
+            counts[column] = counts.get(column, 0) + 1
+
+    def _collect_usage(self, query):
+        if parse_create_table(query):
+            return
+        aliases = self._resolve(query)
+        for left_alias, left_column, right_alias, right_column in _JOIN_PREDICATE.findall(query):
+            left = self._table_for(aliases, left_alias, left_column)
+            right = self._table_for(aliases, right_alias, right_column)
+            if left == right:
+                # Self joins (e.g. songplays with its LIKE-created stage
+                # table) are co-located whatever the distribution key is.
+                continue
+            self._count('join', left, left_column)
+            self._count('join', right, right_column)
+        for group_by in _GROUP_BY.findall(query):
+            select = _SELECT_LIST.search(query)
+            items = _split_top_level(select.group(1)) if select else []
+            default_table = self._base_table(select.group(2)) if select else None
+            default_alias = default_table or ''
+            aliases.setdefault(default_alias, [default_table] if default_table else [])
+            for item in _split_top_level(group_by):
+                item = item.strip()
+                if item.isdigit() and int(item) <= len(items):
+                    item = re.split(r'\s+as\s+', items[int(item) - 1].strip(), flags=re.I)[0]
+                alias, _, column = item.rpartition('.')
+                column = column.strip()
+                self._count('group', self._table_for(aliases, alias or default_alias, column), column)
+        for alias, column in _RANGE_PREDICATE.findall(query):
+            if column.lower() in TIME_COLUMNS:
+                tables = aliases.get(alias, []) if alias else {t for ts in aliases.values() for t in ts}
+                for table in tables:
+                    self._count('range', table, column)
+
+    def _is_fact(self, table):
+        """
+        A fact table carries the primary keys of at least three other tables;
+        lookup tables such as song_lookup map onto two. Rollups of a fact
+        table (no primary key, a time column and at least one dimension key,
+        e.g. song_plays_daily) grow with it and count as facts too.
+        """
+        if table.startswith('staging_'):
+            return False
+        info = self.tables[table]
+        keys = self._dimension_keys(table)
+        if not info['primary_key'] and set(info['columns']) & set(TIME_COLUMNS):
+            return len(keys) >= 1
+        return len(keys) >= 3
+
+    def _dimension_keys(self, table):
+        """Columns of `table` that are the primary key of another table, in column order."""
+        keys = {info['primary_key'] for name, info in self.tables.items()
+                if name != table and info['primary_key']}
+        return [column for column in self.tables[table]['columns'] if column in keys]
+
+    def _sortkey(self, table):
+        usage = self.usage[table]
+        columns = self.tables[table]['columns']
+        if usage['range']:
+            return max(usage['range'], key=usage['range'].get)
+        for column in TIME_COLUMNS:
+            if column in columns and (self._is_fact(table) or table.startswith('staging_')
+                                      or not self.tables[table]['primary_key']):
+                return column
+        return self.tables[table]['primary_key']
+
+    def _dimension_rows(self, column):
+        for name, info in self.tables.items():
+            if info['primary_key'] == column:
+                return self.table_rows.get(name, 0)
+        return 0
+
+    def analyze(self):
+        """
+        Returns table -> {'diststyle', 'distkey', 'sortkey', 'reason'}.
+        """
+        advice = {}
+        for table, info in self.tables.items():
+            usage = self.usage[table]
+            rows = self.table_rows.get(table)
+            sortkey = self._sortkey(table)
+            if info['diststyle'] != 'AUTO':
+                advice[table] = {'diststyle': info['diststyle'], 'distkey': info['distkey'],
+                    'sortkey': sortkey, 'reason': "distribution fixed in sql_queries"}
+            elif table.startswith('staging_') or self._is_fact(table):
+                scores = {}
+                for kind in ('join', 'group'):
+                    for column, count in usage[kind].items():
+                        scores[column] = scores.get(column, 0) + count
+                if scores:
+                    # Ties go to the column joining the largest dimension.
+                    distkey = max(scores, key=lambda c: (scores[c], self._dimension_rows(c),
+                                                         -info['columns'].index(c)))
+                    advice[table] = {'diststyle': 'KEY', 'distkey': distkey, 'sortkey': sortkey,
+                        'reason': f"joined/grouped on {distkey} ({scores[distkey]} statements)"}
+                elif self._is_fact(table):
+                    # A fact nothing reads yet still grows; spread it on a
+                    # dimension key rather than copying or round-robining it.
+                    distkey = max(self._dimension_keys(table), key=self._dimension_rows)
+                    advice[table] = {'diststyle': 'KEY', 'distkey': distkey, 'sortkey': sortkey,
+                        'reason': f"fact table, distributed on the {distkey} dimension key"}
+                else:
+                    # Keys computed from the columns, such as the song_key of
+                    # staging_songs in song_lookup_insert, are hashed from
+                    # normalized values, so rows sharing a key do not share
+                    # any stored column and no DISTKEY would co-locate them.
+                    advice[table] = {'diststyle': 'EVEN', 'distkey': None, 'sortkey': sortkey,
+                        'reason': "no join or group-by on a stored column"}
+            elif rows is None:
+                # ALL would be wrong for a dimension that turns out large;
+                # AUTO starts small tables as ALL and moves them to EVEN.
+                advice[table] = {'diststyle': 'AUTO', 'distkey': None, 'sortkey': sortkey,
+                    'reason': "dimension of unknown size, distributed by Redshift"}
+            elif rows < self.small_table_rows:
+                advice[table] = {'diststyle': 'ALL', 'distkey': None, 'sortkey': sortkey,
+                    'reason': f"small dimension ({rows} rows), copied to every node"}
+            else:
+                distkey = info['primary_key']
+                advice[table] = {'diststyle': 'KEY', 'distkey': distkey, 'sortkey': sortkey,
+                    'reason': f"large dimension ({rows} rows), distributed on its key"}
+            if self.redistribution.get(table):
+                advice[table]['reason'] += (f"; {self.redistribution[table] / 1024 / 1024:.1f} MB "
+                                            "broadcast/redistributed recently")
+        return advice
+
+    def ddl(self, advice=None):
+        """Returns table -> CREATE TABLE statement with explicit distribution."""
+        advice = advice or self.analyze()
+        statements = {}
+        for table, choice in advice.items():
+            statements[table] = _DISTRIBUTION.sub(_table_attributes(choice),
+                                                  self.tables[table]['ddl'])
+        return statements
+
+    def alter_statements(self, advice=None):
+        """Returns ALTER TABLE statements that apply the advice to existing tables."""
+        advice = advice or self.analyze()
+        statements = []
+        for table, choice in advice.items():
+            if choice['diststyle'] == 'KEY':
+                statements.append(f"ALTER TABLE {table} ALTER DISTKEY {choice['distkey']}")
+            else:
+                statements.append(f"ALTER TABLE {table} ALTER DISTSTYLE {choice['diststyle']}")
+            if choice['sortkey']:
+                statements.append(f"ALTER TABLE {table} ALTER SORTKEY ({choice['sortkey']})")
+        return statements
+
+
+def _table_attributes(choice):
+    attributes = f"DISTSTYLE {choice['diststyle']}"
+    if choice['distkey']:
+        attributes += f" DISTKEY({choice['distkey']})"
+    if choice['sortkey']:
+        attributes += f" SORTKEY({choice['sortkey']})"
+    return attributes
+
+def _split_top_level(text):
+    """Splits on commas that are not inside parentheses."""
+    items, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            items.append(current)
+            current = ''
+        else:
+            current += char
+    items.append(current)
+    return [item for item in items if item.strip()]
+
+def main():
+    advisor = TableDesignAdvisor()
+    for table, choice in advisor.analyze().items():
+        logging.info(f"{table}: {_table_attributes(choice)} -- {choice['reason']}")
+    for statement in advisor.ddl().values():
+        print(statement)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import unittest
+from table_design import TableDesignAdvisor
+from sql_queries import staging_songs_table_create, songplay_table_create, user_table_create, \
+    song_table_create, artist_table_create, time_table_create, song_lookup_table_create, \
+    song_plays_daily_table_create, user_plays_daily_table_create, song_lookup_insert, \
+    read_popular_songs, read_top_active_users, read_popular_songs_rollup
+
+QUERIES = [staging_songs_table_create, songplay_table_create, user_table_create,
+           song_table_create, artist_table_create, time_table_create, song_lookup_table_create,
+           song_plays_daily_table_create, user_plays_daily_table_create, song_lookup_insert,
+           read_popular_songs, read_top_active_users, read_popular_songs_rollup]
+
+def distribution(choice):
+    return choice['diststyle'], choice['distkey'], choice['sortkey']
+
+class TableDesignAdvisorTest(unittest.TestCase):
+
+    def test_unknown_sizes(self):
+        advice = TableDesignAdvisor(QUERIES).analyze()
+        for table, key in [('users', 'user_id'), ('songs', 'song_id'), ('artists', 'artist_id'),
+                           ('time', 'start_time')]:
+            self.assertEqual(distribution(advice[table]), ('AUTO', None, key))
+        self.assertEqual(distribution(advice['songplays'])[0], 'KEY')
+        self.assertEqual(distribution(advice['songplays'])[2], 'start_time')
+
+    def test_rollups_are_facts(self):
+        advice = TableDesignAdvisor(QUERIES).analyze()
+        self.assertEqual(distribution(advice['song_plays_daily']), ('KEY', 'song_id', 'day_start'))
+        # Not read by any of the queries: distributed on its dimension key.
+        self.assertEqual(distribution(advice['user_plays_daily']), ('KEY', 'user_id', 'day_start'))
+
+    def test_known_sizes(self):
+        rows = {'users': 100, 'songs': 10000000, 'user_plays_daily': 10}
+        advice = TableDesignAdvisor(QUERIES, table_rows=rows).analyze()
+        self.assertEqual(distribution(advice['users']), ('ALL', None, 'user_id'))
+        self.assertEqual(distribution(advice['songs']), ('KEY', 'song_id', 'song_id'))
+        self.assertEqual(distribution(advice['user_plays_daily'])[:2], ('KEY', 'user_id'))
+
+    def test_computed_song_key(self):
+        advice = TableDesignAdvisor(QUERIES).analyze()
+        # song_lookup_insert only uses staging_songs through the hashed key.
+        self.assertEqual(distribution(advice['staging_songs'])[:2], ('EVEN', None))
+        self.assertEqual(distribution(advice['song_lookup'])[:2], ('KEY', 'song_key'))
+
+    def test_ddl_replaces_distribution(self):
+        ddl = TableDesignAdvisor(QUERIES).ddl()
+        self.assertIn('DISTSTYLE KEY DISTKEY(song_id) SORTKEY(day_start)', ddl['song_plays_daily'])
+        self.assertIn('DISTSTYLE KEY DISTKEY(song_key)', ddl['song_lookup'])
+        self.assertNotIn('diststyle', ddl['song_lookup'])
+
+if __name__ == "__main__":
+    unittest.main()